@@ -0,0 +1,240 @@
+'''
+Benchmark interfaces on synthetic runs
+======================================
+
+Time and memory-profile cosanlab_preproc's python interfaces on synthetic 4D runs in the space of a bundled MNI template (e.g. 91x109x91xN at 2mm) with matching realignment parameter and outlier files. Each interface and run length is measured in a fresh process; the fastest of the repeats and the largest memory peaks are kept. Results are written to a JSON file that a later run can be compared against, e.g. before upgrading the package in production:
+
+    python benchmarks/bench_interfaces.py --volumes 100 400 --output before.json
+    python benchmarks/bench_interfaces.py --volumes 100 400 --output after.json --compare before.json
+
+With --compare, the exit status is 1 if any interface got slower, or peaked at more memory, by more than --tolerance.
+
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+import cosanlab_preproc
+from cosanlab_preproc.utils import get_resource_path
+
+interfaces = ['Plot_Quality_Control', 'Plot_Realignment_Parameters', 'Plot_Coregistration_Montage',
+              'Down_Sample_Precision', 'Filter_In_Mask', 'Create_Covariates', 'Create_Encoding_File']
+
+tr = 2.
+
+
+def make_data(data_dir, template, n_volumes, seed=0):
+    """ Write a synthetic run in template space and matching mask, realignment parameter, outlier and fieldmap files; returns a dict of their paths. """
+
+    rng = np.random.default_rng(seed)
+    brain = nib.load(os.path.join(get_resource_path(), 'MNI152_T1_%s_brain.nii.gz' % template))
+    base = np.asarray(brain.get_fdata(), dtype=np.float32)
+    mask = base > 0
+
+    # Template contrast plus a slow drift and noise inside the brain, zeros outside like a masked EPI
+    base = 1000 * base / base[mask].mean()
+    run = np.empty(base.shape + (n_volumes,), dtype=np.float32)
+    drift = np.sin(np.linspace(0, 4 * np.pi, n_volumes)).astype(np.float32)
+    for t in range(n_volumes):
+        volume = base * (1 + .01 * drift[t]) + rng.normal(0, 20, base.shape).astype(np.float32)
+        run[..., t] = np.where(mask, volume, 0)
+    files = {'run': os.path.join(data_dir, 'run.nii.gz'),
+             'mask': os.path.join(data_dir, 'mask.nii.gz'),
+             'canonical': os.path.join(get_resource_path(), 'MNI152_T1_%s.nii.gz' % template)}
+    nib.save(nib.Nifti1Image(run, brain.affine), files['run'])
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), brain.affine), files['mask'])
+    del run
+
+    # McFlirt-style parameters: rotations (rad) then translations (mm), as a random walk
+    par = np.cumsum(rng.normal(0, [.0005] * 3 + [.02] * 3, (n_volumes, 6)), axis=0)
+    files['par'] = os.path.join(data_dir, 'run.par')
+    np.savetxt(files['par'], par, fmt='%.6f')
+
+    # About 2% of volumes are ART outliers and 2% FD outliers, half of them the same volumes
+    outliers = np.sort(rng.choice(n_volumes, max(1, n_volumes // 50), replace=False))
+    fds = np.union1d(outliers[::2], rng.choice(n_volumes, max(1, n_volumes // 100), replace=False))
+    files['art'] = os.path.join(data_dir, 'art.outliers.txt')
+    files['fd'] = os.path.join(data_dir, 'fd_outliers.txt')
+    np.savetxt(files['art'], outliers, fmt='%d')
+    np.savetxt(files['fd'], fds, fmt='%d')
+
+    files['fmaps'] = []
+    for direction in ['AP', 'PA']:
+        fmap = os.path.join(data_dir, 'fmap_%s.nii.gz' % direction)
+        nib.save(nib.Nifti1Image(np.zeros(base.shape + (2,), dtype=np.float32), brain.affine), fmap)
+        files['fmaps'].append(fmap)
+    return files
+
+
+def make_interface(name, files, n_volumes):
+    """ Interface name with inputs set from make_data's files. """
+
+    from cosanlab_preproc import interfaces as ifaces
+
+    interface = getattr(ifaces, name)()
+    if name == 'Plot_Quality_Control':
+        interface.inputs.dat_img = files['run']
+    elif name == 'Plot_Realignment_Parameters':
+        interface.inputs.realignment_parameters = files['par']
+        interface.inputs.outliers = files['art']
+    elif name == 'Plot_Coregistration_Montage':
+        interface.inputs.wra_img = files['run']
+        interface.inputs.canonical_img = files['canonical']
+    elif name == 'Down_Sample_Precision':
+        interface.inputs.in_file = files['run']
+    elif name == 'Filter_In_Mask':
+        interface.inputs.in_file = files['run']
+        interface.inputs.mask = files['mask']
+        interface.inputs.sampling_rate = tr
+        interface.inputs.low_pass_cutoff = .1
+        interface.inputs.high_pass_cutoff = .01
+    elif name == 'Create_Covariates':
+        interface.inputs.realignment_parameters = files['par']
+        interface.inputs.spike_id = files['art']
+        interface.inputs.fd_outliers = files['fd']
+    elif name == 'Create_Encoding_File':
+        interface.inputs.fmaps = files['fmaps']
+        interface.inputs.fmap_pes = ['j-', 'j']
+        interface.inputs.totalReadoutTimes = [.0423, .0423]
+        interface.inputs.measurements = [2, 2]
+        interface.inputs.file_name = 'encoding_file.txt'
+    return interface
+
+
+def run_case(name, files, n_volumes, repeats, n_threads, trace_memory=False):
+    """ Run interface name repeats times in fresh directories; returns its timings and memory peaks. """
+
+    case = {'interface': name, 'n_volumes': n_volumes, 'status': 'ok'}
+    runs = []
+    for _ in range(repeats):
+        cwd = tempfile.mkdtemp()
+        try:
+            interface = make_interface(name, files, n_volumes)
+            if n_threads:
+                interface.inputs.num_threads = n_threads
+            interface.inputs.trace_memory = trace_memory
+            runtime = interface.run(cwd=cwd).runtime
+            runs.append(runtime)
+        except Exception as e:
+            case['status'] = 'error'
+            case['error'] = '%s: %s' % (type(e).__name__, str(e).strip().splitlines()[-1] if str(e).strip() else '')
+            return case
+        finally:
+            shutil.rmtree(cwd, ignore_errors=True)
+
+    fastest = min(runs, key=lambda r: r.duration)
+    case['seconds'] = fastest.duration
+    case['volumes_per_s'] = n_volumes / fastest.duration if fastest.duration else None
+    case['phases'] = {phase: stats['time'] for phase, stats in fastest.phases.items()}
+    case['read_mb'] = fastest.read_bytes / 1e6 if fastest.read_bytes is not None else None
+    case['write_mb'] = fastest.write_bytes / 1e6 if fastest.write_bytes is not None else None
+    for key in ['peak_rss_mb', 'tracemalloc_peak_mb']:
+        peaks = [getattr(r, key) for r in runs if getattr(r, key) is not None]
+        case[key] = max(peaks) if peaks else None
+    return case
+
+
+def _run_case(args):
+    # Keep plotting off any display; each case runs in its own process so memory peaks don't carry over
+    import matplotlib
+    matplotlib.use('Agg')
+    return run_case(*args)
+
+
+def compare(results, baseline, tolerance):
+    """ Print each case's time and peak memory relative to baseline; returns the cases that regressed by more than tolerance. """
+
+    old = {(c['interface'], c['n_volumes']): c for c in baseline['results']}
+    regressions = []
+    print("\nCompared to %s (%s)" % (baseline['meta'].get('version'), baseline['meta'].get('date')))
+    print(f"{'interface':<30}{'volumes':>8}{'seconds':>10}{'time':>8}{'peak MB':>10}{'memory':>8}")
+    for case in results:
+        before = old.get((case['interface'], case['n_volumes']))
+        if before is None or before['status'] != 'ok':
+            continue
+        if case['status'] != 'ok':
+            regressions.append(case)
+            print(f"{case['interface']:<30}{case['n_volumes']:>8}  REGRESSION, failed: {case['error']}")
+            continue
+        time_ratio = case['seconds'] / before['seconds'] if before['seconds'] else 1.
+        memory_ratio = (case['peak_rss_mb'] / before['peak_rss_mb']
+                        if case['peak_rss_mb'] and before['peak_rss_mb'] else 1.)
+        flag = ''
+        if time_ratio > 1 + tolerance or memory_ratio > 1 + tolerance:
+            regressions.append(case)
+            flag = '  REGRESSION'
+        print(f"{case['interface']:<30}{case['n_volumes']:>8}{case['seconds']:>10.2f}{time_ratio:>7.2f}x"
+              f"{case['peak_rss_mb'] or 0:>10.0f}{memory_ratio:>7.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark interfaces on synthetic runs")
+    parser.add_argument('--template', default='2mm', choices=['1mm', '2mm', '3mm'],
+                        help="bundled MNI template whose grid the synthetic runs use")
+    parser.add_argument('--volumes', type=int, nargs='+', default=[100, 300])
+    parser.add_argument('--interfaces', nargs='+', default=interfaces, choices=interfaces)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--n_threads', type=int, default=None, help="num_threads of each interface; default all cpus")
+    parser.add_argument('--trace_memory', action='store_true',
+                        help="also record python/numpy memory peaks with tracemalloc; slows interfaces down, so only compare against runs that used it too")
+    parser.add_argument('--output', default='bench_interfaces.json')
+    parser.add_argument('--compare', default=None, help="results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=.2,
+                        help="fraction slower or more memory that counts as a regression; default .2")
+    args = parser.parse_args()
+
+    meta = {'version': cosanlab_preproc.__version__,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'hostname': socket.gethostname(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'nibabel': nib.__version__,
+            'cpu_count': os.cpu_count(),
+            'template': args.template,
+            'repeats': args.repeats,
+            'n_threads': args.n_threads,
+            'trace_memory': args.trace_memory}
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    print(f"{'interface':<30}{'volumes':>8}{'seconds':>10}{'vol/s':>10}{'peak MB':>10}{'numpy MB':>10}")
+    for n_volumes in args.volumes:
+        data_dir = tempfile.mkdtemp()
+        try:
+            files = make_data(data_dir, args.template, n_volumes)
+            for name in args.interfaces:
+                with context.Pool(1) as pool:
+                    case = pool.apply(_run_case, ((name, files, n_volumes, args.repeats, args.n_threads, args.trace_memory),))
+                results.append(case)
+                if case['status'] == 'ok':
+                    print(f"{name:<30}{n_volumes:>8}{case['seconds']:>10.2f}{case['volumes_per_s'] or 0:>10.1f}"
+                          f"{case['peak_rss_mb'] or 0:>10.0f}{case['tracemalloc_peak_mb'] or 0:>10.0f}")
+                else:
+                    print(f"{name:<30}{n_volumes:>8}  failed: {case['error']}")
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=4)
+    print("\nWrote %s" % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
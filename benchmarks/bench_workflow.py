@@ -0,0 +1,216 @@
+'''
+Benchmark workflow orchestration
+================================
+
+Run the full builder workflow end to end on a tiny synthetic BIDS dataset with the FSL and ANTs commands replaced by stubs that write correctly shaped outputs instantly (see stub_tools.py), so what's left is the python overhead of building and running the workflow. Reports:
+
+- graph construction: wfmaker_batch, with a cold and a warm BIDS index, and expanding the workflow's iterables into the graph the scheduler runs
+- interface time: time inside interfaces, split into cosanlab_preproc's interfaces, the stubbed commands (process start-up and writing their outputs) and nipype's own
+- scheduler overhead: the part of the wall time on the critical path that isn't interface time, i.e. nipype hashing inputs, pickling nodes and results, dispatching jobs and polling
+- hashing/caching cost: rerunning the finished workflow, which only hashes inputs and finds every node's result in the cache
+
+Scale the dataset to see how overhead grows with the number of runs, e.g.:
+
+    python benchmarks/bench_workflow.py --subjects 50 --runs 4 --n_procs 8 --output bench_workflow.json
+
+Distortion correction (TOPUP), trimming and FreeSurfer templates aren't stubbed; QA plots are deferred by default since bench_interfaces.py times them.
+
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import tempfile
+import time
+import numpy as np
+import nibabel as nib
+from stub_tools import install_stubs
+
+task_name = 'bench'
+tr = 2.
+
+
+def make_dataset(raw_dir, n_subjects, n_runs, n_volumes, func_shape=(32, 32, 24), anat_shape=(64, 64, 64)):
+    """ Write a BIDS dataset of n_subjects with one T1w and n_runs functional runs of n_volumes each. """
+
+    rng = np.random.default_rng(0)
+    os.makedirs(raw_dir, exist_ok=True)
+    with open(os.path.join(raw_dir, 'dataset_description.json'), 'w') as f:
+        json.dump({'Name': 'cosanlab_preproc benchmark', 'BIDSVersion': '1.0.2'}, f)
+
+    # A bright ellipsoid as head, 3mm functional and 3mm anatomical voxels
+    def head(shape):
+        grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+        return 1000 * (sum(g ** 2 for g in grid) < .8).astype(np.float32)
+
+    anat = head(anat_shape)
+    func = head(func_shape)
+    affine = np.diag([3., 3., 3., 1.])
+    for s in range(1, n_subjects + 1):
+        sub = 'sub-%03d' % s
+        os.makedirs(os.path.join(raw_dir, sub, 'anat'), exist_ok=True)
+        os.makedirs(os.path.join(raw_dir, sub, 'func'), exist_ok=True)
+        nib.save(nib.Nifti1Image(anat + rng.normal(0, 10, anat_shape).astype(np.float32), affine),
+                 os.path.join(raw_dir, sub, 'anat', '%s_T1w.nii.gz' % sub))
+        for r in range(1, n_runs + 1):
+            name = os.path.join(raw_dir, sub, 'func', '%s_task-%s_run-%02d_bold' % (sub, task_name, r))
+            data = func[..., None] + rng.normal(0, 20, func_shape + (n_volumes,)).astype(np.float32)
+            nib.save(nib.Nifti1Image(data, affine), name + '.nii.gz')
+            with open(name + '.json', 'w') as f:
+                json.dump({'RepetitionTime': tr, 'TaskName': task_name}, f)
+
+
+def make_resources(resource_dir):
+    """ Link the bundled resources into resource_dir, adding the OASIS template brain extraction needs if it isn't bundled. """
+
+    from cosanlab_preproc.utils import get_resource_path
+
+    os.makedirs(resource_dir, exist_ok=True)
+    bundled = get_resource_path()
+    for name in os.listdir(bundled):
+        os.symlink(os.path.join(bundled, name), os.path.join(resource_dir, name))
+    # The stub never reads the template, it only has to exist
+    template = os.path.join(resource_dir, 'OASIS_template.nii.gz')
+    if not os.path.exists(template):
+        os.symlink(os.path.join(bundled, 'OASIS_BrainCerebellumExtractionMask.nii.gz'), template)
+
+
+def _category(interface):
+    if interface is None:
+        return 'other'
+    if interface.startswith('cosanlab_preproc.'):
+        return 'cosanlab_preproc'
+    if interface.startswith(('nipype.interfaces.fsl.', 'nipype.interfaces.ants.')):
+        return 'stubbed FSL/ANTs'
+    return 'nipype'
+
+
+def build(project_dir, args):
+    from cosanlab_preproc.wfmaker import wfmaker_batch
+
+    start = time.perf_counter()
+    workflow = wfmaker_batch(project_dir, 'raw', task_name=task_name, mni_template=args.mni_template,
+                             ants_threads=1, reports=args.reports, intermediate_format=args.intermediate_format)
+    return workflow, time.perf_counter() - start
+
+
+def run(workflow, n_procs, mp_context):
+    start = time.time()
+    workflow.run('MultiProc', plugin_args={'n_procs': n_procs, 'mp_context': mp_context})
+    return start, time.time()
+
+
+def analyze(work_dir, run_start, run_end, n_procs):
+    """ Split a run's wall time into interface time and orchestration overhead from its node results. """
+
+    from cosanlab_preproc.timing import load_node_results, critical_path, core_usage
+
+    nodes = load_node_results(work_dir)
+    origin = nodes.attrs['start_time'].timestamp() - run_start
+    path = critical_path(nodes)
+    wall = run_end - run_start
+    nodes['category'] = nodes['interface'].map(_category)
+    return {'wall_time': wall,
+            'n_nodes': len(nodes),
+            'interface_time': nodes.groupby('category')['duration'].sum().to_dict(),
+            'startup': origin,
+            'drain': run_end - (run_start + origin + nodes['end'].max()),
+            'critical_path_interface_time': path['duration'].sum(),
+            'critical_path_waits': path['wait'].sum(),
+            'scheduler_overhead': wall - path['duration'].sum(),
+            'busy_cores': core_usage(nodes),
+            'utilization': core_usage(nodes) / n_procs,
+            'stages': nodes.groupby('stage')['duration'].agg(['count', 'sum', 'mean']).sort_values('sum', ascending=False).to_dict('index')}
+
+
+def print_report(results):
+    first = results['first_run']
+    print("\nDataset: %(subjects)d subjects x %(runs)d runs x %(volumes)d volumes, %(n_procs)d processes (%(mp_context)s)" % results['meta'])
+    print("\nGraph construction")
+    print("  wfmaker_batch, cold BIDS index   %8.2f s" % results['build_cold'])
+    print("  wfmaker_batch, warm BIDS index   %8.2f s" % results['build_warm'])
+    print("  expanding iterables              %8.2f s  (%d nodes)" % (results['expand'], results['n_expanded_nodes']))
+    print("\nFirst run: %.2f s wall for %d nodes" % (first['wall_time'], first['n_nodes']))
+    for category, seconds in sorted(first['interface_time'].items()):
+        print("  %-32s %8.2f s" % ('interfaces: ' + category, seconds))
+    print("  critical path interface time     %8.2f s" % first['critical_path_interface_time'])
+    print("  scheduler overhead               %8.2f s  (%.0f%% of wall, %.0f ms per node)" % (
+        first['scheduler_overhead'], 100 * first['scheduler_overhead'] / first['wall_time'],
+        1000 * first['scheduler_overhead'] / first['n_nodes']))
+    print("    before the first node          %8.2f s" % first['startup'])
+    print("    waits on the critical path     %8.2f s" % first['critical_path_waits'])
+    print("    after the last node            %8.2f s" % first['drain'])
+    print("  mean busy processes              %8.1f    (%.0f%% utilization)" % (first['busy_cores'], 100 * first['utilization']))
+    if 'rerun' in results:
+        print("\nCached rerun (hashing/caching): %.2f s wall, %.0f ms per node" % (
+            results['rerun'], 1000 * results['rerun'] / first['n_nodes']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark workflow orchestration with stubbed FSL/ANTs commands")
+    parser.add_argument('--subjects', type=int, default=2)
+    parser.add_argument('--runs', type=int, default=2, help="functional runs per subject")
+    parser.add_argument('--volumes', type=int, default=40, help="volumes per run")
+    parser.add_argument('--n_procs', type=int, default=os.cpu_count())
+    # Forked workers inherit the lock of nipype's log file, which recent filelock versions refuse to use
+    parser.add_argument('--mp_context', default='forkserver', choices=['fork', 'forkserver', 'spawn'],
+                        help="how MultiProc starts its workers; default 'forkserver'")
+    parser.add_argument('--mni_template', default='3mm', choices=['1mm', '2mm', '3mm'])
+    parser.add_argument('--reports', default='deferred', choices=['inline', 'deferred'])
+    parser.add_argument('--intermediate_format', default='nii.gz', choices=['nii', 'nii.gz'])
+    parser.add_argument('--no_rerun', action='store_true', help="skip the cached rerun")
+    parser.add_argument('--project_dir', default=None, help="keep the dataset and outputs here; default a temporary directory")
+    parser.add_argument('--output', default=None, help="JSON file to write results to")
+    args = parser.parse_args()
+
+    project_dir = os.path.abspath(args.project_dir) if args.project_dir else tempfile.mkdtemp()
+    stub_dir = os.path.join(project_dir, 'stubs')
+    try:
+        make_dataset(os.path.join(project_dir, 'raw'), args.subjects, args.runs, args.volumes)
+        install_stubs(os.path.join(stub_dir, 'bin'), fsl_dir=os.path.join(stub_dir, 'fsl'))
+        make_resources(os.path.join(stub_dir, 'resources'))
+        os.environ['PATH'] = os.path.join(stub_dir, 'bin') + os.pathsep + os.environ['PATH']
+        os.environ['FSLDIR'] = os.path.join(stub_dir, 'fsl')
+        os.environ['FSLOUTPUTTYPE'] = 'NIFTI_GZ'
+        os.environ['COSANLAB_PREPROC_RESOURCES'] = os.path.join(stub_dir, 'resources')
+
+        from nipype import config
+        from nipype.pipeline.engine.utils import generate_expanded_graph
+
+        results = {'meta': {'subjects': args.subjects, 'runs': args.runs, 'volumes': args.volumes,
+                            'n_procs': args.n_procs, 'mp_context': args.mp_context, 'mni_template': args.mni_template, 'reports': args.reports,
+                            'intermediate_format': args.intermediate_format,
+                            'poll_sleep_duration': config.get('execution', 'poll_sleep_duration'),
+                            'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'hostname': socket.gethostname(),
+                            'platform': platform.platform(), 'python': platform.python_version(),
+                            'cpu_count': os.cpu_count()}}
+        workflow, results['build_cold'] = build(project_dir, args)
+        workflow, results['build_warm'] = build(project_dir, args)
+        start = time.perf_counter()
+        graph = generate_expanded_graph(workflow._create_flat_graph())
+        results['expand'] = time.perf_counter() - start
+        results['n_expanded_nodes'] = graph.number_of_nodes()
+
+        work_dir = os.path.join(workflow.base_dir, workflow.name)
+        run_start, run_end = run(workflow, args.n_procs, args.mp_context)
+        results['first_run'] = analyze(work_dir, run_start, run_end, args.n_procs)
+        if not args.no_rerun:
+            workflow, _ = build(project_dir, args)
+            run_start, run_end = run(workflow, args.n_procs, args.mp_context)
+            results['rerun'] = run_end - run_start
+    finally:
+        if not args.project_dir:
+            shutil.rmtree(project_dir, ignore_errors=True)
+
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4, default=float)
+        print("\nWrote %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+'''
+Stub FSL and ANTs executables
+=============================
+
+Stand-ins for the FSL and ANTs commands that builder's default pipeline runs (mcflirt, fslmaths, antsRegistration, antsApplyTransforms, N4BiasFieldCorrection and antsBrainExtraction.sh). Each parses the command line nipype generates and instantly writes every output nipype expects, with the right shape and space (e.g. a normalized run is on the reference image's grid and has the input's number of volumes), so a workflow can run end to end without the real tools. install_stubs writes an executable for each command into a directory to put on PATH; they call:
+
+    python stub_tools.py <command> <arguments>
+
+'''
+
+import os
+import re
+import stat
+import sys
+import numpy as np
+import nibabel as nib
+
+commands = ['mcflirt', 'fslmaths', 'antsRegistration', 'antsApplyTransforms', 'N4BiasFieldCorrection',
+            'antsBrainExtraction.sh']
+
+fsl_version = '6.0.5'
+ants_version = '2.3.5'
+
+# A rigid ITK transform, for transform files that are only passed on to other (stub) commands
+itk_identity = ("#Insight Transform File V1.0\n#Transform 0\nTransform: MatrixOffsetTransformBase_double_3_3\n"
+                "Parameters: 1 0 0 0 1 0 0 0 1 0 0 0\nFixedParameters: 0 0 0\n")
+
+
+def install_stubs(bin_dir, fsl_dir=None):
+    """
+    Write an executable for each stubbed command into bin_dir, and if fsl_dir is given a minimal FSLDIR there so nipype can read the FSL version.
+
+    Args:
+        bin_dir: directory to put first on PATH
+        fsl_dir: directory to set FSLDIR to
+
+    """
+
+    os.makedirs(bin_dir, exist_ok=True)
+    for command in commands:
+        path = os.path.join(bin_dir, command)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, os.path.abspath(__file__), command))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    if fsl_dir is not None:
+        os.makedirs(os.path.join(fsl_dir, 'etc'), exist_ok=True)
+        with open(os.path.join(fsl_dir, 'etc', 'fslversion'), 'w') as f:
+            f.write(fsl_version)
+
+
+def _option(args, *names):
+    """ Value following the first of names in args, or None. """
+
+    for name in names:
+        if name in args:
+            return args[args.index(name) + 1]
+    return None
+
+
+def _bracketed(args, name):
+    """ Comma-separated values of an ANTs option given as name [ a, b, c ] (or name a), as a list. """
+
+    text = ' '.join(args)
+    match = re.search(re.escape(name) + r'\s*\[([^\]]*)\]', text)
+    if match:
+        return [v.strip() for v in match.group(1).split(',')]
+    value = _option(args, name)
+    return [value] if value is not None else []
+
+
+def _save(data, img, out_file, dtype=np.float32):
+    hdr = img.header.copy()
+    hdr.set_data_dtype(dtype)
+    nib.save(nib.Nifti1Image(np.asarray(data, dtype=dtype), img.affine, hdr), out_file)
+
+
+def _labels(data):
+    """ Three tissue labels (1 CSF, 2 gray matter, 3 white matter) from intensity terciles of the nonzero voxels. """
+
+    labels = np.zeros(data.shape, dtype=np.int16)
+    inside = data > 0
+    if inside.any():
+        cuts = np.percentile(data[inside], [33, 66])
+        labels[inside] = 1 + np.searchsorted(cuts, data[inside])
+    return labels
+
+
+def _image_ext(out_file):
+    return '.nii.gz' if out_file.endswith('.nii.gz') else os.path.splitext(out_file)[1]
+
+
+def mcflirt(args):
+    in_file = _option(args, '-in')
+    out_file = _option(args, '-out')
+    img = nib.load(in_file)
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    n_volumes = data.shape[3] if data.ndim == 4 else 1
+    _save(data, img, out_file)
+    base = out_file[:-len(_image_ext(out_file))]
+    if '-meanvol' in args:
+        _save(data.mean(axis=3) if data.ndim == 4 else data, img, base + '_mean_reg' + _image_ext(out_file))
+    if '-plots' in args:
+        rng = np.random.default_rng(0)
+        par = np.cumsum(rng.normal(0, [.0005] * 3 + [.02] * 3, (n_volumes, 6)), axis=0)
+        np.savetxt(out_file + '.par', par, fmt='%.6f')
+    if '-mats' in args:
+        mat_dir = out_file + '.mat'
+        os.makedirs(mat_dir, exist_ok=True)
+        for t in range(n_volumes):
+            np.savetxt(os.path.join(mat_dir, 'MAT_%04d' % t), np.eye(4), fmt='%g')
+    if '-rmsabs' in args:
+        np.savetxt(out_file + '_abs.rms', np.zeros(n_volumes))
+        np.savetxt(out_file + '_abs_mean.rms', [0])
+    if '-rmsrel' in args:
+        np.savetxt(out_file + '_rel.rms', np.zeros(max(n_volumes - 1, 1)))
+        np.savetxt(out_file + '_rel_mean.rms', [0])
+
+
+def fslmaths(args):
+    img = nib.load(args[0])
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    if '-Tmean' in args and data.ndim == 4:
+        data = data.mean(axis=3)
+    _save(data, img, args[-1])
+
+
+def antsRegistration(args):
+    fixed, moving = _bracketed(args, '--initial-moving-transform')[:2]
+    outputs = _bracketed(args, '--output')
+    prefix = outputs[0]
+    if '--write-composite-transform 1' in ' '.join(args):
+        for name in ['Composite.h5', 'InverseComposite.h5']:
+            with open(prefix + name, 'w') as f:
+                f.write(itk_identity)
+    # The warped moving image is on the fixed image's grid and vice versa
+    if len(outputs) > 1:
+        _save(np.asarray(nib.load(fixed).dataobj), nib.load(fixed), outputs[1])
+    if len(outputs) > 2:
+        _save(np.asarray(nib.load(moving).dataobj), nib.load(moving), outputs[2])
+
+
+def antsApplyTransforms(args):
+    in_img = nib.load(_option(args, '--input', '-i'))
+    ref_img = nib.load(_option(args, '--reference-image', '-r'))
+    out_file = _option(args, '--output', '-o')
+    ref = np.asarray(ref_img.dataobj, dtype=np.float32)
+    if _option(args, '--interpolation', '-n') in ['MultiLabel', 'NearestNeighbor', 'GenericLabel']:
+        _save(_labels(ref), ref_img, out_file, dtype=np.int16)
+    elif len(in_img.shape) == 4:
+        # A time series: the reference image scaled by each volume's mean
+        data = np.asarray(in_img.dataobj, dtype=np.float32)
+        scale = data.reshape(-1, data.shape[3]).mean(axis=0) / max(float(ref.mean()), 1e-6)
+        _save(ref[..., None] * scale, ref_img, out_file)
+    else:
+        _save(ref, ref_img, out_file)
+
+
+def N4BiasFieldCorrection(args):
+    in_file = _option(args, '--input-image', '-i')
+    outputs = _bracketed(args, '--output')
+    img = nib.load(in_file)
+    _save(np.asarray(img.dataobj, dtype=np.float32), img, outputs[0])
+    if len(outputs) > 1:
+        _save(np.ones(img.shape), img, outputs[1])
+
+
+def antsBrainExtraction(args):
+    anat_img = nib.load(_option(args, '-a'))
+    prefix = _option(args, '-o')
+    suffix = _option(args, '-s') or 'nii.gz'
+    anat = np.asarray(anat_img.dataobj, dtype=np.float32)
+    mask = anat > np.percentile(anat, 50)
+    labels = _labels(np.where(mask, anat, 0))
+    images = {'BrainExtractionBrain': anat * mask,
+              'BrainExtractionMask': mask,
+              'BrainExtractionSegmentation': labels,
+              'BrainExtractionCSF': labels == 1,
+              'BrainExtractionGM': labels == 2,
+              'BrainExtractionWM': labels == 3}
+    for name in ['BrainExtractionInitialAffineFixed', 'BrainExtractionInitialAffineMoving', 'BrainExtractionLaplacian',
+                 'BrainExtractionPrior1InverseWarp', 'BrainExtractionPrior1Warp', 'BrainExtractionPriorWarped',
+                 'BrainExtractionTemplateLaplacian', 'BrainExtractionTmp', 'N4Corrected0', 'N4Truncated0']:
+        images[name] = anat
+    for name, data in images.items():
+        _save(data, anat_img, '%s%s.%s' % (prefix, name, suffix))
+    for name in ['BrainExtractionInitialAffine.mat', 'BrainExtractionPrior0GenericAffine.mat']:
+        with open(prefix + name, 'w') as f:
+            f.write(itk_identity)
+
+
+def main(command, args):
+    if '--version' in args:
+        print('ANTs Version: %s' % ants_version)
+        return
+    handlers = {'antsBrainExtraction.sh': antsBrainExtraction}
+    handler = handlers.get(command) or globals()[command]
+    handler(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2:])
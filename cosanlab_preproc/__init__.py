@@ -7,6 +7,6 @@ __all__ = [
 ]
 
 from .pipelines import Couple_Preproc_Pipeline, TV_Preproc_Pipeline
-from .interfaces import Plot_Coregistration_Montage, Plot_Realignment_Parameters, Create_Covariates, Down_Sample_Precision, Filter_In_Mask, Create_Encoding_File
+from .interfaces import Plot_Coregistration_Montage, Plot_Realignment_Parameters, Compute_Quality_Metrics, Plot_Quality_Metrics, Compute_Run_Statistics, Compute_CompCor, Create_Covariates, Down_Sample_Precision, Filter_In_Mask, Smooth_In_Mask, Filter_Smooth_Down_Sample, Filter_Smooth_Down_Sample_Grid, Create_Encoding_File
 from .wfmaker import wfmaker
 from .version import __version__
@@ -3,7 +3,7 @@ import matplotlib
 matplotlib.use('Agg')
 import nibabel as nib
 import os
-from .utils import get_resource_path
+from .utils import get_resource_path, get_image_gb, get_n_volumes
 
 """
 Builder
@@ -14,7 +14,7 @@ Base function to build dynamic workflows using BIDS formatted data files.
 """
 
 
-def builder(subject_id, subId, project_dir, data_dir, output_dir, output_final_dir, output_interm_dir, log_dir, layout, anat=None, funcs=None, fmaps=None, task_name='', session=None, apply_trim=False, apply_dist_corr=False, apply_smooth=False, apply_filter=False, mni_template='2mm', apply_n4=True, ants_threads=8, readable_crash_files=False):
+def builder(subject_id, subId, project_dir, data_dir, output_dir, output_final_dir, output_interm_dir, log_dir, layout, anat=None, funcs=None, fmaps=None, task_name='', session=None, apply_trim=False, apply_dist_corr=False, apply_smooth=False, apply_filter=False, mni_template='2mm', apply_n4=True, ants_threads=8, readable_crash_files=False, reports='inline', intermediate_format='nii.gz', apply_compcor=False, shared_anat=False, sink_mode='hardlink'):
     """
     Core function that returns a workflow. See wfmaker for more details.
 
@@ -27,7 +27,12 @@ def builder(subject_id, subId, project_dir, data_dir, output_dir, output_final_d
         output_final_dir: final preprocessed sub-dir name
         output_interm_dir: intermediate preprcess sub-dir name
         log_dir: directory for nipype log files
-        layout: BIDS layout instance
+        layout: BIDS layout (or cosanlab_preproc.bids_index.BIDSIndex) instance
+        intermediate_format: 'nii' to write uncompressed intermediate 4D files or 'nii.gz' to compress them
+        reports: 'inline' to render QA plots within the workflow or 'deferred' to only save the data they need for cosanlab_preproc.reports.render_reports
+        apply_compcor: False, or list of 'acompcor' and/or 'tcompcor' regressors to add to the covariates
+        shared_anat: if True anat isn't processed; the brain, normalization transform and outputs of an anat_builder workflow are connected to the workflow's anat_inputs node instead
+        sink_mode: 'hardlink', 'reflink' or 'copy'; how final outputs are put in output_final_dir (see interfaces.Link_DataSink)
     """
 
     ##################
@@ -38,11 +43,6 @@ def builder(subject_id, subId, project_dir, data_dir, output_dir, output_final_d
     MNImask = os.path.join(get_resource_path(), 'MNI152_T1_' + mni_template + '_brain_mask.nii.gz')
     MNItemplatehasskull = os.path.join(get_resource_path(), 'MNI152_T1_' + mni_template + '.nii.gz')
 
-    # Set ANTs files
-    bet_ants_template = os.path.join(get_resource_path(), 'OASIS_template.nii.gz')
-    bet_ants_prob_mask = os.path.join(get_resource_path(), 'OASIS_BrainCerebellumProbabilityMask.nii.gz')
-    bet_ants_registration_mask = os.path.join(get_resource_path(), 'OASIS_BrainCerebellumRegistrationMask.nii.gz')
-
     #################################
     ### NIPYPE IMPORTS AND CONFIG ###
     #################################
@@ -57,19 +57,23 @@ def builder(subject_id, subId, project_dir, data_dir, output_dir, output_final_d
     logging.update_logging(config)
 
     # Now import everything else
-    from nipype.interfaces.io import DataSink
     from nipype.interfaces.utility import Merge, IdentityInterface
     from nipype.pipeline.engine import Node, Workflow
-    from nipype.interfaces.nipy.preprocess import ComputeMask
-    from nipype.algorithms.rapidart import ArtifactDetect
-    from nipype.interfaces.ants.segmentation import BrainExtraction, N4BiasFieldCorrection
     from nipype.interfaces.ants import Registration, ApplyTransforms
     from nipype.interfaces.fsl import MCFLIRT, TOPUP, ApplyTOPUP
     from nipype.interfaces.fsl.maths import MeanImage
     from nipype.interfaces.fsl import Merge as MERGE
-    from nipype.interfaces.fsl.utils import Smooth
     from nipype.interfaces.nipy.preprocess import Trim
-    from .interfaces import Plot_Coregistration_Montage, Plot_Quality_Control, Plot_Realignment_Parameters, Create_Covariates, Down_Sample_Precision, Create_Encoding_File, Filter_In_Mask
+    from .interfaces import Plot_Coregistration_Montage, Compute_Run_Statistics, Plot_Quality_Metrics, Plot_Realignment_Parameters, Compute_CompCor, Create_Covariates, Filter_Smooth_Down_Sample_Grid, Create_Encoding_File, Link_DataSink
+    from .nifti import load_header
+
+    # FSL output type for intermediate files; final outputs are always compressed
+    if intermediate_format == 'nii':
+        intermediate_type = 'NIFTI'
+    elif intermediate_format == 'nii.gz':
+        intermediate_type = 'NIFTI_GZ'
+    else:
+        raise ValueError("intermediate_format must be 'nii' or 'nii.gz'")
 
     ##################
     ### INPUT NODE ###
@@ -82,11 +86,19 @@ def builder(subject_id, subId, project_dir, data_dir, output_dir, output_final_d
     # Get TR for use in filtering below; we're assuming all BOLD runs have the same TR
     tr_length = layout.get_metadata(funcs[0])['RepetitionTime']
 
+    ##########################
+    ### RESOURCE ESTIMATES ###
+    ##########################
+    # Every node declares its threads (n_procs) and peak memory (mem_gb) so MultiProc can pack nodes without oversubscribing cores or memory
+    # Memory is estimated from float32 copies of the largest run (func_gb) and of that run resampled to the template (mni_gb)
+    func_gb = max(get_image_gb(f) for f in funcs)
+    mni_gb = get_image_gb(MNItemplate, n_volumes=max(get_n_volumes(f) for f in funcs))
+
     #####################################
     ## TRIM ##
     #####################################
     if apply_trim:
-        trim = Node(Trim(), name='trim')
+        trim = Node(Trim(), name='trim', mem_gb=2 * func_gb + .2)
         trim.inputs.begin_index = apply_trim
 
     #####################################
@@ -106,14 +118,14 @@ def builder(subject_id, subId, project_dir, data_dir, output_dir, output_final_d
             # Grab total readout time for each fmap
             totalReadoutTimes.append(layout.get_metadata(fmap)['TotalReadoutTime'])
 
-            # Grab measurements (for some reason pyBIDS doesn't grab dcm_meta... fields from side-car json file and json.load, doesn't either; so instead just read the header using nibabel to determine number of scans)
-            measurements.append(nib.load(fmap).header['dim'][4])
+            # Grab measurements (for some reason pyBIDS doesn't grab dcm_meta... fields from side-car json file and json.load, doesn't either; so instead just read the header to determine number of scans)
+            measurements.append(load_header(fmap)['dim'][4])
 
             # Get phase encoding direction
             fmap_pe = layout.get_metadata(fmap)["PhaseEncodingDirection"]
             fmap_pes.append(fmap_pe)
 
-        encoding_file_writer = Node(interface=Create_Encoding_File(), name='create_encoding')
+        encoding_file_writer = Node(interface=Create_Encoding_File(), name='create_encoding', n_procs=1)
         encoding_file_writer.inputs.totalReadoutTimes = totalReadoutTimes
         encoding_file_writer.inputs.fmaps = fmaps
         encoding_file_writer.inputs.fmap_pes = fmap_pes
@@ -125,86 +137,82 @@ def builder(subject_id, subId, project_dir, data_dir, output_dir, output_final_d
         merge_to_file_list.inputs.in1 = fmaps[1]
 
         # Merge AP and PA distortion correction scans
-        merger = Node(interface=MERGE(dimension='t'), name='merger')
-        merger.inputs.output_type = 'NIFTI_GZ'
+        merger = Node(interface=MERGE(dimension='t'), name='merger', mem_gb=.5)
+        merger.inputs.output_type = intermediate_type
         merger.inputs.in_files = fmaps
-        merger.inputs.merged_file = 'merged_epi.nii.gz'
+        merger.inputs.merged_file = 'merged_epi.' + intermediate_format
 
         # Create distortion correction map
-        topup = Node(interface=TOPUP(), name='topup')
-        topup.inputs.output_type = 'NIFTI_GZ'
+        topup = Node(interface=TOPUP(), name='topup', mem_gb=1)
+        topup.inputs.output_type = intermediate_type
 
         # Apply distortion correction to other scans
-        apply_topup = Node(interface=ApplyTOPUP(), name='apply_topup')
-        apply_topup.inputs.output_type = 'NIFTI_GZ'
+        apply_topup = Node(interface=ApplyTOPUP(), name='apply_topup', mem_gb=2 * func_gb + .5)
+        apply_topup.inputs.output_type = intermediate_type
         apply_topup.inputs.method = 'jac'
         apply_topup.inputs.interp = 'spline'
 
     ###################################
     ### REALIGN ###
     ###################################
-    realign_fsl = Node(MCFLIRT(), name="realign")
+    realign_fsl = Node(MCFLIRT(), name="realign", mem_gb=2 * func_gb + .5)
     realign_fsl.inputs.cost = 'mutualinfo'
     realign_fsl.inputs.mean_vol = True
-    realign_fsl.inputs.output_type = 'NIFTI_GZ'
+    realign_fsl.inputs.output_type = intermediate_type
     realign_fsl.inputs.save_mats = True
     realign_fsl.inputs.save_rms = True
     realign_fsl.inputs.save_plots = True
 
     ###################################
-    ### MEAN EPIs ###
+    ### MEAN EPI, MASK, ART, QC ###
     ###################################
-    # For coregistration after realignment
-    mean_epi = Node(MeanImage(), name='mean_epi')
-    mean_epi.inputs.dimension = 'T'
+    # Single read of the realigned run to get the mean epi for coregistration, brain mask, rapidart-equivalent outliers and QC metrics
+    # QC metrics and outliers are computed separately from the QC plot so covariate creation doesn't wait on rendering
+    run_stats = Node(Compute_Run_Statistics(), name='run_stats', n_procs=1, mem_gb=1)
+    run_stats.inputs.mask_fraction = .05
+    run_stats.inputs.use_differences = [True, False]
+    run_stats.inputs.norm_threshold = 1
+    run_stats.inputs.zintensity_threshold = 3
+    run_stats.inputs.parameter_source = 'FSL'
 
     # For after normalization is done to plot checks
-    mean_norm_epi = Node(MeanImage(), name='mean_norm_epi')
+    mean_norm_epi = Node(MeanImage(), name='mean_norm_epi', mem_gb=mni_gb + .2)
     mean_norm_epi.inputs.dimension = 'T'
+    mean_norm_epi.inputs.output_type = 'NIFTI_GZ'
 
     ###################################
-    ### MASK, ART, COV CREATION ###
+    ### COV CREATION ###
     ###################################
-    compute_mask = Node(ComputeMask(), name='compute_mask')
-    compute_mask.inputs.m = .05
-
-    art = Node(ArtifactDetect(), name='art')
-    art.inputs.use_differences = [True, False]
-    art.inputs.use_norm = True
-    art.inputs.norm_threshold = 1
-    art.inputs.zintensity_threshold = 3
-    art.inputs.mask_type = 'file'
-    art.inputs.parameter_source = 'FSL'
+    make_cov = Node(Create_Covariates(), name='make_cov', n_procs=1, mem_gb=.2)
 
-    make_cov = Node(Create_Covariates(), name='make_cov')
-
-    ################################
-    ### N4 BIAS FIELD CORRECTION ###
-    ################################
-    if apply_n4:
-        n4_correction = Node(N4BiasFieldCorrection(), name='n4_correction')
-        n4_correction.inputs.copy_header = True
-        n4_correction.inputs.save_bias = False
-        n4_correction.inputs.num_threads = ants_threads
-        n4_correction.inputs.input_image = anat
+    # CompCor regressors from the normalized run and the normalized tissue segmentation
+    if apply_compcor:
+        compcor = Node(Compute_CompCor(), name='compcor', n_procs=1, mem_gb=.5 * mni_gb + .5)
+        compcor.inputs.components_type = apply_compcor
 
     ###################################
-    ### BRAIN EXTRACTION ###
+    ### ANATOMICAL ###
     ###################################
-    brain_extraction_ants = Node(BrainExtraction(), name='brain_extraction')
-    brain_extraction_ants.inputs.dimension = 3
-    brain_extraction_ants.inputs.use_floatingpoint_precision = 1
-    brain_extraction_ants.inputs.num_threads = ants_threads
-    brain_extraction_ants.inputs.brain_probability_mask = bet_ants_prob_mask
-    brain_extraction_ants.inputs.keep_temporary_files = 1
-    brain_extraction_ants.inputs.brain_template = bet_ants_template
-    brain_extraction_ants.inputs.extraction_registration_mask = bet_ants_registration_mask
-    brain_extraction_ants.inputs.out_prefix = 'bet'
+    # N4 bias field correction, brain extraction and normalization of anat, or their outputs from a shared anat_builder workflow
+    if shared_anat:
+        anat_inputs = Node(IdentityInterface(fields=['brain', 'transform', 'warped_image', 'segmentation']), name='anat_inputs')
+        anat_brain = (anat_inputs, 'brain')
+        anat_transform = (anat_inputs, 'transform')
+        anat_warped = (anat_inputs, 'warped_image')
+        anat_segmentation = (anat_inputs, 'segmentation')
+    else:
+        if anat is None:
+            raise IOError("No T1w anatomical scan found for subject %s" % subject_id)
+        n4_correction, brain_extraction_ants, normalization, apply_transform_seg = _anatomical_nodes(anat, MNItemplate, apply_n4, ants_threads, get_image_gb(anat))
+        anat_brain = (brain_extraction_ants, 'BrainExtractionBrain')
+        anat_transform = (normalization, 'composite_transform')
+        anat_warped = (normalization, 'warped_image')
+        anat_segmentation = (apply_transform_seg, 'output_image')
 
     ###################################
     ### COREGISTRATION ###
     ###################################
-    coregistration = Node(Registration(), name='coregistration')
+    coregistration = Node(Registration(), name='coregistration', n_procs=ants_threads, mem_gb=1.5)
     coregistration.inputs.float = False
     coregistration.inputs.output_transform_prefix = "meanEpi2highres"
     coregistration.inputs.transforms = ['Rigid']
@@ -231,136 +239,68 @@ def builder(subject_id, subId, project_dir, data_dir, output_dir, output_final_d
     coregistration.inputs.winsorize_lower_quantile = 0.01
     coregistration.inputs.winsorize_upper_quantile = 0.99
 
-    ###################################
-    ### NORMALIZATION ###
-    ###################################
-    # Settings Explanations
-    # Only a few key settings are worth adjusting and most others relate to how ANTs optimizer starts or iterates and won't make a ton of difference
-    # Brian Avants referred to these settings as the last "best tested" when he was aligning fMRI data: https://github.com/ANTsX/ANTsRCore/blob/master/R/antsRegistration.R#L275
-    # Things that matter the most:
-    # smoothing_sigmas:
-    # how much gaussian smoothing to apply when performing registration, probably want the upper limit of this to match the resolution that the data is collected at e.g. 3mm
-    # Old settings [[3,2,1,0]]*3
-    # shrink_factors
-    # The coarseness with which to do registration
-    # Old settings [[8,4,2,1]] * 3
-    # >= 8 may result is some problems causing big chunks of cortex with little fine grain spatial structure to be moved to other parts of cortex
-    # Other settings
-    # transform_parameters:
-    # how much regularization to do for fitting that transformation
-    # for syn this pertains to both the gradient regularization term, and the flow, and elastic terms. Leave the syn settings alone as they seem to be the most well tested across published data sets
-    # radius_or_number_of_bins
-    # This is the bin size for MI metrics and 32 is probably adequate for most use cases. Increasing this might increase precision (e.g. to 64) but takes exponentially longer
-    # use_histogram_matching
-    # Use image intensity distribution to guide registration
-    # Leave it on for within modality registration (e.g. T1 -> MNI), but off for between modality registration (e.g. EPI -> T1)
-    # convergence_threshold
-    # threshold for optimizer
-    # convergence_window_size
-    # how many samples should optimizer average to compute threshold?
-    # sampling_strategy
-    # what strategy should ANTs use to initialize the transform. Regular here refers to approximately random sampling around the center of the image mass
-    normalization = Node(Registration(), name='normalization')
-    normalization.inputs.float = False
-    normalization.inputs.collapse_output_transforms = True
-    normalization.inputs.convergence_threshold = [1e-06, 1e-06, 1e-07]
-    normalization.inputs.convergence_window_size = [10]
-    normalization.inputs.dimension = 3
-    normalization.inputs.fixed_image = MNItemplate
-    normalization.inputs.initial_moving_transform_com = True
-    normalization.inputs.metric = ['MI', 'MI', 'CC']
-    normalization.inputs.metric_weight = [1.0]*3
-    normalization.inputs.number_of_iterations = [[1000, 500, 250, 100],
-                                                 [1000, 500, 250, 100],
-                                                 [100, 70, 50, 20]]
-    normalization.inputs.num_threads = ants_threads
-    normalization.inputs.output_transform_prefix = 'anat2template'
-    normalization.inputs.output_inverse_warped_image = True
-    normalization.inputs.output_warped_image = True
-    normalization.inputs.radius_or_number_of_bins = [32, 32, 4]
-    normalization.inputs.sampling_percentage = [0.25, 0.25, 1]
-    normalization.inputs.sampling_strategy = ['Regular',
-                                              'Regular',
-                                              'None']
-    normalization.inputs.shrink_factors = [[4, 3, 2, 1]]*3
-    normalization.inputs.sigma_units = ['vox']*3
-    normalization.inputs.smoothing_sigmas = [[2, 1], [2, 1], [3, 2, 1, 0]]
-    normalization.inputs.transforms = ['Rigid', 'Affine', 'SyN']
-    normalization.inputs.transform_parameters = [(0.1,),
-                                                 (0.1,),
-                                                 (0.1, 3.0, 0.0)]
-    normalization.inputs.use_histogram_matching = True
-    normalization.inputs.winsorize_lower_quantile = 0.005
-    normalization.inputs.winsorize_upper_quantile = 0.995
-    normalization.inputs.write_composite_transform = True
-
     ###################################
     ### APPLY TRANSFORMS AND SMOOTH ###
     ###################################
     merge_transforms = Node(Merge(2), iterfield=['in2'], name='merge_transforms')
 
     # Used for epi -> mni, via (coreg + norm)
-    apply_transforms = Node(ApplyTransforms(), iterfield=['input_image'], name='apply_transforms')
+    # ANTs holds the run and its resampled copy in double precision
+    apply_transforms = Node(ApplyTransforms(), iterfield=['input_image'], name='apply_transforms', n_procs=ants_threads, mem_gb=2 * (func_gb + mni_gb) + .5)
     apply_transforms.inputs.input_image_type = 3
     apply_transforms.inputs.float = False
-    apply_transforms.inputs.num_threads = 12
+    apply_transforms.inputs.num_threads = ants_threads
     apply_transforms.inputs.environ = {}
     apply_transforms.inputs.interpolation = 'BSpline'
     apply_transforms.inputs.invert_transform_flags = [False, False]
     apply_transforms.inputs.reference_image = MNItemplate
 
-    # Used for t1 segmented -> mni, via (norm)
-    apply_transform_seg = Node(ApplyTransforms(), name='apply_transform_seg')
-    apply_transform_seg.inputs.input_image_type = 3
-    apply_transform_seg.inputs.float = False
-    apply_transform_seg.inputs.num_threads = 12
-    apply_transform_seg.inputs.environ = {}
-    apply_transform_seg.inputs.interpolation = 'MultiLabel'
-    apply_transform_seg.inputs.invert_transform_flags = [False]
-    apply_transform_seg.inputs.reference_image = MNItemplate
-
     ###################################
     ### PLOTS ###
     ###################################
-    plot_realign = Node(Plot_Realignment_Parameters(), name="plot_realign")
-    plot_qa = Node(Plot_Quality_Control(), name="plot_qa")
-    plot_normalization_check = Node(Plot_Coregistration_Montage(), name="plot_normalization_check")
-    plot_normalization_check.inputs.canonical_img = MNItemplatehasskull
+    # When reports are deferred, plot inputs are saved instead and rendered in batch after the workflow finishes
+    if reports == 'inline':
+        plot_realign = Node(Plot_Realignment_Parameters(), name="plot_realign", n_procs=1, mem_gb=.5)
+        plot_qa = Node(Plot_Quality_Metrics(), name="plot_qa", n_procs=1, mem_gb=.5)
+        plot_normalization_check = Node(Plot_Coregistration_Montage(), name="plot_normalization_check", n_procs=1, mem_gb=.5)
+        plot_normalization_check.inputs.canonical_img = MNItemplatehasskull
+    elif reports != 'deferred':
+        raise ValueError("reports must be 'inline' or 'deferred'")
 
     ############################################
     ### FILTER, SMOOTH, DOWNSAMPLE PRECISION ###
     ############################################
-    # Use cosanlab_preproc for down sampling
-    down_samp = Node(Down_Sample_Precision(), name="down_samp")
+    # Use cosanlab_preproc to filter, smooth and down sample in one node so the normalized run is only read and written once for every combination of filter cut-off and smoothing kernel
+    # Filtering holds the run's in-mask time series in memory; smoothing and writing only hold a chunk of volumes
+    down_samp = Node(Filter_Smooth_Down_Sample_Grid(), name="filter_smooth_down_samp", n_procs=ants_threads, mem_gb=(mni_gb if apply_filter else 0) + .5)
 
-    # Use FSL for smoothing
     if apply_smooth:
-        smooth = Node(Smooth(), name='smooth')
+        # Smooth within the brain so signal doesn't bleed across its boundary
+        down_samp.inputs.smooth_mask = MNImask
         if isinstance(apply_smooth, list):
-            smooth.iterables = ("fwhm", apply_smooth)
+            down_samp.inputs.fwhm = apply_smooth
         elif isinstance(apply_smooth, int) or isinstance(apply_smooth, float):
-            smooth.inputs.fwhm = apply_smooth
+            down_samp.inputs.fwhm = [apply_smooth]
         else:
             raise ValueError("apply_smooth must be a list or int/float")
 
-    # Use cosanlab_preproc for low-pass filtering
     if apply_filter:
-        lp_filter = Node(Filter_In_Mask(), name='lp_filter')
-        lp_filter.inputs.mask = MNImask
-        lp_filter.inputs.sampling_rate = tr_length
-        lp_filter.inputs.high_pass_cutoff = 0
+        down_samp.inputs.mask = MNImask
+        down_samp.inputs.sampling_rate = tr_length
+        down_samp.inputs.high_pass_cutoff = 0
         if isinstance(apply_filter, list):
-            lp_filter.iterables = ("low_pass_cutoff", apply_filter)
+            down_samp.inputs.low_pass_cutoff = apply_filter
         elif isinstance(apply_filter, int) or isinstance(apply_filter, float):
-            lp_filter.inputs.low_pass_cutoff = apply_filter
+            down_samp.inputs.low_pass_cutoff = [apply_filter]
         else:
             raise ValueError("apply_filter must be a list or int/float")
 
     ###################
     ### OUTPUT NODE ###
     ###################
-    # Collect all final outputs in the output dir and get rid of file name additions
-    datasink = Node(DataSink(), name='datasink')
+    # Collect all final outputs in the output dir and get rid of file name additions; outputs are linked rather than copied where possible
+    datasink = Node(Link_DataSink(), name='datasink')
+    datasink.inputs.link_mode = sink_mode
     if session:
         datasink.inputs.base_directory = os.path.join(output_final_dir, subject_id)
         datasink.inputs.container = 'ses-' + session
@@ -434,110 +374,97 @@ def builder(subject_id, subId, project_dir, data_dir, output_dir, output_final_d
 
     ############################
     ######### PART (1n) #########
-    # anat -> N4 -> bet
+    # anat -> N4 -> bet -> mni
     # OR
-    # anat -> bet
+    # anat -> bet -> mni
+    # OR
+    # shared anat
     ############################
-    if apply_n4:
-        workflow.connect([
-            (n4_correction, brain_extraction_ants, [('output_image', 'anatomical_image')])
-        ])
-    else:
-        brain_extraction_ants.inputs.anatomical_image = anat
+    if not shared_anat:
+        _connect_anatomical(workflow, n4_correction, brain_extraction_ants, normalization, apply_transform_seg)
 
     ##########################################
     ############### PART (2) #################
     # realign -> coreg -> mni (via t1)
-    # t1 -> mni
     # covariate creation
     # plot creation
     ###########################################
 
     workflow.connect([
-        (realign_fsl, plot_realign, [('par_file', 'realignment_parameters')]),
-        (realign_fsl, plot_qa, [('out_file', 'dat_img')]),
-        (realign_fsl, art, [('out_file', 'realigned_files'),
-                            ('par_file', 'realignment_parameters')]),
-        (realign_fsl, mean_epi, [('out_file', 'in_file')]),
+        (realign_fsl, run_stats, [('out_file', 'in_file'),
+                                  ('par_file', 'realignment_parameters')]),
         (realign_fsl, make_cov, [('par_file', 'realignment_parameters')]),
-        (mean_epi, compute_mask, [('out_file', 'mean_volume')]),
-        (compute_mask, art, [('brain_mask', 'mask_file')]),
-        (art, make_cov, [('outlier_files', 'spike_id')]),
-        (art, plot_realign, [('outlier_files', 'outliers')]),
-        (plot_qa, make_cov, [('fd_outliers', 'fd_outliers')]),
-        (brain_extraction_ants, coregistration, [('BrainExtractionBrain', 'fixed_image')]),
-        (mean_epi, coregistration, [('out_file', 'moving_image')]),
-        (brain_extraction_ants, normalization, [('BrainExtractionBrain', 'moving_image')]),
+        (run_stats, make_cov, [('outlier_files', 'spike_id'),
+                               ('fd_outliers', 'fd_outliers')]),
+        (anat_brain[0], coregistration, [(anat_brain[1], 'fixed_image')]),
+        (run_stats, coregistration, [('mean_file', 'moving_image')]),
         (coregistration, merge_transforms, [('composite_transform', 'in2')]),
-        (normalization, merge_transforms, [('composite_transform', 'in1')]),
+        (anat_transform[0], merge_transforms, [(anat_transform[1], 'in1')]),
         (merge_transforms, apply_transforms, [('out', 'transforms')]),
         (realign_fsl, apply_transforms, [('out_file', 'input_image')]),
-        (apply_transforms, mean_norm_epi, [('output_image', 'in_file')]),
-        (normalization, apply_transform_seg, [('composite_transform', 'transforms')]),
-        (brain_extraction_ants, apply_transform_seg, [('BrainExtractionSegmentation', 'input_image')]),
-        (mean_norm_epi, plot_normalization_check, [('out_file', 'wra_img')])
+        (apply_transforms, mean_norm_epi, [('output_image', 'in_file')])
     ])
 
-    ##################################################
-    ################### PART (3) #####################
-    # epi (in mni) -> filter -> smooth -> down sample
-    # OR
-    # epi (in mni) -> filter -> down sample
-    # OR
-    # epi (in mni) -> smooth -> down sample
-    # OR
-    # epi (in mni) -> down sample
-    ###################################################
+    if apply_compcor:
+        workflow.connect([
+            (apply_transforms, compcor, [('output_image', 'in_file')]),
+            (anat_segmentation[0], compcor, [(anat_segmentation[1], 'segmentation')]),
+            (compcor, make_cov, [('components_file', 'compcor')])
+        ])
 
-    if apply_filter:
+    if reports == 'inline':
         workflow.connect([
-            (apply_transforms, lp_filter, [('output_image', 'in_file')])
+            (realign_fsl, plot_realign, [('par_file', 'realignment_parameters')]),
+            (run_stats, plot_realign, [('outlier_files', 'outliers')]),
+            (run_stats, plot_qa, [('metrics', 'metrics')]),
+            (mean_norm_epi, plot_normalization_check, [('out_file', 'wra_img')])
         ])
 
-        if apply_smooth:
-            # Filtering + Smoothing
-            workflow.connect([
-                (lp_filter, smooth, [('out_file', 'in_file')]),
-                (smooth, down_samp, [('smoothed_file', 'in_file')])
-                ])
-        else:
-            # Filtering + No Smoothing
-            workflow.connect([
-                (lp_filter, down_samp, [('out_file', 'in_file')])
-            ])
-    else:
-        if apply_smooth:
-            # No Filtering + Smoothing
-            workflow.connect([
-                (apply_transforms, smooth, [('output_image', 'in_file')]),
-                (smooth, down_samp, [('smoothed_file', 'in_file')])
-                ])
-        else:
-            # No Filtering + No Smoothing
-            workflow.connect([
-                (apply_transforms, down_samp, [('output_image', 'in_file')])
-            ])
+    ##################################################
+    ################### PART (3) #####################
+    # epi (in mni) -> filter + smooth + down sample
+    ###################################################
+
+    workflow.connect([
+        (apply_transforms, down_samp, [('output_image', 'in_file')])
+    ])
 
     ##########################################
     ############### PART (4) #################
     # down sample -> save
     # plots -> save
+    # OR
+    # plot inputs -> save
     # covs -> save
     # t1 (in mni) -> save
     # t1 segmented masks (in mni) -> save
     ##########################################
 
     workflow.connect([
-        (down_samp, datasink, [('out_file', 'functional.@down_samp')]),
-        (plot_realign, datasink, [('plot', 'functional.@plot_realign')]),
-        (plot_qa, datasink, [('plot', 'functional.@plot_qa')]),
-        (plot_normalization_check, datasink, [('plot', 'functional.@plot_normalization')]),
-        (make_cov, datasink, [('covariates', 'functional.@covariates')]),
-        (normalization, datasink, [('warped_image', 'structural.@normanat')]),
-        (apply_transform_seg, datasink, [('output_image', 'structural.@normanatseg')]),
+        (down_samp, datasink, [('out_files', 'functional.@down_samp')]),
+        (make_cov, datasink, [('covariates', 'functional.@covariates'),
+                              ('covariates_npz', 'functional.@covariates_npz')]),
+        (anat_warped[0], datasink, [(anat_warped[1], 'structural.@normanat')]),
+        (anat_segmentation[0], datasink, [(anat_segmentation[1], 'structural.@normanatseg')]),
         (realign_fsl, datasink, [('par_file', 'functional.@motionparams')])
     ])
 
+    if reports == 'inline':
+        workflow.connect([
+            (plot_realign, datasink, [('plot', 'functional.@plot_realign')]),
+            (plot_qa, datasink, [('plot', 'functional.@plot_qa')]),
+            (plot_normalization_check, datasink, [('plot', 'functional.@plot_normalization')])
+        ])
+    else:
+        workflow.connect([
+            (run_stats, datasink, [('outlier_files', 'functional.@art_outliers'),
+                                   ('metrics', 'functional.@qa_metrics'),
+                                   ('mean_img', 'functional.@qa_mean'),
+                                   ('std_img', 'functional.@qa_std'),
+                                   ('tsnr_img', 'functional.@qa_tsnr')]),
+            (mean_norm_epi, datasink, [('out_file', 'functional.@mean_norm_epi')])
+        ])
+
     # if not os.path.exists(os.path.join(output_dir, 'pipeline.png')):
     #     workflow.write_graph(dotfilename=os.path.join(output_dir, 'pipeline'), format='png')
     if session:
@@ -549,3 +476,198 @@ def builder(subject_id, subId, project_dir, data_dir, output_dir, output_final_d
     else:
         print(f"ANTs will utilize the user-requested {ants_threads} threads for parallel processing.")
     return workflow
+
+
+def anat_builder(subject_id, subId, output_interm_dir, anats, mni_template='2mm', apply_n4=True, ants_threads=8):
+    """
+    Build a workflow that processes one anatomical scan per subject, so that its brain extraction and normalization can be shared by the workflows of every session (built with builder(shared_anat=True)) rather than rerun for each. With several anatomical scans an unbiased within-subject template is made from them first (FreeSurfer mri_robust_template).
+
+    Args:
+        subject_id: name of subject folder
+        subId: abbreviate name of subject for intermediate outputted sub-folder name
+        output_interm_dir: intermediate preprocess sub-dir name
+        anats: list of T1w scans; a single scan is processed as is
+        mni_template: which mm resolution template to use; default '2mm'
+        apply_n4: perform N4 Bias Field correction; default True
+        ants_threads: number of threads ANTs should use; default 8
+
+    Returns:
+        workflow: workflow named 'anat' whose outputnode has the fields brain, transform, warped_image and segmentation, which match the fields of builder's anat_inputs node
+
+    """
+
+    from nipype.interfaces.utility import IdentityInterface
+    from nipype.pipeline.engine import Node, Workflow
+
+    MNItemplate = os.path.join(get_resource_path(), 'MNI152_T1_' + mni_template + '_brain.nii.gz')
+
+    if not anats:
+        raise IOError("No T1w anatomical scan found for subject %s" % subject_id)
+    anat = anats[0] if len(anats) == 1 else None
+    anat_gb = max(get_image_gb(a) for a in anats)
+    n4_correction, brain_extraction_ants, normalization, apply_transform_seg = _anatomical_nodes(anat, MNItemplate, apply_n4, ants_threads, anat_gb)
+
+    outputnode = Node(IdentityInterface(fields=['brain', 'transform', 'warped_image', 'segmentation']), name='outputnode')
+
+    workflow = Workflow(name='anat')
+    workflow.base_dir = os.path.join(output_interm_dir, subId)
+
+    if len(anats) > 1:
+        from nipype.interfaces.freesurfer import RobustTemplate
+        anat_template = Node(RobustTemplate(), name='anat_template', n_procs=ants_threads, mem_gb=1 + 10 * anat_gb * len(anats))
+        anat_template.inputs.in_files = anats
+        anat_template.inputs.out_file = 'anat_template.nii.gz'
+        anat_template.inputs.auto_detect_sensitivity = True
+        anat_template.inputs.average_metric = 'median'
+        anat_template.inputs.intensity_scaling = True
+        anat_template.inputs.num_threads = ants_threads
+        if apply_n4:
+            workflow.connect([(anat_template, n4_correction, [('out_file', 'input_image')])])
+        else:
+            workflow.connect([(anat_template, brain_extraction_ants, [('out_file', 'anatomical_image')])])
+
+    _connect_anatomical(workflow, n4_correction, brain_extraction_ants, normalization, apply_transform_seg)
+    workflow.connect([
+        (brain_extraction_ants, outputnode, [('BrainExtractionBrain', 'brain')]),
+        (normalization, outputnode, [('composite_transform', 'transform'),
+                                     ('warped_image', 'warped_image')]),
+        (apply_transform_seg, outputnode, [('output_image', 'segmentation')])
+    ])
+
+    print(f"Creating anatomical workflow for subject: {subject_id} from {len(anats)} scan(s)")
+    return workflow
+
+
+def _anatomical_nodes(anat, MNItemplate, apply_n4, ants_threads, anat_gb):
+    """ N4 bias field correction (None if not apply_n4), brain extraction, normalization and segmentation transform nodes for anat; anat can be None if it's connected later. anat_gb is the size of anat as float32, used to estimate the nodes' memory. """
+
+    from nipype.pipeline.engine import Node
+    from nipype.interfaces.ants.segmentation import BrainExtraction, N4BiasFieldCorrection
+    from nipype.interfaces.ants import Registration, ApplyTransforms
+
+    # Set ANTs files
+    bet_ants_template = os.path.join(get_resource_path(), 'OASIS_template.nii.gz')
+    bet_ants_prob_mask = os.path.join(get_resource_path(), 'OASIS_BrainCerebellumProbabilityMask.nii.gz')
+    bet_ants_registration_mask = os.path.join(get_resource_path(), 'OASIS_BrainCerebellumRegistrationMask.nii.gz')
+
+    # Memory estimates are rough peaks for a 1mm T1w; brain extraction also registers to the 1mm OASIS template and normalization holds SyN warp fields
+
+    ################################
+    ### N4 BIAS FIELD CORRECTION ###
+    ################################
+    if apply_n4:
+        n4_correction = Node(N4BiasFieldCorrection(), name='n4_correction', n_procs=ants_threads, mem_gb=1 + 10 * anat_gb)
+        n4_correction.inputs.copy_header = True
+        n4_correction.inputs.save_bias = False
+        n4_correction.inputs.num_threads = ants_threads
+        if anat is not None:
+            n4_correction.inputs.input_image = anat
+    else:
+        n4_correction = None
+
+    ###################################
+    ### BRAIN EXTRACTION ###
+    ###################################
+    brain_extraction_ants = Node(BrainExtraction(), name='brain_extraction', n_procs=ants_threads, mem_gb=3 + 30 * anat_gb)
+    brain_extraction_ants.inputs.dimension = 3
+    brain_extraction_ants.inputs.use_floatingpoint_precision = 1
+    brain_extraction_ants.inputs.num_threads = ants_threads
+    brain_extraction_ants.inputs.brain_probability_mask = bet_ants_prob_mask
+    brain_extraction_ants.inputs.keep_temporary_files = 1
+    brain_extraction_ants.inputs.brain_template = bet_ants_template
+    brain_extraction_ants.inputs.extraction_registration_mask = bet_ants_registration_mask
+    brain_extraction_ants.inputs.out_prefix = 'bet'
+    if not apply_n4 and anat is not None:
+        brain_extraction_ants.inputs.anatomical_image = anat
+
+    ###################################
+    ### NORMALIZATION ###
+    ###################################
+    # Settings Explanations
+    # Only a few key settings are worth adjusting and most others relate to how ANTs optimizer starts or iterates and won't make a ton of difference
+    # Brian Avants referred to these settings as the last "best tested" when he was aligning fMRI data: https://github.com/ANTsX/ANTsRCore/blob/master/R/antsRegistration.R#L275
+    # Things that matter the most:
+    # smoothing_sigmas:
+    # how much gaussian smoothing to apply when performing registration, probably want the upper limit of this to match the resolution that the data is collected at e.g. 3mm
+    # Old settings [[3,2,1,0]]*3
+    # shrink_factors
+    # The coarseness with which to do registration
+    # Old settings [[8,4,2,1]] * 3
+    # >= 8 may result is some problems causing big chunks of cortex with little fine grain spatial structure to be moved to other parts of cortex
+    # Other settings
+    # transform_parameters:
+    # how much regularization to do for fitting that transformation
+    # for syn this pertains to both the gradient regularization term, and the flow, and elastic terms. Leave the syn settings alone as they seem to be the most well tested across published data sets
+    # radius_or_number_of_bins
+    # This is the bin size for MI metrics and 32 is probably adequate for most use cases. Increasing this might increase precision (e.g. to 64) but takes exponentially longer
+    # use_histogram_matching
+    # Use image intensity distribution to guide registration
+    # Leave it on for within modality registration (e.g. T1 -> MNI), but off for between modality registration (e.g. EPI -> T1)
+    # convergence_threshold
+    # threshold for optimizer
+    # convergence_window_size
+    # how many samples should optimizer average to compute threshold?
+    # sampling_strategy
+    # what strategy should ANTs use to initialize the transform. Regular here refers to approximately random sampling around the center of the image mass
+    normalization = Node(Registration(), name='normalization', n_procs=ants_threads, mem_gb=2 + 20 * anat_gb)
+    normalization.inputs.float = False
+    normalization.inputs.collapse_output_transforms = True
+    normalization.inputs.convergence_threshold = [1e-06, 1e-06, 1e-07]
+    normalization.inputs.convergence_window_size = [10]
+    normalization.inputs.dimension = 3
+    normalization.inputs.fixed_image = MNItemplate
+    normalization.inputs.initial_moving_transform_com = True
+    normalization.inputs.metric = ['MI', 'MI', 'CC']
+    normalization.inputs.metric_weight = [1.0]*3
+    normalization.inputs.number_of_iterations = [[1000, 500, 250, 100],
+                                                 [1000, 500, 250, 100],
+                                                 [100, 70, 50, 20]]
+    normalization.inputs.num_threads = ants_threads
+    normalization.inputs.output_transform_prefix = 'anat2template'
+    normalization.inputs.output_inverse_warped_image = True
+    normalization.inputs.output_warped_image = True
+    normalization.inputs.radius_or_number_of_bins = [32, 32, 4]
+    normalization.inputs.sampling_percentage = [0.25, 0.25, 1]
+    normalization.inputs.sampling_strategy = ['Regular',
+                                              'Regular',
+                                              'None']
+    normalization.inputs.shrink_factors = [[4, 3, 2, 1]]*3
+    normalization.inputs.sigma_units = ['vox']*3
+    normalization.inputs.smoothing_sigmas = [[2, 1], [2, 1], [3, 2, 1, 0]]
+    normalization.inputs.transforms = ['Rigid', 'Affine', 'SyN']
+    normalization.inputs.transform_parameters = [(0.1,),
+                                                 (0.1,),
+                                                 (0.1, 3.0, 0.0)]
+    normalization.inputs.use_histogram_matching = True
+    normalization.inputs.winsorize_lower_quantile = 0.005
+    normalization.inputs.winsorize_upper_quantile = 0.995
+    normalization.inputs.write_composite_transform = True
+
+    ###################################
+    ### APPLY TRANSFORMS ###
+    ###################################
+    # Used for t1 segmented -> mni, via (norm)
+    apply_transform_seg = Node(ApplyTransforms(), name='apply_transform_seg', n_procs=ants_threads, mem_gb=1 + 4 * anat_gb)
+    apply_transform_seg.inputs.input_image_type = 3
+    apply_transform_seg.inputs.float = False
+    apply_transform_seg.inputs.num_threads = ants_threads
+    apply_transform_seg.inputs.environ = {}
+    apply_transform_seg.inputs.interpolation = 'MultiLabel'
+    apply_transform_seg.inputs.invert_transform_flags = [False]
+    apply_transform_seg.inputs.reference_image = MNItemplate
+
+    return n4_correction, brain_extraction_ants, normalization, apply_transform_seg
+
+
+def _connect_anatomical(workflow, n4_correction, brain_extraction_ants, normalization, apply_transform_seg):
+    """ Connect anat -> (N4 ->) bet -> mni and the segmentation -> mni. """
+
+    if n4_correction is not None:
+        workflow.connect([
+            (n4_correction, brain_extraction_ants, [('output_image', 'anatomical_image')])
+        ])
+    workflow.connect([
+        (brain_extraction_ants, normalization, [('BrainExtractionBrain', 'moving_image')]),
+        (normalization, apply_transform_seg, [('composite_transform', 'transforms')]),
+        (brain_extraction_ants, apply_transform_seg, [('BrainExtractionSegmentation', 'input_image')])
+    ])
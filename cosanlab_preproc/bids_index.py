@@ -0,0 +1,189 @@
+from __future__ import division
+
+'''
+Preproc BIDS Index
+==================
+
+A persistent SQLite index of a BIDS dataset that stands in for pybids' BIDSLayout when building workflows. The dataset is walked and its sidecar JSON files parsed once; later wfmaker calls (e.g. one per cluster array task) read the index instead. The index is rebuilt whenever the modification time of any directory in the dataset changes, i.e. whenever files are added, removed or renamed.
+
+Note that editing a sidecar JSON file in place doesn't change its directory's modification time; use rebuild=True after doing so.
+
+'''
+
+__all__ = ['BIDSIndex', 'load_bids_index']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+import os
+import re
+import json
+import sqlite3
+from collections import namedtuple
+
+index_version = 1
+
+
+def _dir_mtimes(data_dir):
+    """ Modification times of every directory in data_dir. """
+
+    mtimes = []
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        mtimes.append((root, os.stat(root).st_mtime_ns))
+    return mtimes
+
+
+def _build_index(data_dir, index_file):
+    """ Walk data_dir with pybids and write its files, entities and image metadata to index_file. """
+
+    from bids.grabbids import BIDSLayout
+
+    mtimes = _dir_mtimes(data_dir)
+    layout = BIDSLayout(data_dir)
+
+    # Write to a temporary file and move it into place so concurrent readers never see a partial index
+    tmp_file = '%s.%d.tmp' % (index_file, os.getpid())
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    con = sqlite3.connect(tmp_file)
+    with con:
+        con.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+        con.execute("CREATE TABLE dirs (path TEXT PRIMARY KEY, mtime INTEGER)")
+        con.execute("CREATE TABLE files (path TEXT PRIMARY KEY, subject TEXT, entities TEXT, metadata TEXT)")
+        con.execute("CREATE INDEX files_subject ON files (subject)")
+        con.executemany("INSERT INTO info VALUES (?, ?)", [('version', str(index_version)),
+                                                           ('data_dir', os.path.abspath(data_dir))])
+        con.executemany("INSERT INTO dirs VALUES (?, ?)", mtimes)
+        rows = []
+        for path, f in layout.files.items():
+            metadata = None
+            if re.search(r'\.nii(\.gz)?$', path):
+                metadata = json.dumps(layout.get_metadata(path))
+            rows.append((path, f.entities.get('subject'), json.dumps(f.entities), metadata))
+        con.executemany("INSERT INTO files VALUES (?, ?, ?, ?)", rows)
+    con.close()
+    os.replace(tmp_file, index_file)
+
+
+def _is_current(index_file, data_dir):
+    """ Whether index_file exists and was built from data_dir as it currently is. """
+
+    if not os.path.exists(index_file):
+        return False
+    try:
+        con = sqlite3.connect('file:%s?mode=ro' % index_file, uri=True)
+        try:
+            info = dict(con.execute("SELECT key, value FROM info"))
+            dirs = con.execute("SELECT path, mtime FROM dirs").fetchall()
+        finally:
+            con.close()
+    except sqlite3.DatabaseError:
+        return False
+    if info.get('version') != str(index_version) or info.get('data_dir') != os.path.abspath(data_dir):
+        return False
+    for path, mtime in dirs:
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+class BIDSIndex(object):
+    """
+    Read-only view of a BIDS index file with the parts of the BIDSLayout interface used by wfmaker, utils.file_getter and builder: get, get_subjects, get_sessions and get_metadata. Use load_bids_index to get one.
+
+    Args:
+        index_file: SQLite index file written by load_bids_index
+
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self._con = sqlite3.connect('file:%s?mode=ro' % index_file, uri=True, check_same_thread=False)
+        self.root = dict(self._con.execute("SELECT key, value FROM info"))['data_dir']
+        self._tuple_types = {}
+
+    def _as_tuple(self, path, entities):
+        keys = tuple(entities.keys())
+        if keys not in self._tuple_types:
+            self._tuple_types[keys] = namedtuple('File', ('filename',) + keys)
+        return self._tuple_types[keys](filename=path, **entities)
+
+    def get(self, return_type='tuple', target=None, extensions=None, **kwargs):
+        """
+        Get files matching entity filters, like BIDSLayout.get.
+
+        Args:
+            return_type: 'tuple' for named tuples with a filename field and one per entity, 'file' for file names, or 'id' for the unique values of target; default 'tuple'
+            target: entity to return values of when return_type is 'id'
+            extensions: file extension or list of extensions to match
+            kwargs: entity filters, e.g. subject='01'; values can be lists
+
+        Returns:
+            list of matching files or ids
+
+        """
+
+        if 'subject' in kwargs and not isinstance(kwargs['subject'], (list, tuple)):
+            rows = self._con.execute("SELECT path, entities FROM files WHERE subject = ? ORDER BY path",
+                                     (str(kwargs['subject']),))
+        else:
+            rows = self._con.execute("SELECT path, entities FROM files ORDER BY path")
+        if isinstance(extensions, str):
+            extensions = [extensions]
+        filters = {k: [str(x) for x in v] if isinstance(v, (list, tuple)) else [str(v)] for k, v in kwargs.items()}
+
+        results = []
+        for path, entities in rows:
+            if extensions and not any(path.endswith(ext if ext.startswith('.') else '.' + ext) for ext in extensions):
+                continue
+            entities = json.loads(entities)
+            if any(str(entities.get(k)) not in v for k, v in filters.items()):
+                continue
+            results.append((path, entities))
+
+        if return_type == 'id':
+            return sorted(set(entities[target] for _, entities in results if target in entities))
+        if return_type == 'file':
+            return [path for path, _ in results]
+        return [self._as_tuple(path, entities) for path, entities in results]
+
+    def get_subjects(self, **kwargs):
+        """ Get sorted unique subject ids. """
+
+        return self.get(return_type='id', target='subject', **kwargs)
+
+    def get_sessions(self, **kwargs):
+        """ Get sorted unique session ids. """
+
+        return self.get(return_type='id', target='session', **kwargs)
+
+    def get_metadata(self, path, **kwargs):
+        """ Get the metadata of an image from its sidecar JSON files, following the BIDS inheritance principle. """
+
+        row = self._con.execute("SELECT metadata FROM files WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        if row is None or row[0] is None:
+            raise ValueError("%s is not an image in the BIDS index" % path)
+        return json.loads(row[0])
+
+
+def load_bids_index(data_dir, index_file, rebuild=False):
+    """
+    Get a BIDSIndex of data_dir stored in index_file, (re)building it with pybids if it doesn't exist or the dataset changed since it was built.
+
+    Args:
+        data_dir: root of the BIDS dataset
+        index_file: SQLite file to store the index in
+        rebuild: rebuild the index even if it's current; default False
+
+    Returns:
+        index: BIDSIndex
+
+    """
+
+    data_dir = os.path.abspath(data_dir)
+    if rebuild or not _is_current(index_file, data_dir):
+        _build_index(data_dir, index_file)
+    return BIDSIndex(index_file)
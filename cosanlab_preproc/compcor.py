@@ -0,0 +1,205 @@
+from __future__ import division
+
+'''
+Preproc CompCor
+===============
+
+Anatomical (aCompCor) and temporal (tCompCor) component based noise correction regressors, computed with a randomized truncated SVD over blocks of voxels
+
+'''
+
+__all__ = ['randomized_components', 'acompcor', 'tcompcor', 'compute_compcor']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+import numpy as np
+
+
+def _standardize(series, block_size):
+    """ Remove a linear trend from each voxel of a (time, voxels) float32 array and scale it to unit variance, in place and a block of voxels at a time. """
+
+    n_vols = series.shape[0]
+    design = np.column_stack([np.ones(n_vols), np.linspace(-1, 1, n_vols)]).astype(np.float32)
+    pinv = np.linalg.pinv(design).astype(np.float32)
+    for start in range(0, series.shape[1], block_size):
+        block = series[:, start:start + block_size]
+        block -= design.dot(pinv.dot(block))
+        sd = block.std(axis=0)
+        sd[sd == 0] = 1
+        block /= sd
+    return series
+
+
+def randomized_components(series, n_components, n_oversamples=10, n_iter=4, block_size=4096, random_state=0):
+    """
+    Get the top temporal components of a (time, voxels) array with a randomized truncated SVD (Halko et al. 2011). The array is only ever multiplied a block of voxels at a time, so nothing larger than a block is created beyond the (time, n_components + n_oversamples) sketch, and everything stays in float32.
+
+    Args:
+        series: float32 array of shape (time, voxels)
+        n_components: number of components
+        n_oversamples: extra random vectors used to improve accuracy; default 10
+        n_iter: number of power iterations; default 4
+        block_size: number of voxels multiplied at a time; default 4096
+        random_state: seed of the random projection; default 0
+
+    Returns:
+        components: array of shape (time, n_components), the left singular vectors
+        variance_explained: fraction of the total variance explained by each component
+
+    """
+
+    n_vols, n_vox = series.shape
+    n_components = min(n_components, n_vols, n_vox)
+    n_random = min(n_components + n_oversamples, n_vols, n_vox)
+    rng = np.random.RandomState(random_state)
+    blocks = [slice(start, start + block_size) for start in range(0, n_vox, block_size)]
+
+    # Sketch the range of the series with a random projection
+    sketch = np.zeros((n_vols, n_random), dtype=np.float32)
+    for block in blocks:
+        data = series[:, block]
+        sketch += data.dot(rng.standard_normal((data.shape[1], n_random)).astype(np.float32))
+    basis, _ = np.linalg.qr(sketch)
+
+    # Power iterations sharpen the spectrum: basis <- orth(X X' basis)
+    for _ in range(n_iter):
+        sketch = np.zeros((n_vols, n_random), dtype=np.float32)
+        for block in blocks:
+            data = series[:, block]
+            sketch += data.dot(data.T.dot(basis))
+        basis, _ = np.linalg.qr(sketch)
+
+    # SVD of the small projected matrix B = basis' X through B B'
+    gram = np.zeros((n_random, n_random), dtype=np.float64)
+    total = 0.
+    for block in blocks:
+        projected = basis.T.dot(series[:, block])
+        gram += projected.dot(projected.T)
+        total += float(np.sum(series[:, block].astype(np.float64)**2))
+    evals, evecs = np.linalg.eigh(gram)
+    order = np.argsort(evals)[::-1][:n_components]
+    components = basis.dot(evecs[:, order].astype(np.float32))
+    variance_explained = np.clip(evals[order], 0, None) / total if total > 0 else np.zeros(n_components)
+    return components, variance_explained
+
+
+def acompcor(in_file, segmentation, labels=(1, 3), n_components=5, erode=0, chunk_size=1, block_size=4096):
+    """
+    Anatomical CompCor: components of the time series of noise tissue voxels (by default CSF and white matter of an ANTs/Atropos segmentation), after removing a linear trend and scaling each voxel to unit variance.
+
+    Args:
+        in_file: 4D nifti file
+        segmentation: label image in the same space as in_file
+        labels: labels of noise tissues; default (1, 3), i.e. CSF and white matter for ANTs
+        n_components: number of components; default 5
+        erode: number of binary erosions applied to the noise mask to limit partial voluming with grey matter; default 0
+        chunk_size: number of volumes read at a time; default 1
+        block_size: number of voxels processed at a time; default 4096
+
+    Returns:
+        components: array of shape (time, n_components)
+        variance_explained: fraction of the variance of the noise voxels explained by each component
+
+    """
+
+    import nibabel as nib
+    from scipy.ndimage import binary_erosion
+    from .filters import load_masked_series
+
+    seg = np.asarray(nib.load(segmentation).dataobj)
+    mask_idx = np.isin(np.round(seg), labels)
+    if erode:
+        mask_idx = binary_erosion(mask_idx, iterations=erode)
+    if mask_idx.shape != nib.load(in_file).shape[:3]:
+        raise ValueError("segmentation doesn't match the shape of in_file")
+    series = _standardize(load_masked_series(in_file, mask_idx, chunk_size), block_size)
+    return randomized_components(series, n_components, block_size=block_size)
+
+
+def tcompcor(in_file, mask, n_components=5, fraction=.02, chunk_size=1, block_size=4096):
+    """
+    Temporal CompCor: components of the time series of the voxels with the highest temporal standard deviation (after removing a linear trend) within a mask. Voxel variances are computed in a streaming pass over the run, then only the selected voxels are read into memory.
+
+    Args:
+        in_file: 4D nifti file
+        mask: boolean 3D array of voxels to consider, e.g. the brain
+        n_components: number of components; default 5
+        fraction: fraction of the mask's voxels with the highest variance to use; default .02
+        chunk_size: number of volumes read at a time; default 1
+        block_size: number of voxels processed at a time; default 4096
+
+    Returns:
+        components: array of shape (time, n_components)
+        variance_explained: fraction of the variance of the selected voxels explained by each component
+
+    """
+
+    import nibabel as nib
+    from .nifti import iter_volumes
+    from .filters import load_masked_series
+
+    n_vols = nib.load(in_file).shape[3]
+    time = np.arange(n_vols) - (n_vols - 1) / 2.
+    n_vox = int(mask.sum())
+    mean = np.zeros(n_vox)
+    m2 = np.zeros(n_vox)
+    cross = np.zeros(n_vox)
+    for start, block in iter_volumes(in_file, chunk_size):
+        for i in range(block.shape[-1]):
+            t = start + i
+            vol = block[..., i][mask]
+            delta = vol - mean
+            mean += delta / (t + 1)
+            m2 += delta * (vol - mean)
+            cross += time[t] * vol
+    # Residual sum of squares after removing a linear trend
+    residual = m2 - cross**2 / np.sum(time**2)
+
+    n_select = max(int(np.round(fraction * n_vox)), 1)
+    selected = np.zeros(n_vox, dtype=bool)
+    selected[np.argsort(residual)[::-1][:n_select]] = True
+    mask_idx = np.zeros(mask.shape, dtype=bool)
+    mask_idx[mask] = selected
+    series = _standardize(load_masked_series(in_file, mask_idx, chunk_size), block_size)
+    return randomized_components(series, n_components, block_size=block_size)
+
+
+def compute_compcor(in_file, segmentation, components_type=('acompcor',), n_components=5, labels=(1, 3), erode=0, fraction=.02, chunk_size=1):
+    """
+    Compute aCompCor and/or tCompCor regressors for a run.
+
+    Args:
+        in_file: 4D nifti file
+        segmentation: label image in the same space as in_file; noise tissue labels are used for aCompCor and all non-zero voxels (the brain) for tCompCor
+        components_type: which of 'acompcor' and 'tcompcor' to compute; default ('acompcor',)
+        n_components: number of components of each type; default 5
+        labels: noise tissue labels for aCompCor; default (1, 3), i.e. CSF and white matter for ANTs
+        erode: number of erosions of the aCompCor noise mask; default 0
+        fraction: fraction of brain voxels with the highest variance used for tCompCor; default .02
+        chunk_size: number of volumes read at a time; default 1
+
+    Returns:
+        regressors: DataFrame with columns acompcor1..n and/or tcompcor1..n
+        variance_explained: dict of the variance explained by each column
+
+    """
+
+    import pandas as pd
+    import nibabel as nib
+
+    regressors = []
+    variance_explained = {}
+    for name in components_type:
+        if name == 'acompcor':
+            components, var = acompcor(in_file, segmentation, labels=labels, n_components=n_components,
+                                       erode=erode, chunk_size=chunk_size)
+        elif name == 'tcompcor':
+            mask = np.asarray(nib.load(segmentation).dataobj) > 0
+            components, var = tcompcor(in_file, mask, n_components=n_components, fraction=fraction,
+                                       chunk_size=chunk_size)
+        else:
+            raise ValueError("components_type must be 'acompcor' and/or 'tcompcor'")
+        columns = [name + str(i + 1) for i in range(components.shape[1])]
+        regressors.append(pd.DataFrame(components, columns=columns))
+        variance_explained.update(zip(columns, [float(v) for v in var]))
+    return pd.concat(regressors, axis=1), variance_explained
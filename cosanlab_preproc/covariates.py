@@ -0,0 +1,201 @@
+from __future__ import division
+
+'''
+Preproc Covariates
+==================
+
+Functions to build nuisance covariates (motion parameters and spike regressors) for first level models
+
+'''
+
+__all__ = ['read_indices', 'motion_regressors', 'merge_spikes', 'spike_regressors', 'save_spike_index', 'load_spike_index',
+           'save_covariates', 'load_covariates']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+import json
+import numpy as np
+import pandas as pd
+
+
+def read_indices(file_name):
+    """ Read a text file of volume indices, e.g. ART outliers or FD outliers, as an int array. Empty files give an empty array. """
+
+    with open(file_name) as f:
+        values = f.read().split()
+    return np.array([int(float(v)) for v in values], dtype=int)
+
+
+def motion_regressors(realignment_parameters):
+    """
+    Build the 24 motion regressors: mean centered realignment parameters, their squares, their derivatives and their squared derivatives.
+
+    Args:
+        realignment_parameters: realignment parameter file with one row per volume and 6 columns
+
+    Returns:
+        regressors: DataFrame with columns ra1-6, rasq1-6, radiff1-6 and radiffsq1-6
+
+    """
+
+    ra = np.loadtxt(realignment_parameters, ndmin=2)
+    ra = ra - ra.mean(axis=0)  # mean center
+    diff = np.full_like(ra, np.nan)
+    diff[1:] = np.diff(ra, axis=0)  # derivative
+    columns = [prefix + str(x) for prefix in ['ra', 'rasq', 'radiff', 'radiffsq'] for x in range(1, 7)]
+    return pd.DataFrame(np.hstack([ra, ra**2, diff, diff**2]), columns=columns)
+
+
+def merge_spikes(spikes, fds):
+    """
+    Merge spike and FD outlier indices so each volume only gets one regressor. Volumes that are both a spike and an FD outlier are kept as spikes.
+
+    Args:
+        spikes: spike volume indices
+        fds: FD outlier volume indices
+
+    Returns:
+        columns: list of regressor names, spike1..n followed by FD1..m
+        index: array of the volume index of each regressor
+
+    """
+
+    spikes = np.asarray(spikes, dtype=int)
+    fds = np.asarray(fds, dtype=int)
+    fds = fds[~np.isin(fds, spikes)]
+    columns = ['spike' + str(i + 1) for i in range(len(spikes))] + ['FD' + str(i + 1) for i in range(len(fds))]
+    return columns, np.concatenate([spikes, fds])
+
+
+def spike_regressors(n_vols, columns, index, sparse=False):
+    """
+    Build one-hot spike regressors as a single array.
+
+    Args:
+        n_vols: number of volumes
+        columns: regressor names from merge_spikes
+        index: volume index of each regressor from merge_spikes
+        sparse: return a scipy.sparse CSC matrix instead of a DataFrame; default False
+
+    Returns:
+        regressors: DataFrame (or sparse matrix) of shape (n_vols, len(columns))
+
+    """
+
+    if sparse:
+        from scipy.sparse import csc_matrix
+        return csc_matrix((np.ones(len(index)), (index, np.arange(len(index)))), shape=(n_vols, len(index)))
+    dense = np.zeros((n_vols, len(index)), dtype=int)
+    dense[index, np.arange(len(index))] = 1
+    return pd.DataFrame(dense, columns=columns)
+
+
+def save_spike_index(file_name, n_vols, columns, index):
+    """ Save spike regressors in column-indexed form: the name and volume index of each regressor. """
+
+    with open(file_name, 'w') as f:
+        json.dump({'n_volumes': int(n_vols), 'columns': list(columns), 'index': [int(i) for i in index]}, f, indent=4)
+    return file_name
+
+
+def load_spike_index(file_name, sparse=True):
+    """
+    Load spike regressors saved in column-indexed form by Create_Covariates(spike_format='index').
+
+    Args:
+        file_name: spike index json file
+        sparse: return a scipy.sparse CSC matrix; if False a dense DataFrame; default True
+
+    Returns:
+        regressors: sparse matrix or DataFrame of shape (n_volumes, n_spikes)
+
+    """
+
+    with open(file_name) as f:
+        spikes = json.load(f)
+    return spike_regressors(spikes['n_volumes'], spikes['columns'], np.array(spikes['index'], dtype=int), sparse=sparse)
+
+
+def save_covariates(file_name, regressors, spike_columns, spike_index):
+    """
+    Save covariates as an uncompressed .npz so they can be loaded without parsing text, and memory-mapped with load_covariates. Regressors are stored as a single float32 array; spike regressors are stored as index lists rather than one-hot columns.
+
+    Args:
+        file_name: output .npz file name
+        regressors: DataFrame of motion (and CompCor) regressors
+        spike_columns: spike regressor names from merge_spikes
+        spike_index: volume index of each spike regressor from merge_spikes
+
+    Returns:
+        file_name: output file name
+
+    """
+
+    np.savez(file_name,
+             data=np.asarray(regressors.values, dtype=np.float32),
+             columns=np.array(regressors.columns, dtype=str),
+             spike_columns=np.array(spike_columns, dtype=str),
+             spike_index=np.asarray(spike_index, dtype=np.int64))
+    return file_name
+
+
+def _mmap_npz_member(file_name, member):
+    """ Memory-map an array stored (uncompressed) in an .npz file. """
+
+    import zipfile
+    import struct
+    from numpy.lib import format as npformat
+
+    with zipfile.ZipFile(file_name) as zf:
+        info = zf.getinfo(member + '.npy')
+        if info.compress_type != zipfile.ZIP_STORED:
+            return None
+    with open(file_name, 'rb') as f:
+        # Skip the zip local file header to get to the .npy data
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = npformat.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = npformat.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = npformat.read_array_header_2_0(f)
+        offset = f.tell()
+    if dtype.hasobject:
+        return None
+    return np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def load_covariates(file_name, mmap=True, as_frame=False):
+    """
+    Load covariates saved by Create_Covariates as .npz.
+
+    Args:
+        file_name: covariates .npz file
+        mmap: memory-map the regressors rather than reading them into memory; default True
+        as_frame: return a single DataFrame with dense spike columns, with the same columns as covariates.csv; regressors keep the float32 precision they're stored in, so they match the csv's float64 values to about 7 significant digits; default False
+
+    Returns:
+        data: float32 array of shape (n_volumes, n_regressors)
+        columns: list of regressor names
+        spikes: scipy.sparse CSC matrix of spike regressors with spike_columns as their names
+        spike_columns: list of spike regressor names
+
+        or a DataFrame if as_frame is True
+
+    """
+
+    with np.load(file_name) as npz:
+        columns = [str(c) for c in npz['columns']]
+        spike_columns = [str(c) for c in npz['spike_columns']]
+        spike_index = npz['spike_index']
+        data = _mmap_npz_member(file_name, 'data') if mmap else None
+        if data is None:
+            data = npz['data']
+    spikes = spike_regressors(data.shape[0], spike_columns, spike_index, sparse=True)
+    if as_frame:
+        return pd.concat([pd.DataFrame(np.asarray(data), columns=columns),
+                          spike_regressors(data.shape[0], spike_columns, spike_index)], axis=1)
+    return data, columns, spikes, spike_columns
@@ -0,0 +1,364 @@
+from __future__ import division
+
+'''
+Preproc Filters
+===============
+
+Native temporal filtering and spatial smoothing of fMRI data, used by Filter_In_Mask and to run the final filter -> smooth -> down sample stage of a workflow in one node
+
+'''
+
+__all__ = ['fwhm_to_sigma', 'smooth_volume', 'smooth_in_mask', 'smooth_volumes', 'butterworth_filter', 'load_mask', 'load_masked_series', 'masked_volume_sources', 'write_final_stage']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+import numpy as np
+from .utils import get_n_threads
+
+
+def fwhm_to_sigma(fwhm, zooms):
+    """
+    Convert a Gaussian kernel FWHM in mm to a standard deviation in voxels along each axis.
+
+    Args:
+        fwhm: kernel full width at half maximum in mm
+        zooms: voxel sizes in mm
+
+    Returns:
+        sigma: list of kernel standard deviations in voxels, one per axis
+
+    """
+
+    sigma_mm = fwhm / np.sqrt(8 * np.log(2))
+    return [sigma_mm / z for z in zooms[:3]]
+
+
+def smooth_volume(vol, sigma, out=None):
+    """
+    Smooth a 3D volume with a Gaussian kernel like fslmaths -kernel gauss -fmean, i.e. treating everything outside the field of view as 0.
+
+    Args:
+        vol: 3D array
+        sigma: kernel standard deviation in voxels along each axis, e.g. from fwhm_to_sigma
+        out: optional array to write the result into
+
+    Returns:
+        out: smoothed volume
+
+    """
+
+    from scipy.ndimage import gaussian_filter
+    return gaussian_filter(vol, sigma, output=out, mode='constant', cval=0.)
+
+
+def smooth_in_mask(vol, sigma, mask, mask_weights=None):
+    """
+    Smooth a 3D volume within a mask, like AFNI's 3dBlurInMask. Voxels outside the mask don't contribute and the result is normalized by the smoothed mask, so voxels near the edge of the mask aren't pulled towards 0. Voxels outside the mask are set to 0.
+
+    Args:
+        vol: 3D array
+        sigma: kernel standard deviation in voxels along each axis, e.g. from fwhm_to_sigma
+        mask: boolean 3D array
+        mask_weights: the smoothed mask, i.e. smooth_volume(mask, sigma); computed if not provided
+
+    Returns:
+        out: smoothed float32 volume
+
+    """
+
+    if mask_weights is None:
+        mask_weights = smooth_volume(mask.astype(np.float32), sigma)
+    smoothed = smooth_volume(np.where(mask, vol, 0).astype(np.float32, copy=False), sigma)
+    out = np.zeros(vol.shape, dtype=np.float32)
+    np.divide(smoothed, mask_weights, out=out, where=mask)
+    return out
+
+
+def smooth_volumes(volumes, sigmas, mask=None, n_threads=None):
+    """
+    Smooth a stream of volumes with one or more Gaussian kernels on a thread pool. scipy's separable Gaussian filters release the GIL so volumes are smoothed in parallel, while only a few volumes per thread are held at a time.
+
+    Args:
+        volumes: iterator of (index, 3D volume)
+        sigmas: list of kernel standard deviations in voxels from fwhm_to_sigma; None leaves the volume as-is
+        mask: boolean 3D array to smooth within (see smooth_in_mask); default None smooths the whole field of view
+        n_threads: number of threads; default the enclosing limit_threads context's limit (a node's n_procs), otherwise the number of cpus
+
+    Yields:
+        index: index of the volume
+        outs: list of smoothed volumes, one per sigma
+
+    """
+
+    from itertools import islice
+    from concurrent.futures import ThreadPoolExecutor
+
+    weights = [None if sigma is None or mask is None else smooth_volume(mask.astype(np.float32), sigma) for sigma in sigmas]
+
+    def smooth(vol):
+        outs = []
+        for sigma, mask_weights in zip(sigmas, weights):
+            if sigma is None:
+                outs.append(vol)
+            elif mask is None:
+                outs.append(smooth_volume(vol, sigma))
+            else:
+                outs.append(smooth_in_mask(vol, sigma, mask, mask_weights))
+        return outs
+
+    n_threads = get_n_threads(n_threads)
+    volumes = iter(volumes)
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        while True:
+            batch = list(islice(volumes, 2 * n_threads))
+            if not batch:
+                return
+            for (t, _), outs in zip(batch, pool.map(smooth, [vol for _, vol in batch])):
+                yield t, outs
+
+
+def butterworth_filter(data, sampling_rate, low_pass=None, high_pass=None, order=5, n_threads=None, block_size=4096):
+    """
+    Zero-phase Butterworth filter time series in place, with the same design as nilearn's (and therefore nltools') butterworth filter: an order 5 low, high or band-pass filter applied forwards and backwards as second-order sections. Voxels are filtered in blocks on a thread pool; scipy releases the GIL while filtering so blocks run in parallel, and only one block at a time per thread is upcast to float64.
+
+    Args:
+        data: float32 array of shape (time, voxels); filtered in place
+        sampling_rate: TR in seconds
+        low_pass: frequencies above this will be filtered; 0 or None to disable
+        high_pass: frequencies below this will be filtered; 0 or None to disable
+        order: filter order; default 5
+        n_threads: number of threads; default the enclosing limit_threads context's limit (a node's n_procs), otherwise the number of cpus
+        block_size: number of voxels filtered at a time per thread; default 4096
+
+    Returns:
+        data: filtered time series
+
+    """
+
+    import warnings
+    from concurrent.futures import ThreadPoolExecutor
+    from scipy.signal import butter, sosfiltfilt
+
+    if not low_pass and not high_pass:
+        return data
+    if low_pass and high_pass and high_pass >= low_pass:
+        raise ValueError("high_pass cutoff must be lower than low_pass cutoff")
+
+    fs = 1. / sampling_rate
+    nyq = fs / 2.
+    cutoffs = []
+    for cutoff in [high_pass, low_pass]:
+        if not cutoff:
+            continue
+        if cutoff >= nyq:
+            # Like nilearn, lower cutoffs at or above Nyquist to just below it
+            new_cutoff = nyq - nyq * 10 * np.finfo(np.float32).eps
+            warnings.warn("Cutoff %s Hz is above the Nyquist frequency (%s Hz); using %s Hz" % (cutoff, nyq, new_cutoff))
+            cutoff = new_cutoff
+        cutoffs.append(cutoff)
+    if len(cutoffs) == 2:
+        btype = 'band'
+    else:
+        btype = 'high' if high_pass else 'low'
+        cutoffs = cutoffs[0]
+    sos = butter(order, cutoffs, btype=btype, output='sos', fs=fs)
+
+    def filter_block(start):
+        stop = min(start + block_size, data.shape[1])
+        data[:, start:stop] = sosfiltfilt(sos, data[:, start:stop], axis=0)
+
+    n_threads = get_n_threads(n_threads)
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        list(pool.map(filter_block, range(0, data.shape[1], block_size)))
+    return data
+
+
+def load_masked_series(in_file, mask_idx, chunk_size=1):
+    """
+    Read the in-mask time series of a run into a float32 (time, voxels) array, a block of volumes at a time.
+
+    Args:
+        in_file: 4D nifti file
+        mask_idx: boolean 3D array
+        chunk_size: number of volumes read at a time; default 1
+
+    Returns:
+        series: array of shape (time, voxels)
+
+    """
+
+    import nibabel as nib
+    from .nifti import iter_volumes
+
+    img = nib.load(in_file)
+    n_vols = img.shape[3] if len(img.shape) > 3 else 1
+    series = np.empty((n_vols, int(mask_idx.sum())), dtype=np.float32)
+    for start, block in iter_volumes(in_file, chunk_size):
+        series[start:start + block.shape[-1]] = block[mask_idx].T
+    return series
+
+
+def load_mask(mask, shape):
+    """ Load a mask image as a boolean array, checking it matches a data shape. """
+
+    import nibabel as nib
+    mask_idx = np.asarray(nib.load(mask).dataobj) > 0
+    if mask_idx.shape != tuple(shape):
+        raise ValueError("mask shape %s doesn't match data shape %s" % (mask_idx.shape, tuple(shape)))
+    return mask_idx
+
+
+def masked_volume_sources(in_file, mask=None, sampling_rate=None, low_pass_cutoffs=(None,), high_pass=None, chunk_size=1, n_threads=None):
+    """
+    Get the volumes of a run after optional masking and temporal filtering, for each of several low-pass cutoffs.
+
+    Filtering needs every time point of a voxel, so when a mask is given or any filtering is requested the in-mask time series are read once and held in memory; only in-mask voxels are held, which is a fraction of the full 4D image. Each cutoff then filters its own copy of them, one cutoff at a time. Otherwise volumes are streamed straight from in_file. Each volume is filled in on the fly so the full 4D result is never held in memory. A masked or filtered source can be iterated more than once without re-reading or re-filtering, but an unmasked, unfiltered source reads in_file again each time.
+
+    Args:
+        in_file: 4D nifti file
+        mask: mask image in the same space as in_file; voxels outside it are set to 0
+        sampling_rate: TR in seconds; required for filtering
+        low_pass_cutoffs: low-pass cutoffs to produce; 0 or None means no low-pass filtering; default (None,)
+        high_pass: frequencies below this will be filtered for every cutoff; default None
+        chunk_size: number of volumes read at a time; default 1
+        n_threads: number of threads used for filtering; default as butterworth_filter
+
+    Yields:
+        low_pass: the low-pass cutoff
+        volumes: callable returning a fresh iterator of (index, 3D float32 volume)
+
+    """
+
+    import nibabel as nib
+    from .nifti import iter_volumes
+
+    shape = nib.load(in_file).shape[:3]
+    if mask is None and not high_pass and not any(low_pass_cutoffs):
+        def volumes():
+            for start, block in iter_volumes(in_file, chunk_size):
+                for i in range(block.shape[-1]):
+                    yield start + i, block[..., i]
+        for low_pass in low_pass_cutoffs:
+            yield low_pass, volumes
+        return
+
+    mask_idx = load_mask(mask, shape) if mask is not None else np.ones(shape, dtype=bool)
+    raw = load_masked_series(in_file, mask_idx, chunk_size)
+    for low_pass in low_pass_cutoffs:
+        if low_pass or high_pass:
+            series = butterworth_filter(raw.copy(), sampling_rate, low_pass=low_pass, high_pass=high_pass, n_threads=n_threads)
+        else:
+            series = raw
+
+        def volumes(series=series):
+            for t in range(series.shape[0]):
+                vol = np.zeros(shape, dtype=np.float32)
+                vol[mask_idx] = series[t]
+                yield t, vol
+        yield low_pass, volumes
+        del series
+
+
+def write_final_stage(in_file, out_files, mask=None, sampling_rate=None, high_pass=None, smooth_mask=None, data_type='int16', scale=True, chunk_size=1, n_threads=None, spool_file='spool.dat'):
+    """
+    Mask, filter, smooth and reduce the precision of a run for every combination of low-pass cutoff and smoothing kernel in out_files. The run is read once, each cutoff is filtered once and shared by all of its kernels, and each volume is smoothed with all kernels of its cutoff once.
+
+    Integer outputs with scale factors need the range of the data before they can be written, so the smoothed volumes of a cutoff are spooled to an uncompressed float32 memory-mapped file while the range is tracked, and the outputs are written from it. Only voxels that can be non-zero are spooled: those in smooth_mask for smoothed outputs, or in mask for unsmoothed ones, so with the usual brain masks the spool is a fraction of a full-size copy of the run per kernel. The spool file is removed before returning.
+
+    Args:
+        in_file: 4D nifti file
+        out_files: dict mapping (low_pass, fwhm) to output file name; 0 or None for either means that step is skipped
+        mask: mask to apply to data before filtering/smoothing
+        sampling_rate: TR in seconds; required for filtering
+        high_pass: frequencies below this will be filtered; default None
+        smooth_mask: mask to smooth within (see smooth_in_mask); default None smooths the whole field of view
+        data_type: output data type; default 'int16'
+        scale: compute optimal scale factors for integer data types; if False values are simply truncated to integers; default True
+        chunk_size: number of volumes read at a time; default 1
+        n_threads: number of threads used for filtering, smoothing and compressing the outputs; default as butterworth_filter
+        spool_file: path of the temporary spool file; default 'spool.dat'
+
+    Returns:
+        out_files: the output file names
+
+    """
+
+    import os
+    import nibabel as nib
+    from collections import OrderedDict
+    from contextlib import ExitStack
+    from .nifti import get_scaling, NiftiVolumeWriter
+
+    if (high_pass or any(k[0] for k in out_files)) and not sampling_rate:
+        raise ValueError("sampling_rate is required for filtering")
+
+    img = nib.load(in_file)
+    zooms = img.header.get_zooms()
+    n_vols = img.shape[3] if len(img.shape) > 3 else 1
+    smooth_mask_idx = load_mask(smooth_mask, img.shape[:3]) if smooth_mask is not None else None
+    mask_idx = load_mask(mask, img.shape[:3]) if mask is not None else None
+    grid = OrderedDict()
+    for low_pass, fwhm in out_files:
+        grid.setdefault(low_pass, []).append(fwhm)
+
+    sources = masked_volume_sources(in_file, mask=mask, sampling_rate=sampling_rate, low_pass_cutoffs=list(grid),
+                                    high_pass=high_pass, chunk_size=chunk_size, n_threads=n_threads)
+    for low_pass, volumes in sources:
+        fwhms = grid[low_pass]
+        sigmas = [fwhm_to_sigma(fwhm, zooms) if fwhm else None for fwhm in fwhms]
+
+        headers = []
+        for _ in fwhms:
+            hdr = img.header.copy()
+            hdr.set_data_dtype(data_type)
+            hdr.set_slope_inter(None, None)
+            headers.append(hdr)
+        if not np.issubdtype(np.dtype(data_type), np.integer) or not scale:
+            if np.issubdtype(np.dtype(data_type), np.integer):
+                for hdr in headers:
+                    hdr.set_slope_inter(1, 0)
+            with ExitStack() as stack:
+                writers = [stack.enter_context(NiftiVolumeWriter(out_files[(low_pass, fwhm)], hdr, n_threads=n_threads))
+                           for fwhm, hdr in zip(fwhms, headers)]
+                truncate = np.issubdtype(np.dtype(data_type), np.integer)
+                for _, outs in smooth_volumes(volumes(), sigmas, smooth_mask_idx, n_threads):
+                    for writer, out in zip(writers, outs):
+                        if truncate:
+                            out = np.trunc(out)
+                        writer.write(out[..., np.newaxis])
+            continue
+
+        # Scale factors need the range of the processed data before anything is written, so each volume is smoothed
+        # once into the spool while the range is tracked and the outputs are written from the spool. Everything
+        # outside a kernel's support is 0, so only the support is spooled
+        supports = [(smooth_mask_idx if fwhm else mask_idx) for fwhm in fwhms]
+        sizes = [int(idx.sum()) if idx is not None else int(np.prod(img.shape[:3])) for idx in supports]
+        offsets = np.cumsum([0] + sizes)
+        spool = np.memmap(spool_file, dtype=np.float32, mode='w+', shape=(n_vols, max(offsets[-1], 1)))
+        try:
+            data_min = np.array([0. if idx is not None else np.inf for idx in supports])
+            data_max = np.array([0. if idx is not None else -np.inf for idx in supports])
+            for t, outs in smooth_volumes(volumes(), sigmas, smooth_mask_idx, n_threads):
+                for i, (out, idx) in enumerate(zip(outs, supports)):
+                    values = out[idx] if idx is not None else out.ravel()
+                    spool[t, offsets[i]:offsets[i + 1]] = values
+                    if values.size:
+                        data_min[i] = min(data_min[i], np.nanmin(values))
+                        data_max[i] = max(data_max[i], np.nanmax(values))
+            for hdr, mn, mx in zip(headers, data_min, data_max):
+                hdr.set_slope_inter(*get_scaling(mn, mx, data_type))
+            with ExitStack() as stack:
+                writers = [stack.enter_context(NiftiVolumeWriter(out_files[(low_pass, fwhm)], hdr, n_threads=n_threads))
+                           for fwhm, hdr in zip(fwhms, headers)]
+                for t in range(n_vols):
+                    for i, (writer, idx) in enumerate(zip(writers, supports)):
+                        if idx is None:
+                            vol = np.asarray(spool[t, offsets[i]:offsets[i + 1]]).reshape(img.shape[:3])
+                        else:
+                            vol = np.zeros(img.shape[:3], dtype=np.float32)
+                            vol[idx] = spool[t, offsets[i]:offsets[i + 1]]
+                        writer.write(vol[..., np.newaxis])
+        finally:
+            del spool
+            os.remove(spool_file)
+    return out_files
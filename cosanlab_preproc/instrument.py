@@ -0,0 +1,256 @@
+from __future__ import division
+
+'''
+Preproc Instrumentation
+=======================
+
+Record how long cosanlab_preproc's interfaces spend loading, computing, rendering and writing, how many bytes they read and write and how much memory they peak at. Preproc_Interface records every run, adds the measurements to nipype's runtime object and appends them to a JSON-lines log (instrumentation.jsonl) in nipype's log directory, which wfmaker sets to the project's logs/nipype folder.
+
+Library code marks phases with phase(); time outside any marked phase counts as compute. Phases nest: time spent in an inner phase only counts towards the inner phase.
+
+'''
+
+__all__ = ['Recorder', 'phase', 'get_log_file', 'append_record', 'interface_record', 'read_log']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+log_file_name = 'instrumentation.jsonl'
+
+# tracemalloc slows down allocation-heavy code a lot, so it's off unless asked for, e.g. for MultiProc workers through the environment
+trace_memory_default = os.environ.get('COSANLAB_PREPROC_TRACE_MEMORY', '').lower() in ['1', 'true', 'yes']
+
+# Recorder of the interface currently running in this process, if any
+_active = None
+
+
+def _io_counters():
+    """ Bytes passed to read and write system calls by this process so far (Linux only), or None. """
+
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def _reset_peak_rss():
+    """ Reset the process's peak resident set size (Linux >= 4.0); returns whether it could be reset. """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss_mb(was_reset):
+    """ Peak resident set size in MB since it was reset, or over the lifetime of the process if it couldn't be. """
+
+    if was_reset:
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024.
+        except (IOError, OSError, ValueError):
+            pass
+    try:
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kB elsewhere
+        return peak / 1024.**2 if sys.platform == 'darwin' else peak / 1024.
+    except ImportError:
+        return None
+
+
+class Recorder(object):
+    """
+    Record phase timings, bytes read and written, and peak memory of a block of code. Only phases entered on the thread that started the recorder are counted; phases entered on other threads (e.g. in a thread pool) count towards the phase the recording thread is in.
+
+    Args:
+        trace_memory: also record the peak of memory allocated through python (including numpy arrays) with tracemalloc, which slows down code that allocates a lot; the peak resident set size is always recorded; default False, or True if the COSANLAB_PREPROC_TRACE_MEMORY environment variable is set to 1
+
+    Examples:
+
+        >>> recorder = Recorder()
+        >>> with recorder:
+        >>>     with phase('load'):
+        >>>         data = load()
+        >>>     result = compute(data)
+        >>> recorder.summary()
+
+    """
+
+    def __init__(self, trace_memory=None):
+        self.trace_memory = trace_memory_default if trace_memory is None else trace_memory
+        self.phases = OrderedDict()
+        self._stack = []
+
+    def __enter__(self):
+        global _active
+        import tracemalloc
+
+        self._thread = threading.get_ident()
+        self._previous = _active
+        self._rss_reset = _reset_peak_rss()
+        self._started_tracing = False
+        if self.trace_memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+                self._started_tracing = True
+        self.start_time = time.time()
+        self._io_start = _io_counters()
+        self._mark = (time.perf_counter(), self._io_start)
+        self._stack = ['compute']
+        _active = self
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        import tracemalloc
+
+        self._charge()
+        self.duration = time.time() - self.start_time
+        io_end = _io_counters()
+        if self._io_start is not None and io_end is not None:
+            self.read_bytes = io_end[0] - self._io_start[0]
+            self.write_bytes = io_end[1] - self._io_start[1]
+        else:
+            self.read_bytes = self.write_bytes = None
+        self.peak_rss_mb = _peak_rss_mb(self._rss_reset)
+        self.tracemalloc_peak_mb = None
+        if self.trace_memory:
+            self.tracemalloc_peak_mb = tracemalloc.get_traced_memory()[1] / 1024.**2
+            if self._started_tracing:
+                tracemalloc.stop()
+        _active = self._previous
+        return False
+
+    def _charge(self):
+        """ Charge the time and I/O since the last mark to the current phase. """
+
+        now = (time.perf_counter(), _io_counters())
+        stats = self.phases.setdefault(self._stack[-1], OrderedDict([('time', 0.), ('read_bytes', 0), ('write_bytes', 0)]))
+        stats['time'] += now[0] - self._mark[0]
+        if now[1] is not None and self._mark[1] is not None:
+            stats['read_bytes'] += now[1][0] - self._mark[1][0]
+            stats['write_bytes'] += now[1][1] - self._mark[1][1]
+        self._mark = now
+
+    @contextmanager
+    def phase(self, name):
+        """ Count the time and I/O of the block towards phase name. """
+
+        if threading.get_ident() != self._thread:
+            yield
+            return
+        self._charge()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._charge()
+            self._stack.pop()
+
+    def summary(self):
+        """ Measurements as a dict: duration, phases (time, read_bytes and write_bytes of each), read_bytes, write_bytes, peak_rss_mb and tracemalloc_peak_mb. """
+
+        return OrderedDict([('duration', self.duration),
+                            ('phases', self.phases),
+                            ('read_bytes', self.read_bytes),
+                            ('write_bytes', self.write_bytes),
+                            ('peak_rss_mb', self.peak_rss_mb),
+                            ('tracemalloc_peak_mb', self.tracemalloc_peak_mb)])
+
+
+@contextmanager
+def _no_phase():
+    yield
+
+
+def phase(name):
+    """
+    Mark a block of code as phase name ('load', 'compute', 'render' or 'write') of the interface running in this process. Does nothing when no interface is being recorded.
+
+    Examples:
+
+        >>> with phase('write'):
+        >>>     img.to_filename(out_file)
+
+    """
+
+    if _active is None:
+        return _no_phase()
+    return _active.phase(name)
+
+
+def get_log_file():
+    """ Instrumentation log file in nipype's log directory (set by wfmaker to logs/nipype), or None if nipype doesn't log to file. """
+
+    from nipype import config
+    if not config.getboolean('logging', 'log_to_file'):
+        return None
+    return os.path.join(config.get('logging', 'log_directory'), log_file_name)
+
+
+def append_record(record, log_file):
+    """ Append a record to a JSON-lines log file. Each record is written with a single write so processes can share the file. """
+
+    line = (json.dumps(record) + '\n').encode('utf-8')
+    fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def read_log(log_file):
+    """
+    Read an instrumentation log.
+
+    Args:
+        log_file: instrumentation.jsonl file
+
+    Returns:
+        records: DataFrame with one row per interface run and a column for each phase's time
+
+    """
+
+    import pandas as pd
+
+    records = []
+    with open(log_file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            for name, stats in record.pop('phases', {}).items():
+                record[name + '_time'] = stats['time']
+            records.append(record)
+    return pd.DataFrame(records)
+
+
+def interface_record(interface, recorder, cwd, status):
+    """ Log record of an interface run. """
+
+    cwd = str(cwd) if cwd else None
+    return OrderedDict([('interface', type(interface).__name__),
+                        ('node', os.path.basename(cwd) if cwd else None),
+                        ('cwd', cwd),
+                        ('hostname', socket.gethostname()),
+                        ('pid', os.getpid()),
+                        ('start', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(recorder.start_time))),
+                        ('status', status)] + list(recorder.summary().items()))
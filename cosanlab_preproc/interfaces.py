@@ -8,8 +8,8 @@ Classes for various nipype interfaces
 
 '''
 
-__all__ = ['Plot_Coregistration_Montage', 'Plot_Realignment_Parameters',
-           'Create_Covariates', 'Down_Sample_Precision', 'Filter_In_Mask', 'Create_Encoding_File']
+__all__ = ['Plot_Coregistration_Montage', 'Plot_Quality_Control', 'Compute_Quality_Metrics', 'Plot_Quality_Metrics', 'Compute_Run_Statistics', 'Plot_Realignment_Parameters',
+           'Compute_CompCor', 'Create_Covariates', 'Down_Sample_Precision', 'Filter_In_Mask', 'Smooth_In_Mask', 'Filter_Smooth_Down_Sample', 'Filter_Smooth_Down_Sample_Grid', 'Create_Encoding_File', 'Link_DataSink']
 __author__ = ["Luke Chang"]
 __license__ = "MIT"
 
@@ -19,11 +19,60 @@ import pandas as pd
 import numpy as np
 import os
 import nibabel as nib
-from nipype.interfaces.base import BaseInterface, TraitedSpec, File, traits
+from nipype.interfaces.base import BaseInterface, TraitedSpec, File, traits, isdefined
+from nipype.interfaces.io import DataSink, DataSinkInputSpec
 from nilearn import plotting, image
 
 
-class Plot_Coregistration_Montage_InputSpec(TraitedSpec):
+class Preproc_InputSpec(TraitedSpec):
+    num_threads = traits.Int(nohash=True, desc="threads the interface may use, including BLAS and OpenMP threads; set by nipype from the node's n_procs")
+    trace_memory = traits.Bool(nohash=True, desc="also record peak python/numpy memory with tracemalloc, which slows down allocation-heavy code; default off unless COSANLAB_PREPROC_TRACE_MEMORY=1")
+
+
+class Preproc_Interface(BaseInterface):
+
+    """
+    Base class of cosanlab_preproc's python interfaces.
+
+    While the interface runs, BLAS and OpenMP threads are limited to num_threads, which nipype sets from the node's n_procs, and so are the package's own thread pools (gzip compression, filtering and smoothing; see utils.get_n_threads), so the node doesn't use more cores than the scheduler allots it.
+
+    Each run is instrumented (see cosanlab_preproc.instrument): the time spent in each phase (load, compute, render, write), bytes read and written, and peak memory are added to the result's runtime as phases, read_bytes, write_bytes, peak_rss_mb and (with trace_memory) tracemalloc_peak_mb, and appended to instrumentation.jsonl in nipype's log directory.
+
+    """
+
+    def run(self, cwd=None, ignore_exception=None, **inputs):
+        from .utils import limit_threads
+        from .instrument import Recorder, get_log_file, append_record, interface_record
+
+        n_threads = inputs.get('num_threads', self.inputs.num_threads)
+        trace_memory = inputs.get('trace_memory', self.inputs.trace_memory)
+        recorder = Recorder(trace_memory=trace_memory if isdefined(trace_memory) else None)
+        status = 'error'
+        try:
+            with limit_threads(n_threads if isdefined(n_threads) else None), recorder:
+                result = super(Preproc_Interface, self).run(cwd=cwd, ignore_exception=ignore_exception, **inputs)
+            status = 'error' if getattr(result.runtime, 'traceback', None) or result.runtime.returncode not in [0, None] else 'ok'
+            for key, value in recorder.summary().items():
+                if key != 'duration':
+                    setattr(result.runtime, key, value)
+            return result
+        finally:
+            log_file = get_log_file()
+            if log_file is not None and os.path.isdir(os.path.dirname(log_file)) and hasattr(recorder, 'duration'):
+                append_record(interface_record(self, recorder, cwd or os.getcwd(), status), log_file)
+
+    def _n_threads(self):
+        """ Threads for the interface's own thread pools: n_threads if it's set, otherwise num_threads, otherwise None (utils.get_n_threads's default). """
+
+        n_threads = getattr(self.inputs, 'n_threads', None)
+        if n_threads is not None and isdefined(n_threads):
+            return n_threads
+        if isdefined(self.inputs.num_threads):
+            return self.inputs.num_threads
+        return None
+
+
+class Plot_Coregistration_Montage_InputSpec(Preproc_InputSpec):
     wra_img = File(exists=True, mandatory=True)
     canonical_img = File(exists=True, mandatory=True)
     title = traits.Str("Normalized Functional Check", usedefault=True)
@@ -33,7 +82,7 @@ class Plot_Coregistration_Montage_OutputSpec(TraitedSpec):
     plot = File(exists=True)
 
 
-class Plot_Coregistration_Montage(BaseInterface):
+class Plot_Coregistration_Montage(Preproc_Interface):
     # This function creates an axial montage of the average normalized functional data
     # and overlays outline of the normalized single subject overlay.
     # Could probably pick a better overlay later.
@@ -45,11 +94,13 @@ class Plot_Coregistration_Montage(BaseInterface):
         import matplotlib
         matplotlib.use('Agg')
         import pylab as plt
+        from .instrument import phase
 
-        wra_img = nib.load(self.inputs.wra_img)
-        canonical_img = nib.load(self.inputs.canonical_img)
+        with phase('load'):
+            wra_img = nib.load(self.inputs.wra_img)
+            canonical_img = nib.load(self.inputs.canonical_img)
+            mean_wraimg = image.mean_img(wra_img)
         title = self.inputs.title
-        mean_wraimg = image.mean_img(wra_img)
 
         if title != "":
             filename = title.replace(" ", "_") + ".pdf"
@@ -64,12 +115,13 @@ class Plot_Coregistration_Montage(BaseInterface):
         cut_coords = [range(-50, 0, 10), range(0, 51, 10), range(-30, 15, 9),
                       range(0, 61, 10), range(-60, 0, 12), range(0, 31, 6)]
         display_modes = ['x', 'x', 'z', 'z', 'y', 'y']
-        for i, ax in enumerate(axes):
-            fig = plotting.plot_anat(
-                mean_wraimg, title=titles[i], cut_coords=cut_coords[i], display_mode=display_modes[i], axes=ax)
-            fig.add_edges(canonical_img)
+        with phase('render'):
+            for i, ax in enumerate(axes):
+                fig = plotting.plot_anat(
+                    mean_wraimg, title=titles[i], cut_coords=cut_coords[i], display_mode=display_modes[i], axes=ax)
+                fig.add_edges(canonical_img)
 
-        f.savefig(filename)
+            f.savefig(filename)
         plt.close(f)
         plt.close()
         del f
@@ -83,12 +135,291 @@ class Plot_Coregistration_Montage(BaseInterface):
         return outputs
 
 
-class Plot_Quality_Control_InputSpec(TraitedSpec):
+class Compute_Quality_Metrics_InputSpec(Preproc_InputSpec):
+    dat_img = File(exists=True, mandatory=True)
+    global_outlier_cutoff = traits.Float(3, usedefault=True)
+    frame_outlier_cutoff = traits.Float(3, usedefault=True)
+    chunk_size = traits.Int(1, usedefault=True)
+
+
+class Compute_Quality_Metrics_OutputSpec(TraitedSpec):
+    metrics = File(exists=True)
+    mean_img = File(exists=True)
+    std_img = File(exists=True)
+    tsnr_img = File(exists=True)
+    fd_outliers = File(exists=True)
+    global_outliers = File(exists=True)
+
+
+class Compute_Quality_Metrics(Preproc_Interface):
+
+    """
+    Metrics-only counterpart of Plot_Quality_Control. Computes tSNR brain images, global signal mean, std and frame-differences (of signal intensities) and identifies global and frame-difference outlier TRs without rendering anything. Use Plot_Quality_Metrics to render the QA plot from its outputs.
+
+    Args:
+        dat_img: epi nifti file
+        global_outlier_cutoff: cutoff to identify outlier TRs based on global signal intensity; default 3 standard deviations from mean
+        frame_outlier_cutoff: cutoff to identifiy outlier TRs based on intensity differences between successive TRs; default 3 standard deviations from mean
+        chunk_size: number of volumes read into memory at a time; default 1
+
+    Returns:
+        metrics: json file with tSNR summary, global signal series, frame-differences and outliers
+        mean_img: voxel-wise mean image referenced by the metrics file
+        std_img: voxel-wise std image referenced by the metrics file
+        tsnr_img: voxel-wise tSNR image referenced by the metrics file
+        fd_outliers: outlier TRs based on frame-differences
+        global_outliers: outlier TRs based on global intensity
+
+    """
+
+    input_spec = Compute_Quality_Metrics_InputSpec
+    output_spec = Compute_Quality_Metrics_OutputSpec
+
+    def _run_interface(self, runtime):
+        from .qc import compute_qc_metrics, find_outliers, save_qc_metrics
+
+        # Stream over the run so only a few volumes are in memory at once
+        # Mask is computed first to deal with 0 sd for computing tsnr
+        metrics = compute_qc_metrics(self.inputs.dat_img, chunk_size=self.inputs.chunk_size)
+
+        # Identify global signal and frame difference outliers
+        metrics['global_outliers'] = find_outliers(metrics['global_mean'], self.inputs.global_outlier_cutoff)
+        metrics['fd_outliers'] = find_outliers(metrics['frame_diff'], self.inputs.frame_outlier_cutoff)
+        metrics['global_outlier_cutoff'] = self.inputs.global_outlier_cutoff
+        metrics['frame_outlier_cutoff'] = self.inputs.frame_outlier_cutoff
+
+        fd_file_name = "fd_outliers.txt"
+        global_file_name = "global_outliers.txt"
+        np.savetxt(fd_file_name, metrics['fd_outliers'])
+        np.savetxt(global_file_name, metrics['global_outliers'])
+
+        self._metrics = save_qc_metrics(metrics, 'qc_metrics.json', n_threads=self._n_threads())
+        self._fd_outliers = fd_file_name
+        self._global_outliers = global_file_name
+
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        from .qc import qc_image_files
+        outputs = self._outputs().get()
+        outputs["metrics"] = os.path.abspath(self._metrics)
+        images = qc_image_files(self._metrics)
+        outputs["mean_img"] = images['mean']
+        outputs["std_img"] = images['std']
+        outputs["tsnr_img"] = images['tsnr']
+        outputs["fd_outliers"] = os.path.abspath(self._fd_outliers)
+        outputs["global_outliers"] = os.path.abspath(self._global_outliers)
+        return outputs
+
+
+class Plot_Quality_Metrics_InputSpec(Preproc_InputSpec):
+    metrics = File(exists=True, mandatory=True)
+    title = traits.Str("Signal quality", usedefault=True)
+    dpi = traits.Int(300, usedefault=True)
+
+
+class Plot_Quality_Metrics_OutputSpec(TraitedSpec):
+    plot = File(exists=True)
+
+
+class Plot_Quality_Metrics(Preproc_Interface):
+
+    """
+    Render-only counterpart of Plot_Quality_Control. Draws the QA plot from a metrics file written by Compute_Quality_Metrics without touching the functional data.
+
+    Args:
+        metrics: json file from Compute_Quality_Metrics
+        title: plot title (optional)
+        dpi: figure dpi; default 300
+
+    Returns:
+        plot: QA plot file
+
+    """
+
+    input_spec = Plot_Quality_Metrics_InputSpec
+    output_spec = Plot_Quality_Metrics_OutputSpec
+
+    def _run_interface(self, runtime):
+        from .qc import load_qc_metrics, plot_qc_metrics
+        from .instrument import phase
+
+        with phase('load'):
+            metrics = load_qc_metrics(self.inputs.metrics)
+        with phase('render'):
+            self._plot = plot_qc_metrics(metrics, title=self.inputs.title, dpi=self.inputs.dpi)
+
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["plot"] = os.path.abspath(self._plot)
+        return outputs
+
+
+class Compute_Run_Statistics_InputSpec(Preproc_InputSpec):
+    in_file = File(exists=True, mandatory=True)
+    realignment_parameters = File(exists=True, mandatory=True)
+    parameter_source = traits.Enum('FSL', 'SPM', 'AFNI', 'NiPy', 'FSFAST', usedefault=True)
+    mask_fraction = traits.Float(0.05, usedefault=True)
+    use_differences = traits.List(traits.Bool, [True, False], usedefault=True, minlen=2, maxlen=2)
+    norm_threshold = traits.Float(1, usedefault=True)
+    zintensity_threshold = traits.Float(3, usedefault=True)
+    global_outlier_cutoff = traits.Float(3, usedefault=True)
+    frame_outlier_cutoff = traits.Float(3, usedefault=True)
+    chunk_size = traits.Int(1, usedefault=True)
+
+
+class Compute_Run_Statistics_OutputSpec(TraitedSpec):
+    mean_file = File(exists=True)
+    brain_mask = File(exists=True)
+    outlier_files = File(exists=True)
+    intensity_files = File(exists=True)
+    norm_files = File(exists=True)
+    statistic_files = File(exists=True)
+    metrics = File(exists=True)
+    mean_img = File(exists=True)
+    std_img = File(exists=True)
+    tsnr_img = File(exists=True)
+    fd_outliers = File(exists=True)
+    global_outliers = File(exists=True)
+
+
+class Compute_Run_Statistics(Preproc_Interface):
+
+    """
+    Fused run statistics node that replaces a mean image (FSL MeanImage), brain mask (nipy ComputeMask), artifact detection (rapidart ArtifactDetect) and Compute_Quality_Metrics, which would otherwise each decompress and read the realigned run separately. The run is decompressed once (see cosanlab_preproc.qc.compute_run_statistics).
+
+    Artifact detection follows ArtifactDetect with use_norm=True and mask_type='file' using the computed brain mask, and output files are named the same way.
+
+    Args:
+        in_file: realigned epi nifti file
+        realignment_parameters: realignment parameter file for in_file
+        parameter_source: software that produced the realignment parameters; default 'FSL'
+        mask_fraction: lower fraction of sorted mean intensities used to find the brain mask threshold (ComputeMask's m); default 0.05
+        use_differences: use differences between successive motion (first element) and intensity (second element) estimates; default [True, False]
+        norm_threshold: motion norm threshold in mm; default 1
+        zintensity_threshold: intensity z-score threshold; default 3
+        global_outlier_cutoff: cutoff to identify outlier TRs based on global signal intensity; default 3 standard deviations from mean
+        frame_outlier_cutoff: cutoff to identifiy outlier TRs based on intensity differences between successive TRs; default 3 standard deviations from mean
+        chunk_size: number of volumes read into memory at a time; default 1
+
+    Returns:
+        mean_file: mean epi image
+        brain_mask: brain mask computed from the mean epi
+        outlier_files: outlier TRs based on intensity or motion
+        intensity_files: global intensity within the brain mask for each TR
+        norm_files: motion norm for each TR
+        statistic_files: summary of the outliers
+        metrics: QC metrics json file as from Compute_Quality_Metrics
+        mean_img: voxel-wise mean image referenced by the metrics file
+        std_img: voxel-wise std image referenced by the metrics file
+        tsnr_img: voxel-wise tSNR image referenced by the metrics file
+        fd_outliers: outlier TRs based on frame-differences
+        global_outliers: outlier TRs based on global intensity
+
+    """
+
+    input_spec = Compute_Run_Statistics_InputSpec
+    output_spec = Compute_Run_Statistics_OutputSpec
+
+    def _run_interface(self, runtime):
+        from nipype.utils.filemanip import split_filename, save_json
+        from .qc import compute_run_statistics, detect_art_outliers, find_outliers, save_qc_metrics
+        from .nifti import save_nifti
+
+        _, name, ext = split_filename(self.inputs.in_file)
+        mean, brain_mask, global_intensity, metrics = compute_run_statistics(
+            self.inputs.in_file, mask_fraction=self.inputs.mask_fraction, chunk_size=self.inputs.chunk_size)
+        mean_file = name + '_mean' + ext
+        mask_file = name + '_brain_mask' + ext
+        save_nifti(mean, mean_file, n_threads=self._n_threads())
+        save_nifti(brain_mask, mask_file, n_threads=self._n_threads())
+
+        # Artifact detection
+        mc = np.loadtxt(self.inputs.realignment_parameters)
+        art = detect_art_outliers(global_intensity, mc,
+                                  use_differences=self.inputs.use_differences,
+                                  norm_threshold=self.inputs.norm_threshold,
+                                  zintensity_threshold=self.inputs.zintensity_threshold,
+                                  parameter_source=self.inputs.parameter_source)
+        outlier_file = 'art.' + name + '_outliers.txt'
+        intensity_file = 'global_intensity.' + name + '.txt'
+        norm_file = 'norm.' + name + '.txt'
+        stats_file = 'stats.' + name + '.txt'
+        np.savetxt(outlier_file, art['outliers'], fmt="%d", delimiter=" ")
+        np.savetxt(intensity_file, global_intensity.reshape(-1, 1), fmt="%.2f", delimiter=" ")
+        np.savetxt(norm_file, art['norm'], fmt="%.4f", delimiter=" ")
+        gz = art['intensity_z']
+        normval = art['norm']
+        iidx = art['intensity_outliers']
+        motion_outliers = art['motion_outliers']
+        save_json(stats_file, [
+            {"motion_file": self.inputs.realignment_parameters, "functional_file": self.inputs.in_file},
+            {"common_outliers": len(np.intersect1d(iidx, motion_outliers)),
+             "intensity_outliers": len(np.setdiff1d(iidx, motion_outliers)),
+             "motion_outliers": len(np.setdiff1d(motion_outliers, iidx))},
+            {"motion": [{"using differences": self.inputs.use_differences[0]},
+                        {"mean": np.mean(mc, axis=0).tolist(), "min": np.min(mc, axis=0).tolist(),
+                         "max": np.max(mc, axis=0).tolist(), "std": np.std(mc, axis=0).tolist()}]},
+            {"motion_norm": {"mean": np.mean(normval, axis=0).tolist(), "min": np.min(normval, axis=0).tolist(),
+                             "max": np.max(normval, axis=0).tolist(), "std": np.std(normval, axis=0).tolist()}},
+            {"intensity": [{"using differences": self.inputs.use_differences[1]},
+                           {"mean": np.mean(gz, axis=0).tolist(), "min": np.min(gz, axis=0).tolist(),
+                            "max": np.max(gz, axis=0).tolist(), "std": np.std(gz, axis=0).tolist()}]}
+        ])
+
+        # QC metrics
+        metrics['global_outliers'] = find_outliers(metrics['global_mean'], self.inputs.global_outlier_cutoff)
+        metrics['fd_outliers'] = find_outliers(metrics['frame_diff'], self.inputs.frame_outlier_cutoff)
+        metrics['global_outlier_cutoff'] = self.inputs.global_outlier_cutoff
+        metrics['frame_outlier_cutoff'] = self.inputs.frame_outlier_cutoff
+        fd_file_name = "fd_outliers.txt"
+        global_file_name = "global_outliers.txt"
+        np.savetxt(fd_file_name, metrics['fd_outliers'])
+        np.savetxt(global_file_name, metrics['global_outliers'])
+
+        self._mean_file = mean_file
+        self._brain_mask = mask_file
+        self._outlier_files = outlier_file
+        self._intensity_files = intensity_file
+        self._norm_files = norm_file
+        self._statistic_files = stats_file
+        self._metrics = save_qc_metrics(metrics, 'qc_metrics.json', n_threads=self._n_threads())
+        self._fd_outliers = fd_file_name
+        self._global_outliers = global_file_name
+
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        from .qc import qc_image_files
+        outputs = self._outputs().get()
+        outputs["mean_file"] = os.path.abspath(self._mean_file)
+        outputs["brain_mask"] = os.path.abspath(self._brain_mask)
+        outputs["outlier_files"] = os.path.abspath(self._outlier_files)
+        outputs["intensity_files"] = os.path.abspath(self._intensity_files)
+        outputs["norm_files"] = os.path.abspath(self._norm_files)
+        outputs["statistic_files"] = os.path.abspath(self._statistic_files)
+        outputs["metrics"] = os.path.abspath(self._metrics)
+        images = qc_image_files(self._metrics)
+        outputs["mean_img"] = images['mean']
+        outputs["std_img"] = images['std']
+        outputs["tsnr_img"] = images['tsnr']
+        outputs["fd_outliers"] = os.path.abspath(self._fd_outliers)
+        outputs["global_outliers"] = os.path.abspath(self._global_outliers)
+        return outputs
+
+
+class Plot_Quality_Control_InputSpec(Preproc_InputSpec):
     dat_img = File(exists=True, mandatory=True)
     title = traits.Str("Signal quality", usedefault=True)
     global_outlier_cutoff = traits.Float(3, usedefault=True)
     frame_outlier_cutoff = traits.Float(3, usedefault=True)
     dpi = traits.Int(300, usedefault=True)
+    chunk_size = traits.Int(1, usedefault=True)
 
 
 class Plot_Quality_Control_OutputSpec(TraitedSpec):
@@ -97,19 +428,22 @@ class Plot_Quality_Control_OutputSpec(TraitedSpec):
     global_outliers = File(exists=True)
 
 
-class Plot_Quality_Control(BaseInterface):
+class Plot_Quality_Control(Preproc_Interface):
 
     """
     This is a QA interface that does two things:
     1) It generates plots that include: tSNR brain images, global signal mean, std, and frame-differences (of signal intensities)
     2) It computes two kinds of outliers: a) TRs where the global signal > 3 stds (default) from the mean; b) TRs where successive differences between TRs (i.e. frame differences) are > 3 stds (default) from the mean frame-diff
 
+    Metrics are computed by streaming over the run volume-by-volume (see cosanlab_preproc.qc.compute_qc_metrics) so peak memory does not scale with the number of TRs. To compute outliers without rendering, use Compute_Quality_Metrics followed by Plot_Quality_Metrics instead.
+
     Args:
         dat_img: epi nifti file
         title: plot title (optional)
         global_outlier_cutoff: cutoff to identify outlier TRs based on global signal intensity; default 3 standard deviations from mean
         frame_outlier_cutoff: cutoff to identifiy outlier TRs based on intensity differences between successive TRs; default 3 standard deviations from mean
         dpi: figure dpi; default 300
+        chunk_size: number of volumes read into memory at a time; default 1
 
     Returns:
         plot: QA plot file
@@ -122,96 +456,24 @@ class Plot_Quality_Control(BaseInterface):
     output_spec = Plot_Quality_Control_OutputSpec
 
     def _run_interface(self, runtime):
-        # from __future__ import division
-        import matplotlib
-        matplotlib.use('Agg')
-        import pylab as plt
-        import numpy as np
-        import nibabel as nib
-        from nilearn.masking import compute_epi_mask, apply_mask, unmask
-        from nilearn.plotting import plot_stat_map
-
-        dat_img = nib.load(self.inputs.dat_img)
-        # Apply mask first to deal with 0 sd for computing tsnr
-        # nilearn defaults are lower = 0.2; upper = 0.85
-        mask = compute_epi_mask(dat_img)
-        masked_data = apply_mask(dat_img, mask)
-        # Compute mean across time within each voxel
-        mn = np.mean(masked_data, axis=0)
-        sd = np.std(masked_data, axis=0)
-        tsnr = np.true_divide(mn, sd)
-        # Compute mean across voxels within each TR
-        global_mn = np.mean(masked_data, axis=1)
-        global_sd = np.std(masked_data, axis=1)
-        # Unmask data for plotting below
-        mn = unmask(mn, mask)
-        sd = unmask(sd, mask)
-        tsnr = unmask(tsnr, mask)
-
-        # Identify global signal outliers
-        global_outliers = np.append(np.where(global_mn > np.mean(global_mn) + np.std(global_mn) * self.inputs.global_outlier_cutoff),
-                                   np.where(global_mn < np.mean(global_mn) - np.std(global_mn) * self.inputs.global_outlier_cutoff))
-
-        # Identify frame difference outliers
-        frame_diff = np.mean(np.abs(np.diff(masked_data, axis=0)), axis=1)
-        frame_outliers = np.append(np.where(frame_diff > np.mean(frame_diff) + np.std(frame_diff) * self.inputs.frame_outlier_cutoff),
-                                  np.where(frame_diff < np.mean(frame_diff) - np.std(frame_diff) * self.inputs.frame_outlier_cutoff))
+        from .qc import compute_qc_metrics, find_outliers, plot_qc_metrics
+        from .instrument import phase
 
-        fd_file_name = "fd_outliers.txt"
-        global_file_name = "global_outliers.txt"
-        np.savetxt(fd_file_name, frame_outliers)
-        np.savetxt(global_file_name, global_outliers)
+        # Stream over the run so only a few volumes are in memory at once
+        # Mask is computed first to deal with 0 sd for computing tsnr
+        metrics = compute_qc_metrics(self.inputs.dat_img, chunk_size=self.inputs.chunk_size)
 
-        title = self.inputs.title
-        colspan = 2
-        loc = 9
-        F = plt.figure(figsize=(8.3, 11.7))
-        F.text(0.5, .93, title, horizontalalignment='center',fontsize=16)
-        F.text(0.5, .01, 'TR', horizontalalignment='center',fontsize=16)
-
-        # Plot brain images first
-        ax1 = plt.subplot2grid((6, 2), (0, 0), colspan=colspan)
-        plot_stat_map(mn, title="Mean", cut_coords=range(-40, 40, 10), display_mode='z', axes=ax1,
-                      draw_cross=False, black_bg=True, annotate=False, bg_img=None)
-        ax2 = plt.subplot2grid((6, 2), (1, 0), colspan=colspan)
-        plot_stat_map(sd, title="Standard Deviation", cut_coords=range(-40, 40, 10), display_mode='z', axes=ax2,
-                      draw_cross=False, black_bg=True, annotate=False, bg_img=None)
-        ax3 = plt.subplot2grid((6, 2), (2, 0), colspan=colspan)
-        plot_stat_map(tsnr, title="tSNR (mn/sd)", cut_coords=range(-40, 40, 10), display_mode='z', axes=ax3,
-                      draw_cross=False, black_bg=True, annotate=False, bg_img=None)
-
-        # Plot global mean, std, diffs next
-        ax4 = plt.subplot2grid((6, 2), (3, 0), colspan=colspan)
-        handles = ax4.plot(global_mn)
-        ax4.set(xlabel='',ylabel='Global mean',xticklabels=[])
-        v_ax = ax4.vlines(global_outliers,ax4.get_ylim()[0],ax4.get_ylim()[-1],color='r', linestyle='--',zorder=3)
-        handles.append(v_ax)
-        ax4.legend([v_ax],['intensity outliers'],loc=loc)
-        ax4.tick_params(direction='in')
-
-        ax5 = plt.subplot2grid((6, 2), (4, 0), colspan=colspan)
-        handles = ax5.plot(global_sd)
-        ax5.set(xlabel='',ylabel='Global std',xticklabels=[])
-        ax5.tick_params(direction='in')
-
-        ax6 = plt.subplot2grid((6, 2), (5, 0), colspan=colspan)
-        handles = ax6.plot(frame_diff)
-        ax6.set(xlabel='',ylabel='Global abs diffs')
-        v_ax = ax6.vlines(frame_outliers,ax6.get_ylim()[0],ax6.get_ylim()[-1],color='r', linestyle='--',zorder=3)
-        ax6.legend([v_ax],['diff outliers'],loc=loc)
-        ax6.tick_params(direction='in')
+        # Identify global signal and frame difference outliers
+        metrics['global_outliers'] = find_outliers(metrics['global_mean'], self.inputs.global_outlier_cutoff)
+        metrics['fd_outliers'] = find_outliers(metrics['frame_diff'], self.inputs.frame_outlier_cutoff)
 
-        if title != "":
-            filename = title.replace(" ", "_") + ".pdf"
-        else:
-            filename = "plot.pdf"
-
-        F.savefig(filename, papertype="a4", dpi=self.inputs.dpi)
-        plt.clf()
-        plt.close()
-        del F
+        fd_file_name = "fd_outliers.txt"
+        global_file_name = "global_outliers.txt"
+        np.savetxt(fd_file_name, metrics['fd_outliers'])
+        np.savetxt(global_file_name, metrics['global_outliers'])
 
-        self._plot = filename
+        with phase('render'):
+            self._plot = plot_qc_metrics(metrics, title=self.inputs.title, dpi=self.inputs.dpi)
         self._fd_outliers = fd_file_name
         self._global_outliers = global_file_name
 
@@ -226,7 +488,7 @@ class Plot_Quality_Control(BaseInterface):
         return outputs
 
 
-class Plot_Realignment_Parameters_InputSpec(TraitedSpec):
+class Plot_Realignment_Parameters_InputSpec(Preproc_InputSpec):
     realignment_parameters = File(exists=True, mandatory=True)
     outliers = File(exists=True)
     title = traits.Str("Realignment parameters", usedefault=True)
@@ -237,7 +499,7 @@ class Plot_Realignment_Parameters_OutputSpec(TraitedSpec):
     plot = File(exists=True)
 
 
-class Plot_Realignment_Parameters(BaseInterface):
+class Plot_Realignment_Parameters(Preproc_Interface):
 
     """
     Create a plot of realignment parameters.
@@ -269,63 +531,66 @@ class Plot_Realignment_Parameters(BaseInterface):
         import matplotlib
         matplotlib.use('Agg')
         import pylab as plt
-        realignment_parameters = np.loadtxt(self.inputs.realignment_parameters)
+        from .instrument import phase
+        with phase('load'):
+            realignment_parameters = np.loadtxt(self.inputs.realignment_parameters)
+            outliers = np.loadtxt(self.inputs.outliers)
         realignment_parameter_diffs = np.abs(np.diff(realignment_parameters,axis=0))
-        outliers = np.loadtxt(self.inputs.outliers)
-
-        title = self.inputs.title
-        colspan = 2
-        loc = 9
-        realign_lims = (-2,2)
-        diff_lims = (-0.01,2)
-        F = plt.figure(figsize=(8.3, 11.7))
-        F.text(0.5, .97, title, horizontalalignment='center',fontsize=16)
-        F.text(0.5, .01, 'TR', horizontalalignment='center',fontsize=16)
-
-        # Plot x,y,z first
-        ax1 = plt.subplot2grid((4, 2), (0, 0), colspan=colspan)
-        handles = ax1.plot(realignment_parameters[:, 3:6])
-        ax1.legend(handles, ["x","y", "z"], loc=loc, ncol=3)
-        ax1.set(ylabel="Translation (mm)",xticklabels=[],xlim=(0,realignment_parameters.shape[0]-1),ylim=(realign_lims))
-        ax1.tick_params(direction = 'in')
-
-        # Plot pitch, roll, yaw second
-        ax2 = plt.subplot2grid((4, 2), (1, 0), colspan=colspan)
-        handles = ax2.plot(realignment_parameters[:, 0:3] * 50)
-        ax2.legend(handles, ["pitch", "roll", "yaw"], loc=loc, ncol=3)
-        ax2.set(ylabel="Rotation (mm)",xticklabels=[],xlim=(0,realignment_parameters.shape[0]-1),ylim=realign_lims)
-        ax2.tick_params(direction = 'in')
-
-        # Plot x,y,z diffs with rapidart third
-        ax3 = plt.subplot2grid((4, 2), (2, 0), colspan=colspan)
-        handles = ax3.plot(realignment_parameter_diffs[:, 3:6])
-        v_ax = ax3.vlines(outliers,ymin=realign_lims[0],ymax=realign_lims[1],color='r',linestyle='--')
-        handles.append(v_ax)
-        ax3.legend(handles, ["x","y","z","rapid art"], loc=loc, ncol=4)
-        ax3.set(ylabel="Translation diffs (abs mm)",xticklabels=[],xlim=(0,realignment_parameter_diffs.shape[0]-1),ylim=(diff_lims))
-        ax3.tick_params(direction = 'in')
-
-        # Plot pitch,roll,raw diffs with rapidart fourth
-        ax4 = plt.subplot2grid((4, 2), (3, 0), colspan=colspan)
-        handles = ax4.plot(realignment_parameter_diffs[:, 0:3]*50)
-        v_ax = ax4.vlines(outliers,ymin=realign_lims[0],ymax=realign_lims[1],color='r',linestyle='--')
-        handles.append(v_ax)
-        ax4.legend(handles, ["pitch","roll", "yaw", "rapid art"], loc=loc, ncol=4)
-        ax4.set(ylabel="Rotation diffs (abs mm)",xlim=(0,realignment_parameter_diffs.shape[0]-1),ylim=diff_lims)
-        ax4.tick_params(direction = 'in')
-
-        # Fine-tune spacing
-        plt.subplots_adjust(top=.96,bottom=.05,hspace=.1)
 
-        if title != "":
-            filename = title.replace(" ", "_") + ".pdf"
-        else:
-            filename = "plot.pdf"
-
-        F.savefig(filename, papertype="a4", dpi=self.inputs.dpi)
-        plt.clf()
-        plt.close()
-        del F
+        with phase('render'):
+            title = self.inputs.title
+            colspan = 2
+            loc = 9
+            realign_lims = (-2,2)
+            diff_lims = (-0.01,2)
+            F = plt.figure(figsize=(8.3, 11.7))
+            F.text(0.5, .97, title, horizontalalignment='center',fontsize=16)
+            F.text(0.5, .01, 'TR', horizontalalignment='center',fontsize=16)
+
+            # Plot x,y,z first
+            ax1 = plt.subplot2grid((4, 2), (0, 0), colspan=colspan)
+            handles = ax1.plot(realignment_parameters[:, 3:6])
+            ax1.legend(handles, ["x","y", "z"], loc=loc, ncol=3)
+            ax1.set(ylabel="Translation (mm)",xticklabels=[],xlim=(0,realignment_parameters.shape[0]-1),ylim=(realign_lims))
+            ax1.tick_params(direction = 'in')
+
+            # Plot pitch, roll, yaw second
+            ax2 = plt.subplot2grid((4, 2), (1, 0), colspan=colspan)
+            handles = ax2.plot(realignment_parameters[:, 0:3] * 50)
+            ax2.legend(handles, ["pitch", "roll", "yaw"], loc=loc, ncol=3)
+            ax2.set(ylabel="Rotation (mm)",xticklabels=[],xlim=(0,realignment_parameters.shape[0]-1),ylim=realign_lims)
+            ax2.tick_params(direction = 'in')
+
+            # Plot x,y,z diffs with rapidart third
+            ax3 = plt.subplot2grid((4, 2), (2, 0), colspan=colspan)
+            handles = ax3.plot(realignment_parameter_diffs[:, 3:6])
+            v_ax = ax3.vlines(outliers,ymin=realign_lims[0],ymax=realign_lims[1],color='r',linestyle='--')
+            handles.append(v_ax)
+            ax3.legend(handles, ["x","y","z","rapid art"], loc=loc, ncol=4)
+            ax3.set(ylabel="Translation diffs (abs mm)",xticklabels=[],xlim=(0,realignment_parameter_diffs.shape[0]-1),ylim=(diff_lims))
+            ax3.tick_params(direction = 'in')
+
+            # Plot pitch,roll,raw diffs with rapidart fourth
+            ax4 = plt.subplot2grid((4, 2), (3, 0), colspan=colspan)
+            handles = ax4.plot(realignment_parameter_diffs[:, 0:3]*50)
+            v_ax = ax4.vlines(outliers,ymin=realign_lims[0],ymax=realign_lims[1],color='r',linestyle='--')
+            handles.append(v_ax)
+            ax4.legend(handles, ["pitch","roll", "yaw", "rapid art"], loc=loc, ncol=4)
+            ax4.set(ylabel="Rotation diffs (abs mm)",xlim=(0,realignment_parameter_diffs.shape[0]-1),ylim=diff_lims)
+            ax4.tick_params(direction = 'in')
+
+            # Fine-tune spacing
+            plt.subplots_adjust(top=.96,bottom=.05,hspace=.1)
+
+            if title != "":
+                filename = title.replace(" ", "_") + ".pdf"
+            else:
+                filename = "plot.pdf"
+
+            F.savefig(filename, papertype="a4", dpi=self.inputs.dpi)
+            plt.clf()
+            plt.close()
+            del F
 
         self._plot = filename
 
@@ -338,32 +603,67 @@ class Plot_Realignment_Parameters(BaseInterface):
         return outputs
 
 
-class Down_Sample_Precision_InputSpec(TraitedSpec):
+class Down_Sample_Precision_InputSpec(Preproc_InputSpec):
     in_file = File(exists=True, mandatory=True)
     data_type = traits.Str("int16", usedefault=True)
+    scale = traits.Bool(True, usedefault=True)
+    chunk_size = traits.Int(1, usedefault=True)
 
 
 class Down_Sample_Precision_OutputSpec(TraitedSpec):
     out_file = File(exists=True)
 
 
-class Down_Sample_Precision(BaseInterface):
+class Down_Sample_Precision(Preproc_Interface):
+    """
+    Node to reduce the precision of an image, typically to int16 to save space. Data are converted and written a block of volumes at a time through nibabel's array proxies so the full run is never held in memory. For integer data types the scl_slope/scl_inter of the output are set from the run's min and max so the full range of the data type is used, rather than truncating values (which loses low-amplitude signal such as filtered data).
+
+    Args:
+        in_file: file to convert
+        data_type: output data type; default 'int16'
+        scale: compute optimal scale factors for integer data types; if False values are simply truncated; default True
+        chunk_size: number of volumes read into memory at a time; default 1
+
+    Returns:
+        out_file: converted file
+    """
+
     input_spec = Down_Sample_Precision_InputSpec
     output_spec = Down_Sample_Precision_OutputSpec
 
     def _run_interface(self, runtime):
         import nibabel as nib
         import os
+        from nipype.utils.filemanip import split_filename
+        from .nifti import iter_volumes, get_scaling, NiftiVolumeWriter
         data_type = self.inputs.data_type
         in_file = self.inputs.in_file
+        chunk_size = self.inputs.chunk_size
 
         dat = nib.load(in_file)
-        out = nib.Nifti1Image(dat.get_data().astype(data_type), dat.affine)
-
-        # Generate output file name
-        out_file = os.path.split(
-            in_file)[-1].split('.nii.gz')[0] + '_' + data_type + '.nii.gz'
-        out.to_filename(out_file)
+        hdr = dat.header.copy()
+        hdr.set_data_dtype(data_type)
+        hdr.set_slope_inter(None, None)
+        truncate = np.issubdtype(np.dtype(data_type), np.integer) and not self.inputs.scale
+        if np.issubdtype(np.dtype(data_type), np.integer):
+            if self.inputs.scale:
+                # First pass to get the range of the data for optimal scale factors
+                data_min, data_max = np.inf, -np.inf
+                for _, block in iter_volumes(in_file, chunk_size, dtype=np.float64):
+                    data_min = min(data_min, np.nanmin(block))
+                    data_max = max(data_max, np.nanmax(block))
+                hdr.set_slope_inter(*get_scaling(data_min, data_max, data_type))
+            else:
+                hdr.set_slope_inter(1, 0)
+
+        # Generate output file name; always compressed as this is typically a final output
+        _, name, _ = split_filename(in_file)
+        out_file = name + '_' + data_type + '.nii.gz'
+        with NiftiVolumeWriter(out_file, hdr, n_threads=self._n_threads()) as writer:
+            for _, block in iter_volumes(in_file, chunk_size, dtype=np.float64):
+                if truncate:
+                    block = np.trunc(block)
+                writer.write(block)
 
         self._out_file = out_file
 
@@ -376,21 +676,23 @@ class Down_Sample_Precision(BaseInterface):
         return outputs
 
 
-class Filter_In_Mask_InputSpec(TraitedSpec):
+class Filter_In_Mask_InputSpec(Preproc_InputSpec):
     in_file = File(exists=True, mandatory=True)
     mask = File(exists=True, mandatory=True)
     low_pass_cutoff = traits.Float(0.25, usedefault=True)
     high_pass_cutoff = traits.Float(0, usedefault=True)
     sampling_rate = traits.Float(mandatory=True)
+    chunk_size = traits.Int(1, usedefault=True)
+    n_threads = traits.Int()
 
 
 class Filter_In_Mask_OutputSpec(TraitedSpec):
     out_file = File(exists=True)
 
 
-class Filter_In_Mask(BaseInterface):
+class Filter_In_Mask(Preproc_Interface):
     """
-    Node to perform high and/or low-pass filtering using nltools which utilizes nilearn's 5th order butterworth filter. If no low or high-pass cutoffs are provided, simply masks the data and returns as-is. This can be useful if the output is subsequently passed to a smoothing node, to act like AFNI's blur in mask functionality.
+    Node to perform high and/or low-pass filtering with a 5th order zero-phase butterworth filter, the same filter nltools and nilearn use. In-mask data are read into a float32 (time x voxels) array and filtered in blocks of voxels on a thread pool. If no low or high-pass cutoffs are provided, simply masks the data and returns as-is. This can be useful if the output is subsequently passed to a smoothing node, to act like AFNI's blur in mask functionality.
 
     Args:
         in_file: file to filter
@@ -398,37 +700,200 @@ class Filter_In_Mask(BaseInterface):
         low_pass_cutoff: frequencies above this will be filtered; default 0.25hz
         high_pass_cutoff: frequenceies below this will be filtered; default None
         sampling_rate: TR in seconds
+        chunk_size: number of volumes read at a time; default 1
+        n_threads: number of filtering threads; default num_threads (the node's n_procs) if set, otherwise the number of cpus
 
     Returns:
-        out_file: filtered and masked data
+        out_file: filtered and masked data; written in the same (.nii or .nii.gz) format as in_file
     """
 
     input_spec = Filter_In_Mask_InputSpec
     output_spec = Filter_In_Mask_OutputSpec
 
     def _run_interface(self, runtime):
-        from nltools.data import Brain_Data
+        import nibabel as nib
         import os
+        from nipype.utils.filemanip import split_filename
+        from .filters import butterworth_filter, load_mask, load_masked_series
+        from .nifti import NiftiVolumeWriter
         in_file = self.inputs.in_file
-        mask = self.inputs.mask
         low_pass = self.inputs.low_pass_cutoff
         high_pass = self.inputs.high_pass_cutoff
         TR = self.inputs.sampling_rate
+        n_threads = self._n_threads()
 
         if low_pass == 0:
             low_pass = None
         if high_pass == 0:
             high_pass = None
 
-        dat = Brain_Data(in_file, mask=mask)
+        img = nib.load(in_file)
+        mask_idx = load_mask(self.inputs.mask, img.shape[:3])
+        series = load_masked_series(in_file, mask_idx, self.inputs.chunk_size)
         # Handle no filtering
         if low_pass or high_pass:
-            dat = dat.filter(sampling_rate=TR, low_pass=low_pass,high_pass=high_pass)
+            butterworth_filter(series, TR, low_pass=low_pass, high_pass=high_pass, n_threads=n_threads)
+
+        hdr = img.header.copy()
+        hdr.set_data_dtype(np.float32)
+        hdr.set_slope_inter(1, 0)
+        hdr.set_data_shape(img.shape[:3] + (series.shape[0],))
+
+        # Generate output file name; keeps the (un)compressed format of the input
+        _, name, ext = split_filename(in_file)
+        out_file = name + '_filtered' + ext
+        vol = np.zeros(img.shape[:3], dtype=np.float32)
+        with NiftiVolumeWriter(out_file, hdr, n_threads=n_threads) as writer:
+            for t in range(series.shape[0]):
+                vol[mask_idx] = series[t]
+                writer.write(vol[..., np.newaxis])
+
+        self._out_file = out_file
 
-        # Generate output file name
-        out_file = os.path.split(
-            in_file)[-1].split('.nii.gz')[0] + '_filtered.nii.gz'
-        dat.write(out_file)
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["out_file"] = os.path.abspath(self._out_file)
+        return outputs
+
+
+class Smooth_In_Mask_InputSpec(Preproc_InputSpec):
+    in_file = File(exists=True, mandatory=True)
+    mask = File(exists=True, mandatory=True)
+    fwhm = traits.List(traits.Either(traits.Int(), traits.Float()), mandatory=True)
+    chunk_size = traits.Int(1, usedefault=True)
+    n_threads = traits.Int()
+
+
+class Smooth_In_Mask_OutputSpec(TraitedSpec):
+    smoothed_files = traits.List(File(exists=True))
+
+
+class Smooth_In_Mask(Preproc_Interface):
+    """
+    Node to smooth data within a mask, like AFNI's 3dBlurInMask, as a native alternative to FSL's Smooth. Voxels outside the mask don't contribute and each smoothed volume is normalized by the smoothed mask, so signal doesn't bleed across the brain boundary. Volumes are smoothed with separable Gaussian kernels in float32 on a thread pool. Multiple FWHMs are all produced from a single read of the data.
+
+    Args:
+        in_file: file to smooth
+        mask: mask to smooth within; typically something like MNI152 brain mask
+        fwhm: list of smoothing kernel FWHMs in mm
+        chunk_size: number of volumes read at a time; default 1
+        n_threads: number of smoothing threads; default num_threads (the node's n_procs) if set, otherwise the number of cpus
+
+    Returns:
+        smoothed_files: smoothed data, one file per fwhm, written in the same (.nii or .nii.gz) format as in_file; with more than one fwhm each is put in a _fwhm_<fwhm> folder
+    """
+
+    input_spec = Smooth_In_Mask_InputSpec
+    output_spec = Smooth_In_Mask_OutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nib
+        import os
+        from contextlib import ExitStack
+        from nipype.utils.filemanip import split_filename
+        from .filters import fwhm_to_sigma, load_mask, smooth_volumes
+        from .nifti import iter_volumes, NiftiVolumeWriter
+        in_file = self.inputs.in_file
+        fwhms = self.inputs.fwhm
+
+        img = nib.load(in_file)
+        mask_idx = load_mask(self.inputs.mask, img.shape[:3])
+        sigmas = [fwhm_to_sigma(fwhm, img.header.get_zooms()) for fwhm in fwhms]
+        hdr = img.header.copy()
+        hdr.set_data_dtype(np.float32)
+        hdr.set_slope_inter(1, 0)
+
+        _, name, ext = split_filename(in_file)
+        out_files = []
+        for fwhm in fwhms:
+            if len(fwhms) > 1:
+                os.makedirs('_fwhm_' + str(fwhm), exist_ok=True)
+                out_files.append(os.path.join('_fwhm_' + str(fwhm), name + '_smooth' + ext))
+            else:
+                out_files.append(name + '_smooth' + ext)
+
+        def volumes():
+            for start, block in iter_volumes(in_file, self.inputs.chunk_size):
+                for i in range(block.shape[-1]):
+                    yield start + i, block[..., i]
+
+        n_threads = self._n_threads()
+        with ExitStack() as stack:
+            writers = [stack.enter_context(NiftiVolumeWriter(out_file, hdr, n_threads=n_threads)) for out_file in out_files]
+            for _, outs in smooth_volumes(volumes(), sigmas, mask_idx, n_threads):
+                for writer, out in zip(writers, outs):
+                    writer.write(out[..., np.newaxis])
+
+        self._out_files = out_files
+
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["smoothed_files"] = [os.path.abspath(f) for f in self._out_files]
+        return outputs
+
+
+class Filter_Smooth_Down_Sample_InputSpec(Preproc_InputSpec):
+    in_file = File(exists=True, mandatory=True)
+    mask = File(exists=True)
+    low_pass_cutoff = traits.Float(0, usedefault=True)
+    high_pass_cutoff = traits.Float(0, usedefault=True)
+    smooth_mask = File(exists=True)
+    sampling_rate = traits.Float()
+    fwhm = traits.Float(0, usedefault=True)
+    data_type = traits.Str("int16", usedefault=True)
+    scale = traits.Bool(True, usedefault=True)
+    chunk_size = traits.Int(1, usedefault=True)
+    n_threads = traits.Int()
+
+
+class Filter_Smooth_Down_Sample_OutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+class Filter_Smooth_Down_Sample(Preproc_Interface):
+    """
+    Node that performs the final stage of a workflow in one pass: masking and Butterworth filtering (like Filter_In_Mask), Gaussian smoothing (like FSL's Smooth) and reduction of precision (like Down_Sample_Precision). The run is read once and only the final file is written, instead of reading and writing a full 4D image between each step. Steps whose settings are 0 or not provided are skipped.
+
+    Args:
+        in_file: file to process
+        mask: mask to apply to data before filtering/smoothing; typically something like MNI152 mask
+        low_pass_cutoff: frequencies above this will be filtered; default 0 (no filtering)
+        high_pass_cutoff: frequencies below this will be filtered; default 0 (no filtering)
+        sampling_rate: TR in seconds; required if filtering
+        smooth_mask: mask to smooth within, normalizing by the smoothed mask like Smooth_In_Mask; default smooths the whole field of view like FSL's Smooth
+        fwhm: smoothing kernel FWHM in mm; default 0 (no smoothing)
+        data_type: output data type; default 'int16'
+        scale: compute optimal scale factors for integer data types; if False values are simply truncated; default True
+        chunk_size: number of volumes read into memory at a time; default 1
+        n_threads: number of filtering and smoothing threads; default num_threads (the node's n_procs) if set, otherwise the number of cpus
+
+    Returns:
+        out_file: processed file
+    """
+
+    input_spec = Filter_Smooth_Down_Sample_InputSpec
+    output_spec = Filter_Smooth_Down_Sample_OutputSpec
+
+    def _run_interface(self, runtime):
+        import os
+        from .filters import write_final_stage
+        low_pass = self.inputs.low_pass_cutoff or None
+        fwhm = self.inputs.fwhm or None
+        mask = self.inputs.mask if isdefined(self.inputs.mask) else None
+
+        out_file = _final_stage_name(self.inputs.in_file, mask is not None, fwhm, self.inputs.data_type)
+        write_final_stage(self.inputs.in_file, {(low_pass, fwhm): out_file}, mask=mask,
+                          sampling_rate=self.inputs.sampling_rate if isdefined(self.inputs.sampling_rate) else None,
+                          high_pass=self.inputs.high_pass_cutoff or None, data_type=self.inputs.data_type,
+                          smooth_mask=self.inputs.smooth_mask if isdefined(self.inputs.smooth_mask) else None,
+                          scale=self.inputs.scale, chunk_size=self.inputs.chunk_size,
+                          n_threads=self._n_threads())
 
         self._out_file = out_file
 
@@ -441,43 +906,219 @@ class Filter_In_Mask(BaseInterface):
         return outputs
 
 
-class Create_Covariates_InputSpec(TraitedSpec):
+def _final_stage_name(in_file, masked, fwhm, data_type):
+    """ Output file name for the final stage, the same as the separate filter, smooth and down sample nodes would give. """
+
+    from nipype.utils.filemanip import split_filename
+    _, name, _ = split_filename(in_file)
+    if masked:
+        name += '_filtered'
+    if fwhm:
+        name += '_smooth'
+    return name + '_' + data_type + '.nii.gz'
+
+
+class Filter_Smooth_Down_Sample_Grid_InputSpec(Preproc_InputSpec):
+    in_file = File(exists=True, mandatory=True)
+    mask = File(exists=True)
+    low_pass_cutoff = traits.List(traits.Either(traits.Int(), traits.Float()), [0], usedefault=True)
+    high_pass_cutoff = traits.Float(0, usedefault=True)
+    smooth_mask = File(exists=True)
+    sampling_rate = traits.Float()
+    fwhm = traits.List(traits.Either(traits.Int(), traits.Float()), [0], usedefault=True)
+    data_type = traits.Str("int16", usedefault=True)
+    scale = traits.Bool(True, usedefault=True)
+    chunk_size = traits.Int(1, usedefault=True)
+    n_threads = traits.Int()
+    parameterize = traits.Bool(True, usedefault=True)
+
+
+class Filter_Smooth_Down_Sample_Grid_OutputSpec(TraitedSpec):
+    out_files = traits.List(traits.Either(File(exists=True), traits.Directory(exists=True)))
+
+
+class Filter_Smooth_Down_Sample_Grid(Preproc_Interface):
+    """
+    Node like Filter_Smooth_Down_Sample that produces every combination of a list of low-pass cutoffs and a list of smoothing kernels in one go, instead of running the final stage once per combination with nipype iterables. The run is read once, each cutoff is filtered once and reused for all kernels, and each volume is smoothed once with every kernel of its cutoff (see filters.write_final_stage).
+
+    When more than one cutoff or kernel is requested, outputs are written into the same _low_pass_cutoff_<cutoff>/_fwhm_<fwhm> folders nipype iterables would create, and out_files lists the top level folders; passing them to a DataSink gives the same layout iterables would.
+
+    Args:
+        in_file: file to process
+        mask: mask to apply to data before filtering/smoothing; typically something like MNI152 mask
+        low_pass_cutoff: list of low-pass cutoffs; 0 means no filtering; default [0]
+        high_pass_cutoff: frequencies below this will be filtered; default 0 (no filtering)
+        sampling_rate: TR in seconds; required if filtering
+        smooth_mask: mask to smooth within, normalizing by the smoothed mask like Smooth_In_Mask; default smooths the whole field of view like FSL's Smooth
+        fwhm: list of smoothing kernel FWHMs in mm; 0 means no smoothing; default [0]
+        data_type: output data type; default 'int16'
+        scale: compute optimal scale factors for integer data types; if False values are simply truncated; default True
+        chunk_size: number of volumes read into memory at a time; default 1
+        n_threads: number of filtering and smoothing threads; default num_threads (the node's n_procs) if set, otherwise the number of cpus
+        parameterize: write outputs into iterable-style folders when there is more than one cutoff or kernel; default True
+
+    Returns:
+        out_files: processed files, or the top level folders containing them
+    """
+
+    input_spec = Filter_Smooth_Down_Sample_Grid_InputSpec
+    output_spec = Filter_Smooth_Down_Sample_Grid_OutputSpec
+
+    def _run_interface(self, runtime):
+        import os
+        from collections import OrderedDict
+        from .filters import write_final_stage
+        mask = self.inputs.mask if isdefined(self.inputs.mask) else None
+        cutoffs = self.inputs.low_pass_cutoff
+        fwhms = self.inputs.fwhm
+
+        out_files = OrderedDict()
+        top_level = []
+        for low_pass in cutoffs:
+            for fwhm in fwhms:
+                folders = []
+                if self.inputs.parameterize and len(cutoffs) > 1:
+                    folders.append('_low_pass_cutoff_' + str(low_pass))
+                if self.inputs.parameterize and len(fwhms) > 1:
+                    folders.append('_fwhm_' + str(fwhm))
+                if folders:
+                    os.makedirs(os.path.join(*folders), exist_ok=True)
+                out_file = os.path.join(*(folders + [_final_stage_name(self.inputs.in_file, mask is not None, fwhm, self.inputs.data_type)]))
+                out_files[(low_pass or None, fwhm or None)] = out_file
+                top = folders[0] if folders else out_file
+                if top not in top_level:
+                    top_level.append(top)
+
+        write_final_stage(self.inputs.in_file, out_files, mask=mask,
+                          sampling_rate=self.inputs.sampling_rate if isdefined(self.inputs.sampling_rate) else None,
+                          high_pass=self.inputs.high_pass_cutoff or None, data_type=self.inputs.data_type,
+                          smooth_mask=self.inputs.smooth_mask if isdefined(self.inputs.smooth_mask) else None,
+                          scale=self.inputs.scale, chunk_size=self.inputs.chunk_size,
+                          n_threads=self._n_threads())
+
+        self._out_files = top_level
+
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["out_files"] = [os.path.abspath(f) for f in self._out_files]
+        return outputs
+
+
+class Compute_CompCor_InputSpec(Preproc_InputSpec):
+    in_file = File(exists=True, mandatory=True)
+    segmentation = File(exists=True, mandatory=True)
+    components_type = traits.List(traits.Enum('acompcor', 'tcompcor'), ['acompcor'], usedefault=True)
+    n_components = traits.Int(5, usedefault=True)
+    labels = traits.List(traits.Int(), [1, 3], usedefault=True)
+    erode = traits.Int(0, usedefault=True)
+    tcompcor_fraction = traits.Float(.02, usedefault=True)
+    chunk_size = traits.Int(1, usedefault=True)
+
+
+class Compute_CompCor_OutputSpec(TraitedSpec):
+    components_file = File(exists=True)
+    variance_file = File(exists=True)
+
+
+class Compute_CompCor(Preproc_Interface):
+    """
+    Node to compute anatomical (aCompCor) and/or temporal (tCompCor) CompCor noise regressors. Noise voxels are read into a float32 (time x voxels) array, detrended and variance normalized, and their top components are found with a randomized truncated SVD computed a block of voxels at a time.
+
+    Args:
+        in_file: 4D file, typically the normalized run
+        segmentation: tissue segmentation in the same space as in_file, e.g. the ANTs segmentation in MNI space
+        components_type: list of 'acompcor' and/or 'tcompcor'; default ['acompcor']
+        n_components: number of components of each type; default 5
+        labels: segmentation labels of noise tissues for aCompCor; default [1, 3], i.e. CSF and white matter for ANTs
+        erode: number of erosions of the aCompCor noise mask; default 0
+        tcompcor_fraction: fraction of brain voxels with the highest variance used for tCompCor; default .02
+        chunk_size: number of volumes read at a time; default 1
+
+    Returns:
+        components_file: csv file with columns acompcor1..n and/or tcompcor1..n
+        variance_file: json file of the variance explained by each component
+    """
+
+    input_spec = Compute_CompCor_InputSpec
+    output_spec = Compute_CompCor_OutputSpec
+
+    def _run_interface(self, runtime):
+        import json
+        from .compcor import compute_compcor
+        regressors, variance_explained = compute_compcor(self.inputs.in_file, self.inputs.segmentation,
+                                                         components_type=self.inputs.components_type,
+                                                         n_components=self.inputs.n_components,
+                                                         labels=self.inputs.labels, erode=self.inputs.erode,
+                                                         fraction=self.inputs.tcompcor_fraction,
+                                                         chunk_size=self.inputs.chunk_size)
+        self._components_file = 'compcor.csv'
+        regressors.to_csv(self._components_file, index=False)
+        self._variance_file = 'compcor_variance.json'
+        with open(self._variance_file, 'w') as f:
+            json.dump(variance_explained, f, indent=4)
+
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["components_file"] = os.path.abspath(self._components_file)
+        outputs["variance_file"] = os.path.abspath(self._variance_file)
+        return outputs
+
+
+class Create_Covariates_InputSpec(Preproc_InputSpec):
     realignment_parameters = File(exists=True, mandatory=True)
     spike_id = File(exists=True, mandatory=True)
     fd_outliers = File(exists=True)
+    compcor = File(exists=True)
+    spike_format = traits.Enum('dense', 'index', usedefault=True)
 
 
 class Create_Covariates_OutputSpec(TraitedSpec):
     covariates = File(exists=True)
+    covariates_npz = File(exists=True)
+    spike_index = File()
 
 
-class Create_Covariates(BaseInterface):
+class Create_Covariates(Preproc_Interface):
+    """
+    Node to create a covariates file of 24 motion regressors (mean centered realignment parameters, their squares, derivatives and squared derivatives), optional CompCor regressors and one-hot spike regressors for ART and FD outliers. Volumes that are both an ART and an FD outlier only get a spike regressor.
+
+    Args:
+        realignment_parameters: realignment parameter file
+        spike_id: ART outlier file
+        fd_outliers: FD outlier file
+        compcor: CompCor components file from Compute_CompCor; its columns are added after the motion regressors
+        spike_format: 'dense' adds spike regressors to the covariates file as columns; 'index' leaves them out and instead writes spike_index.json with the name and volume of each regressor, which can be loaded as a sparse matrix with cosanlab_preproc.covariates.load_spike_index; default 'dense'
+
+    Returns:
+        covariates: covariates csv file
+        covariates_npz: the same covariates as float32 in binary form, with spike regressors stored as volume indices; load with cosanlab_preproc.covariates.load_covariates, which memory-maps them
+        spike_index: spike index json file if spike_format is 'index'
+    """
+
     input_spec = Create_Covariates_InputSpec
     output_spec = Create_Covariates_OutputSpec
 
     def _run_interface(self, runtime):
-        ra = pd.read_table(self.inputs.realignment_parameters, header=None,
-                           sep=r"\s*", names=['ra' + str(x) for x in range(1, 7)])
-        spike = pd.read_table(self.inputs.spike_id,
-                              header=None, names=['Spikes'])
-        fd = pd.read_table(self.inputs.fd_outliers, header=None, names=['FDs'])
-
-        ra = ra - ra.mean()  # mean center
-        ra[['rasq' + str(x) for x in range(1, 7)]] = ra**2  # add squared
-        ra[['radiff' + str(x) for x in range(1, 7)]
-           ] = pd.DataFrame(ra[ra.columns[0:6]].diff())  # derivative
-        ra[['radiffsq' + str(x) for x in range(1, 7)]] = pd.DataFrame(
-            ra[ra.columns[0:6]].diff())**2  # derivatives squared
-
-        # build spike regressors
-        for i, loc in enumerate(spike['Spikes']):
-            ra['spike' + str(i + 1)] = 0
-            ra['spike' + str(i + 1)].iloc[int(loc)] = 1
-
-        # build FD regressors
-        for i, loc in enumerate(fd['FDs']):
-            ra['FD' + str(i + 1)] = 0
-            ra['FD' + str(i + 1)].iloc[int(loc)] = 1
+        from .covariates import read_indices, motion_regressors, merge_spikes, spike_regressors, save_spike_index, save_covariates
+        ra = motion_regressors(self.inputs.realignment_parameters)
+        if isdefined(self.inputs.compcor):
+            ra = pd.concat([ra, pd.read_csv(self.inputs.compcor)], axis=1)
+        spikes = read_indices(self.inputs.spike_id)
+        fds = read_indices(self.inputs.fd_outliers) if isdefined(self.inputs.fd_outliers) else []
+        columns, index = merge_spikes(spikes, fds)
+        self._covariates_npz = save_covariates('covariates.npz', ra, columns, index)
+
+        self._spike_index = None
+        if self.inputs.spike_format == 'dense':
+            ra = pd.concat([ra, spike_regressors(len(ra), columns, index)], axis=1)
+        else:
+            self._spike_index = save_spike_index('spike_index.json', len(ra), columns, index)
 
         filename = 'covariates.csv'
         ra.to_csv(filename, index=False)  # write out to file
@@ -489,9 +1130,12 @@ class Create_Covariates(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs["covariates"] = os.path.abspath(self._covariates)
+        outputs["covariates_npz"] = os.path.abspath(self._covariates_npz)
+        if self._spike_index:
+            outputs["spike_index"] = os.path.abspath(self._spike_index)
         return outputs
 
-class Create_Encoding_File_InputSpec(TraitedSpec):
+class Create_Encoding_File_InputSpec(Preproc_InputSpec):
     fmaps = traits.List()
     fmap_pes = traits.List()
     totalReadoutTimes = traits.List()
@@ -501,7 +1145,7 @@ class Create_Encoding_File_InputSpec(TraitedSpec):
 class Create_Encoding_File_OutputSpec(TraitedSpec):
     encoding_file = traits.File()
 
-class Create_Encoding_File(BaseInterface):
+class Create_Encoding_File(Preproc_Interface):
     """
     Create_Encoding_File interface creates encoding file necessary for FSL TOPUP interface.
     Args:
@@ -537,3 +1181,61 @@ class Create_Encoding_File(BaseInterface):
         outputs = self._outputs().get()
         outputs["encoding_file"] =os.path.abspath(self._encoding_file)
         return outputs
+
+class Link_DataSink_InputSpec(DataSinkInputSpec):
+    link_mode = traits.Enum('hardlink', 'reflink', 'copy', usedefault=True, desc="how outputs are put in base_directory: 'hardlink', 'reflink' or 'copy'; links fall back to copying across filesystems")
+
+class Link_DataSink(DataSink):
+    """
+    DataSink that links outputs into base_directory instead of copying them, so large 4D outputs don't take up disk space twice. Output paths, container and substitutions work exactly as with DataSink; directories are linked file by file. S3 base directories and local_copy are handled by DataSink.
+    Args:
+        link_mode: 'hardlink' makes final outputs other names for the intermediate files (writing to one changes the other); 'reflink' makes copy-on-write clones where the filesystem supports it (e.g. btrfs, XFS); 'copy' always copies; links fall back to copying when the filesystems differ; default 'hardlink'
+    Returns:
+        out_file: paths of the outputs in base_directory
+    """
+    input_spec = Link_DataSink_InputSpec
+
+    def _list_outputs(self):
+        import shutil
+        from nipype.utils.filemanip import ensure_list
+        from .utils import link_file
+
+        if self._check_s3_base_dir()[0] or isdefined(self.inputs.local_copy):
+            return super(Link_DataSink, self)._list_outputs()
+
+        outdir = self.inputs.base_directory if isdefined(self.inputs.base_directory) else '.'
+        if isdefined(self.inputs.container):
+            outdir = os.path.join(outdir, self.inputs.container)
+        outdir = os.path.abspath(outdir)
+
+        out_files = []
+        for key, files in list(self.inputs._outputs.items()):
+            if not isdefined(files):
+                continue
+            files = ensure_list(files)
+            if isinstance(files[0], list):
+                files = [f for sublist in files for f in sublist]
+            keydir = os.path.join(outdir, *[d for d in key.split('.') if d[0] != '@'])
+
+            for src in files:
+                src = os.path.abspath(src)
+                if not os.path.isfile(src):
+                    src = os.path.join(src, '')
+                dst = self._substitute(os.path.join(keydir, self._get_dst(src)))
+                if os.path.isfile(src):
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    link_file(src, dst, self.inputs.link_mode)
+                    out_files.append(dst)
+                elif os.path.isdir(src):
+                    if os.path.exists(dst) and self.inputs.remove_dest_dir:
+                        shutil.rmtree(dst)
+                    for root, dirs, names in os.walk(src):
+                        target = os.path.join(dst, os.path.relpath(root, src))
+                        os.makedirs(target, exist_ok=True)
+                        for name in names:
+                            link_file(os.path.join(root, name), os.path.join(target, name), self.inputs.link_mode)
+                    out_files.append(dst)
+
+        outputs = self.output_spec().get()
+        outputs['out_file'] = out_files
+        return outputs
@@ -0,0 +1,316 @@
+from __future__ import division
+
+'''
+Preproc NIfTI Helpers
+=====================
+
+Low-level helpers for reading and writing NIfTI files without holding full 4D runs in memory
+
+'''
+
+__all__ = ['is_compressed', 'load_header', 'clear_header_cache', 'iter_volumes', 'get_scaling', 'NiftiVolumeWriter', 'ParallelGzipFile', 'save_nifti']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import nibabel as nib
+from .instrument import phase
+from .utils import get_n_threads
+
+# Defaults for gzip compressed outputs; can be set per process through the environment, e.g. for MultiProc workers
+gzip_compresslevel = int(os.environ.get('COSANLAB_PREPROC_GZIP_LEVEL', 1))
+gzip_threads = int(os.environ.get('COSANLAB_PREPROC_GZIP_THREADS', 0)) or None
+gzip_block_size = 1 << 20
+
+# Process-wide cache of headers read by load_header
+header_cache_size = 4096
+_header_cache = OrderedDict()
+_header_cache_lock = threading.Lock()
+
+
+def is_compressed(in_file):
+    """ Whether a file is gzip compressed and therefore can't be memory-mapped. """
+
+    return str(in_file).endswith('.gz')
+
+
+def _read_header(in_file):
+    """ Read a NIfTI header, only decompressing the first 348 (NIfTI-1) or 540 (NIfTI-2) bytes of .nii.gz files. Other formats fall back to nibabel. """
+
+    import io
+    import gzip
+    import struct
+
+    opener = gzip.open if is_compressed(in_file) else open
+    with opener(in_file, 'rb') as f:
+        raw = f.read(540)
+    if len(raw) >= 348:
+        for header_class in [nib.Nifti1Header, nib.Nifti2Header]:
+            size = header_class.sizeof_hdr
+            if len(raw) >= size and size in struct.unpack('<i', raw[:4]) + struct.unpack('>i', raw[:4]):
+                return header_class.from_fileobj(io.BytesIO(raw[:size]), check=False)
+    return nib.load(in_file).header
+
+
+def load_header(in_file):
+    """
+    Get the header of an image without loading it. Headers are kept in a process-wide LRU cache keyed on the file's path, size and modification time, so helpers that each need a header field only read a file once, and a file that is rewritten is read again. For .nii.gz files only the header bytes are decompressed.
+
+    Args:
+        in_file: image file path
+
+    Returns:
+        header: a copy of the image's header
+
+    """
+
+    stat = os.stat(in_file)
+    key = (os.path.abspath(in_file), stat.st_size, stat.st_mtime_ns)
+    with _header_cache_lock:
+        header = _header_cache.get(key)
+        if header is not None:
+            _header_cache.move_to_end(key)
+    if header is None:
+        header = _read_header(in_file)
+        with _header_cache_lock:
+            _header_cache[key] = header
+            while len(_header_cache) > header_cache_size:
+                _header_cache.popitem(last=False)
+    return header.copy()
+
+
+def clear_header_cache():
+    """ Empty the header cache used by load_header. """
+
+    with _header_cache_lock:
+        _header_cache.clear()
+
+
+def iter_volumes(in_file, chunk_size=1, dtype=np.float32):
+    """
+    Iterate over a 3D/4D NIfTI file a block of volumes at a time. Uncompressed files are memory-mapped so only the pages of the current block are read. Compressed files are read through nibabel's array proxy with the file handle kept open, so a .nii.gz is decompressed sequentially exactly once. Either way only chunk_size volumes are ever held in memory. Scale factors in the header are applied.
+
+    Args:
+        in_file: nifti file path
+        chunk_size: number of volumes to read per block; default 1
+        dtype: dtype of the returned blocks; default float32
+
+    Yields:
+        start: index of the first volume in the block
+        block: array of shape (x, y, z, n) with n <= chunk_size
+
+    """
+
+    if is_compressed(in_file):
+        img = nib.load(in_file, keep_file_open=True)
+
+        def read(idx):
+            return np.asarray(img.dataobj[idx], dtype=dtype)
+    else:
+        img = nib.load(in_file, mmap='r')
+        raw = img.dataobj.get_unscaled()
+        slope, inter = img.dataobj.slope, img.dataobj.inter
+
+        def read(idx):
+            block = np.asarray(raw[idx], dtype=dtype)
+            if slope != 1 or inter != 0:
+                block = (block * slope + inter).astype(dtype, copy=False)
+            return block
+
+    if len(img.shape) < 4:
+        with phase('load'):
+            block = read(Ellipsis)[..., np.newaxis]
+        yield 0, block
+        return
+    n_vols = img.shape[3]
+    for start in range(0, n_vols, chunk_size):
+        stop = min(start + chunk_size, n_vols)
+        with phase('load'):
+            block = read((Ellipsis, slice(start, stop)))
+        yield start, block
+
+
+def get_scaling(data_min, data_max, data_type):
+    """
+    Get the NIfTI scale factors that map [data_min, data_max] onto the full range of an integer data type, so that low-amplitude data keeps as much precision as possible.
+
+    Args:
+        data_min: minimum of the data
+        data_max: maximum of the data
+        data_type: integer output data type, e.g. 'int16'
+
+    Returns:
+        slope, inter: scl_slope and scl_inter such that data = stored * slope + inter
+
+    """
+
+    info = np.iinfo(np.dtype(data_type))
+    if not np.isfinite(data_min) or not np.isfinite(data_max) or data_max == data_min:
+        return 1.0, float(data_min) if np.isfinite(data_min) else 0.0
+    slope = (float(data_max) - float(data_min)) / (float(info.max) - float(info.min))
+    inter = float(data_min) - float(info.min) * slope
+    return slope, inter
+
+
+class ParallelGzipFile(object):
+    """
+    Write-only gzip file that compresses independent blocks on a thread pool, like pigz. Each block is written as its own gzip member; concatenated members are a valid gzip stream that any gzip reader (including nibabel and python's gzip module) decompresses as one file. zlib releases the GIL so blocks are compressed in parallel.
+
+    Supports the subset of the file interface nibabel needs to write images: write, tell, forward seek and close.
+
+    Args:
+        filename: output file name
+        compresslevel: zlib compression level; default gzip_compresslevel (1, the same as nibabel)
+        n_threads: number of compression threads; default the enclosing limit_threads context's limit (a node's n_procs), otherwise gzip_threads (number of cpus)
+        block_size: uncompressed bytes per gzip member; default 1MB
+
+    """
+
+    def __init__(self, filename, compresslevel=None, n_threads=None, block_size=None):
+        from concurrent.futures import ThreadPoolExecutor
+        from collections import deque
+        self.name = filename
+        self.mode = 'wb'
+        self.compresslevel = gzip_compresslevel if compresslevel is None else compresslevel
+        self.n_threads = get_n_threads(n_threads, default=gzip_threads)
+        self.block_size = block_size or gzip_block_size
+        self._fobj = open(filename, 'wb')
+        self._pool = ThreadPoolExecutor(max_workers=self.n_threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._pos = 0
+        self.closed = False
+
+    def _submit(self, data):
+        import gzip
+        self._pending.append(self._pool.submit(gzip.compress, bytes(data), self.compresslevel, mtime=0))
+        # Bound the number of blocks in flight so memory use stays constant
+        while len(self._pending) > 2 * self.n_threads:
+            self._fobj.write(self._pending.popleft().result())
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self._pos += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def read(self, *args):
+        raise OSError("ParallelGzipFile is write-only")
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence != 0:
+            raise OSError("Can only seek from the start or current position when writing")
+        if offset < self._pos:
+            raise OSError("Can't seek backwards when writing a gzip file")
+        if offset > self._pos:
+            self.write(b'\x00' * (offset - self._pos))
+        return self._pos
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        if self._buffer:
+            self._submit(self._buffer)
+            self._buffer = bytearray()
+        while self._pending:
+            self._fobj.write(self._pending.popleft().result())
+        self._pool.shutdown()
+        self._fobj.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_for_writing(out_file, compresslevel=None, n_threads=None):
+    """ Open out_file for writing, with parallel compression if it ends in .gz. """
+
+    if out_file.endswith('.gz'):
+        return ParallelGzipFile(out_file, compresslevel=compresslevel, n_threads=n_threads)
+    return open(out_file, 'wb')
+
+
+def save_nifti(img, out_file, compresslevel=None, n_threads=None):
+    """
+    Save a nibabel image like img.to_filename, but compress .nii.gz files in parallel with ParallelGzipFile.
+
+    Args:
+        img: nibabel Nifti1Image
+        out_file: output file name
+        compresslevel: zlib compression level; default gzip_compresslevel
+        n_threads: number of compression threads; default as ParallelGzipFile
+
+    Returns:
+        out_file: output file name
+
+    """
+
+    with phase('write'), open_for_writing(out_file, compresslevel, n_threads) as fobj:
+        img.to_file_map({'image': nib.FileHolder(filename=out_file, fileobj=fobj)})
+    return out_file
+
+
+class NiftiVolumeWriter(object):
+    """
+    Write a NIfTI file a block of volumes at a time so a 4D run never has to be held in memory. The header determines the output shape, data type and scale factors; blocks are scaled, rounded and clipped to the header's data type as they are written. .nii.gz files are compressed in parallel with ParallelGzipFile.
+
+    Examples:
+
+        >>> with NiftiVolumeWriter('out.nii.gz', header) as writer:
+        >>>     for start, block in iter_volumes('in.nii.gz'):
+        >>>         writer.write(block)
+
+    """
+
+    def __init__(self, out_file, header, compresslevel=None, n_threads=None):
+        self.out_file = out_file
+        self.compresslevel = compresslevel
+        self.n_threads = n_threads
+        self.header = header.copy()
+        self.dtype = self.header.get_data_dtype()
+        slope, inter = self.header.get_slope_inter()
+        self.slope = 1.0 if slope is None else slope
+        self.inter = 0.0 if inter is None else inter
+        self._fobj = None
+
+    def __enter__(self):
+        self._fobj = open_for_writing(self.out_file, self.compresslevel, self.n_threads)
+        self.header.write_to(self._fobj)
+        self._fobj.write(b'\x00' * (int(self.header.get_data_offset()) - self._fobj.tell()))
+        return self
+
+    def write(self, block):
+        """ Write an (x, y, z, n) block of volumes following those already written. """
+
+        from nibabel.volumeutils import array_to_file
+        with phase('write'):
+            # Zero NaNs up front; nibabel's nan2zero refuses scale factors that can't represent 0, e.g. for data far from 0
+            if block.dtype.kind == 'f' and np.isnan(block).any():
+                block = np.nan_to_num(block)
+            array_to_file(block, self._fobj, self.dtype, offset=None,
+                          intercept=self.inter, divslope=self.slope, order='F', nan2zero=False)
+
+    def __exit__(self, *args):
+        with phase('write'):
+            self._fobj.close()
+        self._fobj = None
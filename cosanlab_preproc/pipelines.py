@@ -893,9 +893,8 @@ def ScanParams_Preproc_Pipeline(base_dir=None, output_dir=None, subject_id=None,
         '''
         Gets TR length of scan by reading in the nifti header.
         '''
-        import nibabel as nib
-        f = nib.load(fName)
-        return round(f.header.get_zooms()[-1]*1000)/1000
+        from cosanlab_preproc.nifti import load_header
+        return round(load_header(fName).get_zooms()[-1]*1000)/1000
 
     get_tr = Node(interface=Function(input_names=['fName'],
                                      output_names=['TR'],
@@ -0,0 +1,396 @@
+from __future__ import division
+
+'''
+Preproc Quality Control
+=======================
+
+Bounded-memory computation of run-level signal quality metrics and artifacts
+
+'''
+
+__all__ = ['compute_qc_metrics', 'compute_run_statistics', 'compute_mean_mask', 'detect_art_outliers', 'find_outliers', 'save_qc_metrics', 'load_qc_metrics', 'qc_image_files', 'plot_qc_metrics']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+import numpy as np
+import nibabel as nib
+from .nifti import is_compressed, iter_volumes, save_nifti
+
+
+def find_outliers(x, cutoff):
+    """ Get indices of values more than cutoff standard deviations above or below the mean. """
+
+    return np.append(np.where(x > np.mean(x) + np.std(x) * cutoff),
+                     np.where(x < np.mean(x) - np.std(x) * cutoff))
+
+
+class _QCAccumulator(object):
+    """ Running voxel-wise and global signal statistics within a mask, updated one volume at a time. """
+
+    def __init__(self, mask, n_vols):
+        self.mask = mask
+        self.mask_idx = np.asarray(mask.dataobj).astype(bool)
+        self.n_vols = n_vols
+        n_vox = int(self.mask_idx.sum())
+        self.vox_mean = np.zeros(n_vox, dtype=np.float64)
+        self.vox_m2 = np.zeros(n_vox, dtype=np.float64)
+        self.global_mn = np.zeros(n_vols, dtype=np.float32)
+        self.global_sd = np.zeros(n_vols, dtype=np.float32)
+        self.frame_diff = np.zeros(max(n_vols - 1, 0), dtype=np.float32)
+        self.prev = None
+
+    def update(self, t, vol):
+        vol = vol[self.mask_idx]
+        self.global_mn[t] = np.mean(vol)
+        self.global_sd[t] = np.std(vol)
+        if self.prev is not None:
+            self.frame_diff[t - 1] = np.mean(np.abs(vol - self.prev))
+        self.prev = vol
+        delta = vol - self.vox_mean
+        self.vox_mean += delta / (t + 1)
+        self.vox_m2 += delta * (vol - self.vox_mean)
+
+    def _unmask(self, values):
+        out = np.zeros(self.mask_idx.shape, dtype=np.float32)
+        out[self.mask_idx] = values
+        return nib.Nifti1Image(out, self.mask.affine)
+
+    def result(self):
+        vox_sd = np.sqrt(self.vox_m2 / self.n_vols)
+        vox_tsnr = np.true_divide(self.vox_mean, vox_sd)
+        return {'mask': self.mask,
+                'mean': self._unmask(self.vox_mean),
+                'std': self._unmask(vox_sd),
+                'tsnr': self._unmask(vox_tsnr),
+                'global_mean': self.global_mn,
+                'global_std': self.global_sd,
+                'frame_diff': self.frame_diff}
+
+
+def compute_qc_metrics(in_file, mask=None, chunk_size=1):
+    """
+    Compute voxel-wise mean, std and tSNR, as well as the global signal mean, std and mean absolute frame-differences within a brain mask by streaming over the volumes of a run. Peak memory is O(voxels + TRs) rather than O(voxels x TRs): voxel-wise moments are accumulated in float64 using Welford's update and only the previous volume is kept around to compute frame-differences.
+
+    If no mask is provided one is computed with nilearn's compute_epi_mask on the mean image, which requires an additional pass over the data.
+
+    Args:
+        in_file: epi nifti file
+        mask: brain mask nifti file or image; default computed from the data
+        chunk_size: number of volumes to read at a time; default 1
+
+    Returns:
+        metrics: dict with 'mask', 'mean', 'std' and 'tsnr' (3D nifti images) as well as 'global_mean', 'global_std' (one value per TR) and 'frame_diff' (one value per successive pair of TRs)
+
+    """
+
+    from nilearn.masking import compute_epi_mask
+
+    img = nib.load(in_file)
+    affine = img.affine
+    n_vols = img.shape[3] if len(img.shape) > 3 else 1
+
+    if mask is None:
+        # nilearn defaults are lower = 0.2; upper = 0.85
+        total = np.zeros(img.shape[:3], dtype=np.float64)
+        for _, block in iter_volumes(in_file, chunk_size):
+            total += block.sum(axis=-1, dtype=np.float64)
+        mask = compute_epi_mask(nib.Nifti1Image(total / n_vols, affine))
+    elif isinstance(mask, str):
+        mask = nib.load(mask)
+
+    acc = _QCAccumulator(mask, n_vols)
+    for start, block in iter_volumes(in_file, chunk_size):
+        for i in range(block.shape[-1]):
+            acc.update(start + i, block[..., i])
+    return acc.result()
+
+
+def compute_mean_mask(mean_volume, m=0.2, M=0.9, cc=True, opening=2):
+    """
+    Compute a brain mask from a mean EPI volume the same way as nipy's compute_mask (used by nipype's ComputeMask): threshold at the largest gap in the sorted intensities between the m and M fractions, keep the largest connected component and apply a morphological opening.
+
+    Args:
+        mean_volume: 3D array
+        m: lower fraction of the sorted intensities to search for a threshold; default 0.2
+        M: upper fraction of the sorted intensities to search for a threshold; default 0.9
+        cc: keep only the largest connected component; default True
+        opening: number of binary opening iterations; default 2
+
+    Returns:
+        mask: 3D boolean array
+
+    """
+
+    from scipy import ndimage
+
+    sorted_input = np.sort(mean_volume.reshape(-1))
+    lower = int(np.floor(m * len(sorted_input)))
+    upper = int(np.floor(M * len(sorted_input)))
+    delta = sorted_input[lower + 1:upper + 1] - sorted_input[lower:upper]
+    ia = delta.argmax()
+    threshold = 0.5 * (sorted_input[ia + lower] + sorted_input[ia + lower + 1])
+    mask = mean_volume >= threshold
+    if cc:
+        labels, n_labels = ndimage.label(mask)
+        if n_labels > 1:
+            sizes = np.bincount(labels.ravel())
+            sizes[0] = 0
+            mask = labels == sizes.argmax()
+    if opening > 0:
+        mask = ndimage.binary_opening(mask.astype(int), iterations=opening)
+    return mask.astype(bool)
+
+
+def detect_art_outliers(global_intensity, realignment_parameters, use_differences=(True, False), norm_threshold=1, zintensity_threshold=3, parameter_source='FSL'):
+    """
+    Identify intensity and motion outliers the same way as nipype's rapidart ArtifactDetect with use_norm=True: the global intensity is detrended (and optionally differenced) and z-scored, and motion is summarized by the (optionally differenced) composite norm of the realignment parameters.
+
+    Args:
+        global_intensity: mean intensity within the brain mask for each TR
+        realignment_parameters: TRs x 6 array of realignment parameters
+        use_differences: use differences between successive motion (first element) and intensity (second element) estimates; default (True, False)
+        norm_threshold: motion norm threshold in mm; default 1
+        zintensity_threshold: intensity z-score threshold; default 3
+        parameter_source: software that produced the realignment parameters; default 'FSL'
+
+    Returns:
+        art: dict with 'outliers', 'intensity_outliers', 'motion_outliers', 'intensity_z' and 'norm'
+
+    """
+
+    from scipy import signal
+    from nipype.algorithms.rapidart import _calc_norm
+
+    g = np.asarray(global_intensity, dtype=np.float64).reshape(-1, 1)
+    gz = signal.detrend(g, axis=0)
+    if use_differences[1]:
+        gz = np.concatenate((np.zeros((1, 1)), np.diff(gz, n=1, axis=0)), axis=0)
+    gz = (gz - np.mean(gz)) / np.std(gz)
+    iidx = np.flatnonzero(abs(gz) > zintensity_threshold)
+
+    normval, _ = _calc_norm(np.asarray(realignment_parameters), use_differences[0], parameter_source)
+    tidx = np.flatnonzero(normval > norm_threshold)
+    ridx = np.flatnonzero(normval < 0)
+    motion_outliers = np.union1d(tidx, ridx)
+
+    return {'outliers': np.unique(np.union1d(iidx, motion_outliers)),
+            'intensity_outliers': iidx,
+            'motion_outliers': motion_outliers,
+            'intensity_z': gz,
+            'norm': normval}
+
+
+def compute_run_statistics(in_file, mask_fraction=0.05, chunk_size=1, spool_file='spool.dat'):
+    """
+    Compute everything needed from a realigned run in a single read of its (compressed) data: the mean EPI, a brain mask, the global intensity used for artifact detection and the QC metrics of compute_qc_metrics.
+
+    Because the masks depend on the mean image, volumes of a compressed run are spooled to an uncompressed float32 memory-mapped file while the mean is accumulated. The second pass then reads that file instead of decompressing the run again, so memory stays O(voxels + TRs). The spool file is removed before returning. Uncompressed runs are memory-mapped and read directly.
+
+    Args:
+        in_file: realigned epi nifti file
+        mask_fraction: lower fraction passed to compute_mean_mask for the brain mask; default 0.05
+        chunk_size: number of volumes to read at a time; default 1
+        spool_file: path of the temporary spool file; default 'spool.dat'
+
+    Returns:
+        mean: mean EPI nifti image
+        brain_mask: brain mask nifti image
+        global_intensity: mean intensity within the brain mask for each TR
+        metrics: dict as returned by compute_qc_metrics
+
+    """
+
+    import os
+    from nilearn.masking import compute_epi_mask
+
+    img = nib.load(in_file)
+    affine = img.affine
+    vol_shape = img.shape[:3]
+    n_vols = img.shape[3] if len(img.shape) > 3 else 1
+
+    # Uncompressed runs are memory-mapped so they can be read twice without spooling
+    spool = None
+    if is_compressed(in_file):
+        spool = np.memmap(spool_file, dtype=np.float32, mode='w+', shape=(n_vols,) + vol_shape)
+    try:
+        total = np.zeros(vol_shape, dtype=np.float64)
+        for start, block in iter_volumes(in_file, chunk_size):
+            total += block.sum(axis=-1, dtype=np.float64)
+            if spool is not None:
+                spool[start:start + block.shape[-1]] = np.moveaxis(block, -1, 0)
+        mean = (total / n_vols).astype(np.float32)
+
+        brain_mask = compute_mean_mask(mean, m=mask_fraction)
+        # QC metrics use nilearn's defaults of lower = 0.2; upper = 0.85
+        qc_mask = compute_epi_mask(nib.Nifti1Image(mean, affine))
+
+        acc = _QCAccumulator(qc_mask, n_vols)
+        global_intensity = np.zeros(n_vols, dtype=np.float64)
+        if spool is not None:
+            volumes = ((t, np.asarray(spool[t])) for t in range(n_vols))
+        else:
+            volumes = ((start + i, block[..., i]) for start, block in iter_volumes(in_file, chunk_size)
+                       for i in range(block.shape[-1]))
+        for t, vol in volumes:
+            global_intensity[t] = np.nanmean(vol[brain_mask])
+            acc.update(t, vol)
+    finally:
+        if spool is not None:
+            del spool
+            os.remove(spool_file)
+
+    return (nib.Nifti1Image(mean, affine),
+            nib.Nifti1Image(brain_mask.astype(np.uint8), affine),
+            global_intensity,
+            acc.result())
+
+
+def save_qc_metrics(metrics, file_name='qc_metrics.json', n_threads=None):
+    """
+    Write QC metrics to a machine-readable json file. The mean, std and tSNR images are written next to it as nifti files and referenced by name, so the metrics file and images can be moved around together.
+
+    Args:
+        metrics: dict as returned by compute_qc_metrics; may additionally contain 'global_outliers', 'fd_outliers' and their cutoffs
+        file_name: output json file name; default 'qc_metrics.json'
+        n_threads: number of threads used to compress the images; default as nifti.save_nifti
+
+    Returns:
+        file_name: path to the json file
+
+    """
+
+    import json
+    import os
+
+    out_dir = os.path.dirname(os.path.abspath(file_name))
+    mask_idx = np.asarray(metrics['mask'].dataobj).astype(bool)
+    tsnr = np.asarray(metrics['tsnr'].dataobj)[mask_idx]
+    tsnr = tsnr[np.isfinite(tsnr)]
+
+    images = {}
+    for key in ['mean', 'std', 'tsnr']:
+        images[key] = 'qc_' + key + '.nii.gz'
+        save_nifti(metrics[key], os.path.join(out_dir, images[key]), n_threads=n_threads)
+
+    out = {'n_volumes': int(len(metrics['global_mean'])),
+           'n_voxels': int(mask_idx.sum()),
+           'tsnr_summary': {'mean': float(np.mean(tsnr)) if tsnr.size else None,
+                            'median': float(np.median(tsnr)) if tsnr.size else None,
+                            'std': float(np.std(tsnr)) if tsnr.size else None},
+           'global_mean': np.asarray(metrics['global_mean']).tolist(),
+           'global_std': np.asarray(metrics['global_std']).tolist(),
+           'frame_diff': np.asarray(metrics['frame_diff']).tolist(),
+           'images': images}
+    for key in ['global_outliers', 'fd_outliers']:
+        if key in metrics:
+            out[key] = np.asarray(metrics[key]).astype(int).tolist()
+    for key in ['global_outlier_cutoff', 'frame_outlier_cutoff']:
+        if key in metrics:
+            out[key] = float(metrics[key])
+
+    with open(file_name, 'w') as fp:
+        json.dump(out, fp, indent=2)
+    return file_name
+
+
+def load_qc_metrics(file_name):
+    """ Load a QC metrics json file written by save_qc_metrics. Series are returned as arrays and images as nibabel images. """
+
+    import json
+    import os
+
+    with open(file_name) as fp:
+        metrics = json.load(fp)
+    in_dir = os.path.dirname(os.path.abspath(file_name))
+    for key in ['global_mean', 'global_std', 'frame_diff']:
+        metrics[key] = np.array(metrics[key], dtype=np.float32)
+    for key in ['global_outliers', 'fd_outliers']:
+        if key in metrics:
+            metrics[key] = np.array(metrics[key], dtype=int)
+    for key, name in metrics['images'].items():
+        metrics[key] = nib.load(os.path.join(in_dir, name))
+    return metrics
+
+
+def qc_image_files(file_name):
+    """ Get the full paths of the mean, std and tSNR images that a QC metrics json file written by save_qc_metrics references, as a dict keyed by 'mean', 'std' and 'tsnr'. """
+
+    import json
+    import os
+
+    with open(file_name) as fp:
+        images = json.load(fp)['images']
+    in_dir = os.path.dirname(os.path.abspath(file_name))
+    return dict((key, os.path.join(in_dir, name)) for key, name in images.items())
+
+
+def plot_qc_metrics(metrics, title="Signal quality", dpi=300):
+    """
+    Render the QC report: mean, std and tSNR brain images followed by global signal mean, std and frame-differences with outliers marked.
+
+    Args:
+        metrics: dict as returned by compute_qc_metrics or load_qc_metrics, including 'global_outliers' and 'fd_outliers'
+        title: plot title; default 'Signal quality'
+        dpi: figure dpi; default 300
+
+    Returns:
+        filename: pdf file name
+
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import pylab as plt
+    from nilearn.plotting import plot_stat_map
+
+    global_outliers = metrics.get('global_outliers', [])
+    frame_outliers = metrics.get('fd_outliers', [])
+
+    colspan = 2
+    loc = 9
+    F = plt.figure(figsize=(8.3, 11.7))
+    F.text(0.5, .93, title, horizontalalignment='center',fontsize=16)
+    F.text(0.5, .01, 'TR', horizontalalignment='center',fontsize=16)
+
+    # Plot brain images first
+    ax1 = plt.subplot2grid((6, 2), (0, 0), colspan=colspan)
+    plot_stat_map(metrics['mean'], title="Mean", cut_coords=range(-40, 40, 10), display_mode='z', axes=ax1,
+                  draw_cross=False, black_bg=True, annotate=False, bg_img=None)
+    ax2 = plt.subplot2grid((6, 2), (1, 0), colspan=colspan)
+    plot_stat_map(metrics['std'], title="Standard Deviation", cut_coords=range(-40, 40, 10), display_mode='z', axes=ax2,
+                  draw_cross=False, black_bg=True, annotate=False, bg_img=None)
+    ax3 = plt.subplot2grid((6, 2), (2, 0), colspan=colspan)
+    plot_stat_map(metrics['tsnr'], title="tSNR (mn/sd)", cut_coords=range(-40, 40, 10), display_mode='z', axes=ax3,
+                  draw_cross=False, black_bg=True, annotate=False, bg_img=None)
+
+    # Plot global mean, std, diffs next
+    ax4 = plt.subplot2grid((6, 2), (3, 0), colspan=colspan)
+    handles = ax4.plot(metrics['global_mean'])
+    ax4.set(xlabel='',ylabel='Global mean',xticklabels=[])
+    v_ax = ax4.vlines(global_outliers,ax4.get_ylim()[0],ax4.get_ylim()[-1],color='r', linestyle='--',zorder=3)
+    handles.append(v_ax)
+    ax4.legend([v_ax],['intensity outliers'],loc=loc)
+    ax4.tick_params(direction='in')
+
+    ax5 = plt.subplot2grid((6, 2), (4, 0), colspan=colspan)
+    handles = ax5.plot(metrics['global_std'])
+    ax5.set(xlabel='',ylabel='Global std',xticklabels=[])
+    ax5.tick_params(direction='in')
+
+    ax6 = plt.subplot2grid((6, 2), (5, 0), colspan=colspan)
+    handles = ax6.plot(metrics['frame_diff'])
+    ax6.set(xlabel='',ylabel='Global abs diffs')
+    v_ax = ax6.vlines(frame_outliers,ax6.get_ylim()[0],ax6.get_ylim()[-1],color='r', linestyle='--',zorder=3)
+    ax6.legend([v_ax],['diff outliers'],loc=loc)
+    ax6.tick_params(direction='in')
+
+    if title != "":
+        filename = title.replace(" ", "_") + ".pdf"
+    else:
+        filename = "plot.pdf"
+
+    F.savefig(filename, papertype="a4", dpi=dpi)
+    plt.clf()
+    plt.close()
+    del F
+    return filename
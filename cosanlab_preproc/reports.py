@@ -0,0 +1,137 @@
+from __future__ import division
+
+'''
+Preproc Reports
+===============
+
+Batch rendering of QA plots for workflows built with wfmaker(..., reports='deferred'). Deferred workflows save the data each plot needs into the final output directory; these functions render all of them for a whole project using a pool of processes once the workflows have finished.
+
+Can also be run from the command line:
+
+    python -m cosanlab_preproc.reports /data/project --n_procs 8
+
+'''
+
+__all__ = ['find_report_dirs', 'render_run_reports', 'render_reports']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+import os
+from glob import glob
+from .utils import get_resource_path
+
+# File patterns saved by deferred workflows in each functional run's output folder
+report_inputs = {
+    'qa_metrics': 'qc_metrics.json',
+    'motion_params': '*.par',
+    'art_outliers': 'art.*_outliers.txt',
+    'mean_norm_epi': '*_trans_mean.nii.gz'
+}
+
+
+def _find_one(run_dir, pattern):
+    """ Get the single file in run_dir matching pattern or None. """
+
+    matches = sorted(glob(os.path.join(run_dir, pattern)))
+    return matches[0] if matches else None
+
+
+def find_report_dirs(final_dir):
+    """ Get all functional run output folders under final_dir that contain deferred report inputs. """
+
+    run_dirs = []
+    for root, dirs, files in os.walk(final_dir):
+        if report_inputs['qa_metrics'] in files:
+            run_dirs.append(root)
+    return sorted(run_dirs)
+
+
+def render_run_reports(run_dir, mni_template='2mm', dpi=300, overwrite=False):
+    """
+    Render the realignment, signal quality and normalization check plots for a single functional run output folder. Plots are written into run_dir with the same names the inline workflow uses.
+
+    Args:
+        run_dir: functional run output folder from a deferred workflow
+        mni_template: MNI template resolution the run was normalized to; default '2mm'
+        dpi: figure dpi; default 300
+        overwrite: re-render plots that already exist; default False
+
+    Returns:
+        plots: list of rendered plot files
+
+    """
+
+    from .interfaces import Plot_Coregistration_Montage, Plot_Quality_Metrics, Plot_Realignment_Parameters
+
+    canonical_img = os.path.join(get_resource_path(), 'MNI152_T1_' + mni_template + '.nii.gz')
+    qa_metrics = _find_one(run_dir, report_inputs['qa_metrics'])
+    motion_params = _find_one(run_dir, report_inputs['motion_params'])
+    art_outliers = _find_one(run_dir, report_inputs['art_outliers'])
+    mean_norm_epi = _find_one(run_dir, report_inputs['mean_norm_epi'])
+
+    to_render = []
+    if motion_params and art_outliers:
+        to_render.append(('Realignment_parameters.pdf', Plot_Realignment_Parameters(
+            realignment_parameters=motion_params, outliers=art_outliers, dpi=dpi)))
+    if qa_metrics:
+        to_render.append(('Signal_quality.pdf', Plot_Quality_Metrics(metrics=qa_metrics, dpi=dpi)))
+    if mean_norm_epi:
+        to_render.append(('Normalized_Functional_Check.pdf', Plot_Coregistration_Montage(
+            wra_img=mean_norm_epi, canonical_img=canonical_img)))
+
+    # Plotting interfaces write to the current directory
+    plots = []
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    try:
+        for filename, interface in to_render:
+            if overwrite or not os.path.exists(filename):
+                interface.run()
+            plots.append(os.path.join(run_dir, filename))
+    finally:
+        os.chdir(cwd)
+    return plots
+
+
+def render_reports(project_dir, n_procs=None, mni_template='2mm', dpi=300, overwrite=False):
+    """
+    Render QA plots for every functional run of a project processed with wfmaker(..., reports='deferred'). Runs are rendered in parallel with a process pool so this can be done on cheap nodes after the expensive workflows have finished.
+
+    Args:
+        project_dir (str): full path to the root of project folder, i.e. the same project_dir given to wfmaker
+        n_procs (int; optional): number of processes to use; default number of cpus
+        mni_template (str; optional): which mm resolution template the data were normalized to, e.g. '3mm'; default '2mm'
+        dpi (int; optional): figure dpi; default 300
+        overwrite (bool; optional): re-render plots that already exist; default False
+
+    Returns:
+        plots: list of rendered plot files
+
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    if mni_template not in ['1mm', '2mm', '3mm']:
+        raise ValueError("MNI template must be: 1mm, 2mm, or 3mm")
+
+    final_dir = os.path.join(project_dir, 'preprocessed', 'final')
+    run_dirs = find_report_dirs(final_dir)
+    plots = []
+    with ProcessPoolExecutor(max_workers=n_procs) as pool:
+        futures = [pool.submit(render_run_reports, run_dir, mni_template, dpi, overwrite) for run_dir in run_dirs]
+        for future in futures:
+            plots.extend(future.result())
+    return plots
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Render deferred QA plots for a preprocessed project")
+    parser.add_argument('project_dir')
+    parser.add_argument('--n_procs', type=int, default=None)
+    parser.add_argument('--mni_template', default='2mm')
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+    plots = render_reports(args.project_dir, n_procs=args.n_procs, mni_template=args.mni_template, dpi=args.dpi, overwrite=args.overwrite)
+    print(f"Rendered {len(plots)} plots")
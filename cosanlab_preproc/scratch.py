@@ -0,0 +1,185 @@
+from __future__ import division
+
+'''
+Preproc Scratch
+===============
+
+Run a workflow's working directories on node-local scratch storage rather than the project's (typically shared) filesystem. DataSink nodes write final outputs to scratch too, and a background thread copies each DataSink's files to the project's final directory as soon as the node finishes, so workers never wait on the shared filesystem. Working directories of selected nodes can be kept by copying them to the project's intermediate directory, also as soon as the node finishes.
+
+Used by wfmaker(scratch_dir=...) and wfmaker_batch(scratch_dir=...).
+
+'''
+
+__all__ = ['ScratchWorkflow', 'SyncThread']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+import os
+import queue
+import shutil
+import threading
+from nipype import logging
+from nipype.pipeline.engine import Workflow
+
+logger = logging.getLogger('nipype.workflow')
+
+# Plugins that run every node on this machine, and so can see its scratch storage
+local_plugins = ['Linear', 'MultiProc', 'LegacyMultiProc']
+
+
+def _copy_file(src, dst):
+    """ Copy src to dst (with its modification time) through a temporary file, so dst is never seen half written. """
+
+    dst_dir = os.path.dirname(dst)
+    if not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir, exist_ok=True)
+    tmp = '%s.%d.tmp' % (dst, os.getpid())
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _is_current(src, dst):
+    """ Whether dst is a copy of src as written by _copy_file. """
+
+    try:
+        s, d = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    return s.st_size == d.st_size and int(s.st_mtime) == int(d.st_mtime)
+
+
+class SyncThread(threading.Thread):
+    """
+    Background thread that copies files and directories from a scratch directory to the same relative paths under a destination directory.
+
+    Args:
+        src_dir: scratch directory
+        dst_dir: destination directory
+
+    Examples:
+
+        >>> sync = SyncThread('/scratch/final', '/data/project/preprocessed/final')
+        >>> sync.start()
+        >>> sync.put('/scratch/final/sub-01/functional/covariates.csv')
+        >>> sync.close()
+
+    """
+
+    def __init__(self, src_dir, dst_dir):
+        super(SyncThread, self).__init__(name='scratch-sync')
+        self.daemon = True
+        self.src_dir = os.path.abspath(src_dir)
+        self.dst_dir = os.path.abspath(dst_dir)
+        self.errors = []
+        self._queue = queue.Queue()
+
+    def put(self, path):
+        """ Queue a file or directory under src_dir to be copied; paths outside src_dir are ignored. """
+
+        path = os.path.abspath(path)
+        if os.path.commonpath([path, self.src_dir]) == self.src_dir:
+            self._queue.put(path)
+
+    def sync(self, path):
+        """ Copy a file, or every file in a directory that differs from its copy, now. """
+
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for f in files:
+                    self.sync(os.path.join(root, f))
+        elif os.path.isfile(path):
+            dst = os.path.join(self.dst_dir, os.path.relpath(path, self.src_dir))
+            if not _is_current(path, dst):
+                _copy_file(path, dst)
+
+    def run(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                return
+            try:
+                self.sync(path)
+            except (IOError, OSError) as e:
+                self.errors.append(e)
+
+    def close(self):
+        """ Copy everything still queued and wait for the thread to finish. """
+
+        self._queue.put(None)
+        self.join()
+
+
+class ScratchWorkflow(Workflow):
+    """
+    Workflow whose working directories and DataSink outputs are on scratch storage. While it runs, DataSink outputs are copied from scratch_final_dir to final_dir as each DataSink node finishes, and the working directories of nodes named in keep_intermediates from scratch_interm_dir to interm_dir. After the run, any final outputs that weren't copied yet (e.g. from DataSinks that failed) are. Only works with plugins that run every node on this machine (Linear or MultiProc). The scratch directories are left in place for the job scheduler or user to remove; rerunning the workflow on the same scratch directory reuses its cached results.
+
+    Args:
+        name: workflow name
+        scratch_final_dir: final directory on scratch that the workflow's DataSinks write to
+        final_dir: project's final directory to copy DataSink outputs to
+        scratch_interm_dir: intermediate directory on scratch that the workflow's working directories are in
+        interm_dir: project's intermediate directory to copy kept working directories to
+        keep_intermediates: list of node names (e.g. ['realign', 'coregistration']) whose working directories are kept
+
+    """
+
+    def __init__(self, name, scratch_final_dir, final_dir, scratch_interm_dir, interm_dir, keep_intermediates=None, **kwargs):
+        super(ScratchWorkflow, self).__init__(name, **kwargs)
+        self.scratch_final_dir = scratch_final_dir
+        self.final_dir = final_dir
+        self.scratch_interm_dir = scratch_interm_dir
+        self.interm_dir = interm_dir
+        self.keep_intermediates = list(keep_intermediates or [])
+
+    def run(self, plugin=None, plugin_args=None, updatehash=False):
+        """ Run the workflow like Workflow.run while copying its outputs from scratch in the background. """
+
+        from nipype import config
+        from nipype.interfaces.io import DataSink
+
+        plugin_name = plugin if plugin is not None else config.get('execution', 'plugin')
+        if not isinstance(plugin_name, str):
+            plugin_name = plugin_name.__class__.__name__[:-len('Plugin')]
+        if plugin_name not in local_plugins:
+            raise ValueError("Workflows on scratch storage can only be run with %s, not %s" % (', '.join(local_plugins), plugin_name))
+
+        finals = SyncThread(self.scratch_final_dir, self.final_dir)
+        intermediates = SyncThread(self.scratch_interm_dir, self.interm_dir)
+        user_callback = (plugin_args or {}).get('status_callback')
+
+        def status_callback(node, status):
+            if user_callback is not None:
+                user_callback(node, status)
+            if status != 'end':
+                return
+            if node.name in self.keep_intermediates:
+                intermediates.put(node.output_dir())
+            if isinstance(node.interface, DataSink):
+                # Anything missed here is copied after the run
+                try:
+                    out_files = node.result.outputs.out_file
+                except Exception:
+                    return
+                for f in out_files if isinstance(out_files, list) else [out_files]:
+                    if isinstance(f, str):
+                        finals.put(f)
+
+        plugin_args = dict(plugin_args or {}, status_callback=status_callback)
+        finals.start()
+        intermediates.start()
+        succeeded = False
+        try:
+            result = super(ScratchWorkflow, self).run(plugin=plugin, plugin_args=plugin_args, updatehash=updatehash)
+            succeeded = True
+            return result
+        finally:
+            finals.put(self.scratch_final_dir)
+            finals.close()
+            intermediates.close()
+            errors = finals.errors + intermediates.errors
+            if errors:
+                message = "Copying outputs from scratch failed: %s" % '; '.join(str(e) for e in errors)
+                # Don't hide the workflow's own error
+                if succeeded:
+                    raise IOError(message)
+                logger.error(message)
@@ -0,0 +1,32 @@
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+tr = 2.
+
+
+def make_run(file_name, shape=(12, 14, 10), n_volumes=60, seed=0):
+    """ Write a small synthetic 4D run: a bright ellipsoid with a slow drift and noise inside, zeros outside. """
+
+    rng = np.random.default_rng(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    brain = sum(g ** 2 for g in grid) < .8
+    drift = np.sin(np.linspace(0, 4 * np.pi, n_volumes))
+    data = 1000 * brain[..., None] * (1 + .01 * drift) + rng.normal(0, 20, shape + (n_volumes,)) * brain[..., None]
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.diag([3., 3., 3., 1.])), file_name)
+    return file_name
+
+
+@pytest.fixture
+def run_file(tmpdir):
+    return make_run(os.path.join(str(tmpdir), 'run.nii.gz'))
+
+
+@pytest.fixture
+def mask_file(tmpdir, run_file):
+    img = nib.load(run_file)
+    mask = (np.asarray(img.dataobj)[..., 0] > 0).astype(np.uint8)
+    file_name = os.path.join(str(tmpdir), 'mask.nii.gz')
+    nib.save(nib.Nifti1Image(mask, img.affine), file_name)
+    return file_name
@@ -0,0 +1,97 @@
+import json
+import os
+import time
+import pytest
+from cosanlab_preproc import bids_index
+from cosanlab_preproc.bids_index import load_bids_index
+
+
+def _touch(path, sidecar=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+    if sidecar is not None:
+        with open(path.replace('.nii.gz', '.json'), 'w') as f:
+            json.dump(sidecar, f)
+
+
+def _add_subject(data_dir, sub, sessions=('01', '02')):
+    for ses in sessions:
+        prefix = os.path.join(data_dir, 'sub-' + sub, 'ses-' + ses)
+        name = 'sub-%s_ses-%s' % (sub, ses)
+        _touch(os.path.join(prefix, 'anat', name + '_T1w.nii.gz'))
+        for task, run in [('rest', '01'), ('rest', '02'), ('faces', '01')]:
+            _touch(os.path.join(prefix, 'func', '%s_task-%s_run-%s_bold.nii.gz' % (name, task, run)),
+                   sidecar={'SliceTiming': [0, 1]})
+        for direction in ['AP', 'PA']:
+            _touch(os.path.join(prefix, 'fmap', '%s_dir-%s_epi.nii.gz' % (name, direction)),
+                   sidecar={'TotalReadoutTime': .04, 'PhaseEncodingDirection': 'j' if direction == 'PA' else 'j-'})
+
+
+@pytest.fixture
+def data_dir(tmpdir):
+    data_dir = os.path.join(str(tmpdir), 'raw')
+    os.makedirs(data_dir)
+    with open(os.path.join(data_dir, 'dataset_description.json'), 'w') as f:
+        json.dump({'Name': 'test', 'BIDSVersion': '1.0.2'}, f)
+    # Task level sidecars, so metadata has to be inherited
+    for task, tr in [('rest', 2.), ('faces', 1.5)]:
+        with open(os.path.join(data_dir, 'task-%s_bold.json' % task), 'w') as f:
+            json.dump({'RepetitionTime': tr, 'TaskName': task}, f)
+    for sub in ['01', '02']:
+        _add_subject(data_dir, sub)
+    return data_dir
+
+
+def test_index_matches_pybids(tmpdir, data_dir):
+    from bids.grabbids import BIDSLayout
+    layout = BIDSLayout(data_dir)
+    index = load_bids_index(data_dir, os.path.join(str(tmpdir), 'index.sqlite'))
+
+    assert index.get_subjects() == sorted(layout.get_subjects())
+    assert index.get_sessions() == sorted(layout.get_sessions())
+    assert index.get_sessions(subject='01') == sorted(layout.get_sessions(subject='01'))
+    queries = [dict(subject='01', type='T1w', extensions='.nii.gz'),
+               dict(subject='01', type='T1w', extensions='.nii.gz', session='02'),
+               dict(subject='02', type='bold', task='rest', extensions='.nii.gz'),
+               dict(subject='02', type='bold', task='rest', session='01', extensions='.nii.gz'),
+               dict(subject='01', modality='fmap', extensions='.nii.gz'),
+               dict(subject=['01', '02'], type='bold', run=2, extensions='.nii.gz'),
+               dict(type='bold', extensions='json')]
+    for query in queries:
+        expected = sorted(f.filename for f in layout.get(**query))
+        assert expected
+        assert [f.filename for f in index.get(**query)] == expected
+        assert index.get(return_type='file', **query) == expected
+    for f in layout.get(type='bold', extensions='.nii.gz') + layout.get(modality='fmap', extensions='.nii.gz'):
+        assert index.get_metadata(f.filename) == layout.get_metadata(f.filename)
+
+    bold = index.get(subject='01', type='bold', task='faces', session='01', extensions='.nii.gz')[0]
+    assert (bold.subject, bold.session, bold.task, bold.run) == ('01', '01', 'faces', 1)
+
+
+def test_index_rebuilt_when_directories_change(tmpdir, data_dir, monkeypatch):
+    index_file = os.path.join(str(tmpdir), 'index.sqlite')
+    builds = []
+    build = bids_index._build_index
+    monkeypatch.setattr(bids_index, '_build_index', lambda *args: builds.append(1) or build(*args))
+
+    load_bids_index(data_dir, index_file)
+    assert load_bids_index(data_dir, index_file).get_subjects() == ['01', '02']
+    assert len(builds) == 1
+
+    # A new subject changes the top level directory's modification time
+    time.sleep(.01)
+    _add_subject(data_dir, '03', sessions=['01'])
+    assert load_bids_index(data_dir, index_file).get_subjects() == ['01', '02', '03']
+    assert len(builds) == 2
+
+    # So does a file added deep in the tree
+    time.sleep(.01)
+    _touch(os.path.join(data_dir, 'sub-01', 'ses-01', 'func', 'sub-01_ses-01_task-rest_run-03_bold.nii.gz'))
+    runs = load_bids_index(data_dir, index_file).get(subject='01', session='01', task='rest', type='bold',
+                                                      extensions='.nii.gz', return_type='id', target='run')
+    assert runs == [1, 2, 3]
+    assert len(builds) == 3
+
+    load_bids_index(data_dir, index_file, rebuild=True)
+    assert len(builds) == 4
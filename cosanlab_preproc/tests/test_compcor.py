@@ -0,0 +1,142 @@
+import json
+import os
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import pytest
+from cosanlab_preproc.compcor import randomized_components, acompcor, tcompcor
+from cosanlab_preproc.covariates import load_covariates
+from cosanlab_preproc.interfaces import Compute_CompCor, Create_Covariates
+
+shape = (12, 14, 10)
+n_volumes = 80
+
+
+def _subspace_alignment(a, b):
+    """ Cosines of the principal angles between the column spaces of a and b; all 1 if they span the same space. """
+
+    qa, _ = np.linalg.qr(a)
+    qb, _ = np.linalg.qr(b)
+    return np.linalg.svd(qa.T.dot(qb), compute_uv=False)
+
+
+def _detrend(series):
+    series = np.asarray(series, dtype=np.float64)
+    design = np.column_stack([np.ones(len(series)), np.linspace(-1, 1, len(series))])
+    return series - design.dot(np.linalg.lstsq(design, series, rcond=None)[0])
+
+
+def _exact_components(series, n_components):
+    """ Components from an exact SVD of the linearly detrended, unit variance series. """
+
+    series = _detrend(series)
+    sd = series.std(axis=0)
+    series /= np.where(sd == 0, 1, sd)
+    u, s, _ = np.linalg.svd(series, full_matrices=False)
+    return u[:, :n_components], s[:n_components]**2 / np.sum(s**2)
+
+
+@pytest.fixture
+def signals():
+    rng = np.random.default_rng(1)
+    return rng.normal(size=(n_volumes, 3))
+
+
+@pytest.fixture
+def compcor_run(tmpdir, signals):
+    """ A run whose CSF (label 1) and white matter (label 3) share two noise signals and a high variance corner carries a third, with a segmentation. """
+
+    rng = np.random.default_rng(0)
+    labels = np.zeros(shape, dtype=np.uint8)
+    labels[2:-2, 2:-2, 2:-2] = 2
+    labels[3:6, 3:-3, 3:-3] = 1
+    labels[-6:-3, 3:-3, 3:-3] = 3
+    data = 1000. * (labels > 0)[..., None] + rng.normal(0, 5, shape + (n_volumes,)) * (labels > 0)[..., None]
+    noise = np.isin(labels, [1, 3])
+    weights = rng.normal(size=(noise.sum(), 2))
+    data[noise] += 20 * weights.dot(signals[:, :2].T) + np.linspace(0, 50, n_volumes)
+    corner = np.zeros(shape, dtype=bool)
+    corner[6:9, 5:8, 4:6] = True
+    data[corner] += 200 * signals[:, 2]
+
+    run_file = os.path.join(str(tmpdir), 'run.nii.gz')
+    seg_file = os.path.join(str(tmpdir), 'seg.nii.gz')
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.diag([3., 3., 3., 1.])), run_file)
+    nib.save(nib.Nifti1Image(labels, np.diag([3., 3., 3., 1.])), seg_file)
+    return run_file, seg_file
+
+
+def test_randomized_components_match_svd():
+    rng = np.random.default_rng(0)
+    # Decaying spectrum plus noise
+    series = (rng.normal(size=(120, 8)) * [40, 30, 20, 15, 10, 8, 6, 5]).dot(rng.normal(size=(8, 5000)))
+    series = (series + rng.normal(size=series.shape)).astype(np.float32)
+
+    components, variance_explained = randomized_components(series, 5, block_size=1000)
+    u, s, _ = np.linalg.svd(series.astype(np.float64), full_matrices=False)
+    assert components.shape == (120, 5)
+    assert components.dtype == np.float32
+    np.testing.assert_allclose(_subspace_alignment(components, u[:, :5]), 1, atol=1e-4)
+    # Each component is one singular vector up to sign
+    np.testing.assert_allclose(np.abs(np.sum(components * u[:, :5], axis=0)), 1, atol=1e-3)
+    np.testing.assert_allclose(variance_explained, s[:5]**2 / np.sum(s**2), rtol=1e-4)
+
+
+def test_randomized_components_of_small_arrays():
+    series = np.random.default_rng(0).normal(size=(10, 4)).astype(np.float32)
+    components, variance_explained = randomized_components(series, 6)
+    assert components.shape == (10, 4)
+    np.testing.assert_allclose(variance_explained.sum(), 1, rtol=1e-5)
+
+
+def test_acompcor_matches_svd(compcor_run, signals):
+    run_file, seg_file = compcor_run
+    components, variance_explained = acompcor(run_file, seg_file, n_components=2, chunk_size=7)
+
+    data = np.asarray(nib.load(run_file).dataobj)
+    noise = np.isin(np.asarray(nib.load(seg_file).dataobj), [1, 3])
+    expected, expected_variance = _exact_components(data[noise].T, 2)
+    np.testing.assert_allclose(_subspace_alignment(components, expected), 1, atol=1e-4)
+    np.testing.assert_allclose(variance_explained, expected_variance, rtol=1e-3)
+    # The shared noise signals are found, and the linear drift is removed
+    assert _subspace_alignment(components, _detrend(signals[:, :2])).min() > .99
+    np.testing.assert_allclose(components.T.dot(np.linspace(-1, 1, n_volumes)), 0, atol=1e-4)
+
+
+def test_tcompcor_uses_high_variance_voxels(compcor_run, signals):
+    run_file, seg_file = compcor_run
+    brain = np.asarray(nib.load(seg_file).dataobj) > 0
+    components, _ = tcompcor(run_file, brain, n_components=1, fraction=18. / brain.sum())
+
+    # The 18 corner voxels carrying the third signal have the highest variance
+    corner = np.asarray(nib.load(run_file).dataobj)[6:9, 5:8, 4:6].reshape(-1, n_volumes).T
+    expected, _ = _exact_components(corner, 1)
+    np.testing.assert_allclose(_subspace_alignment(components, expected), 1, atol=1e-4)
+    assert _subspace_alignment(components, _detrend(signals[:, 2:])).min() > .99
+
+
+def test_compcor_columns_in_covariates(tmpdir, compcor_run):
+    run_file, seg_file = compcor_run
+    tmpdir.chdir()
+    outputs = Compute_CompCor(in_file=run_file, segmentation=seg_file, components_type=['acompcor', 'tcompcor'],
+                              n_components=2).run().outputs
+    compcor = pd.read_csv(outputs.components_file)
+    columns = ['acompcor1', 'acompcor2', 'tcompcor1', 'tcompcor2']
+    assert list(compcor.columns) == columns
+    assert len(compcor) == n_volumes
+    with open(outputs.variance_file) as f:
+        assert sorted(json.load(f)) == columns
+
+    par = os.path.join(str(tmpdir), 'run.par')
+    spikes = os.path.join(str(tmpdir), 'art.outliers.txt')
+    np.savetxt(par, np.random.default_rng(0).normal(0, .01, (n_volumes, 6)))
+    np.savetxt(spikes, [5, 40], fmt='%d')
+    covariates = Create_Covariates(realignment_parameters=par, spike_id=spikes, compcor=outputs.components_file).run().outputs
+    csv = pd.read_csv(covariates.covariates)
+    assert list(csv.columns[24:]) == columns + ['spike1', 'spike2']
+    np.testing.assert_allclose(csv[columns].values, compcor.values, rtol=1e-10)
+
+    data, npz_columns, _, spike_columns = load_covariates(covariates.covariates_npz)
+    assert npz_columns[24:] == columns
+    assert spike_columns == ['spike1', 'spike2']
+    np.testing.assert_allclose(data[:, 24:], compcor.values, rtol=1e-5, atol=1e-7)
@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import pandas as pd
+from cosanlab_preproc.covariates import load_spike_index
+from cosanlab_preproc.interfaces import Create_Covariates
+
+n_volumes = 50
+
+
+def _write_inputs(tmpdir, spikes, fds):
+    rng = np.random.default_rng(0)
+    files = {'par': os.path.join(str(tmpdir), 'run.par'),
+             'spikes': os.path.join(str(tmpdir), 'art.outliers.txt'),
+             'fds': os.path.join(str(tmpdir), 'fd_outliers.txt')}
+    np.savetxt(files['par'], np.cumsum(rng.normal(0, [.0005] * 3 + [.02] * 3, (n_volumes, 6)), axis=0), fmt='%.6f')
+    np.savetxt(files['spikes'], spikes, fmt='%d')
+    np.savetxt(files['fds'], fds)
+    return files
+
+
+def _loop_covariates(par, spikes, fds):
+    """ Covariates built a column at a time, the way Create_Covariates did before it was vectorized. """
+
+    ra = np.loadtxt(par)
+    ra = ra - ra.mean(axis=0)
+    diff = pd.DataFrame(ra).diff().values
+    out = pd.DataFrame(np.hstack([ra, ra ** 2, diff, diff ** 2]),
+                       columns=[p + str(x) for p in ['ra', 'rasq', 'radiff', 'radiffsq'] for x in range(1, 7)])
+    for prefix, locs in [('spike', spikes), ('FD', fds)]:
+        for i, loc in enumerate(locs):
+            out[prefix + str(i + 1)] = 0
+            out.loc[int(loc), prefix + str(i + 1)] = 1
+    return out
+
+
+def test_covariates_match_loop(tmpdir):
+    tmpdir.chdir()
+    spikes, fds = [3, 17, 40], [9, 25]
+    files = _write_inputs(tmpdir, spikes, fds)
+
+    covariates = Create_Covariates(realignment_parameters=files['par'], spike_id=files['spikes'],
+                                   fd_outliers=files['fds']).run().outputs.covariates
+    expected = _loop_covariates(files['par'], spikes, fds)
+    pd.testing.assert_frame_equal(pd.read_csv(covariates), expected, check_dtype=False, atol=1e-12)
+
+
+def test_fd_outliers_that_are_spikes_get_one_regressor(tmpdir):
+    tmpdir.chdir()
+    files = _write_inputs(tmpdir, [3, 17], [17, 30])
+
+    covariates = pd.read_csv(Create_Covariates(realignment_parameters=files['par'], spike_id=files['spikes'],
+                                               fd_outliers=files['fds']).run().outputs.covariates)
+    assert [c for c in covariates.columns if c.startswith(('spike', 'FD'))] == ['spike1', 'spike2', 'FD1']
+    assert covariates['FD1'].values.nonzero()[0].tolist() == [30]
+
+
+def test_spike_index_matches_dense(tmpdir):
+    tmpdir.chdir()
+    files = _write_inputs(tmpdir, [3, 17, 40], [9, 25])
+
+    dense = pd.read_csv(Create_Covariates(realignment_parameters=files['par'], spike_id=files['spikes'],
+                                          fd_outliers=files['fds']).run().outputs.covariates)
+    os.mkdir('index')
+    os.chdir('index')
+    outputs = Create_Covariates(realignment_parameters=files['par'], spike_id=files['spikes'],
+                                fd_outliers=files['fds'], spike_format='index').run().outputs
+    spikes = load_spike_index(outputs.spike_index, sparse=False)
+    pd.testing.assert_frame_equal(spikes, dense[spikes.columns], check_dtype=False)
+    assert list(pd.read_csv(outputs.covariates).columns) == [c for c in dense.columns if c not in spikes.columns]
+
+
+def test_covariates_npz_round_trips(tmpdir):
+    from scipy.sparse import issparse
+    from cosanlab_preproc.covariates import load_covariates
+    tmpdir.chdir()
+    files = _write_inputs(tmpdir, [3, 17, 40], [9, 25])
+    outputs = Create_Covariates(realignment_parameters=files['par'], spike_id=files['spikes'],
+                                fd_outliers=files['fds']).run().outputs
+    csv = pd.read_csv(outputs.covariates)
+
+    for mmap in [True, False]:
+        data, columns, spikes, spike_columns = load_covariates(outputs.covariates_npz, mmap=mmap)
+        assert data.dtype == np.float32
+        assert isinstance(data, np.memmap) == mmap
+        assert columns + spike_columns == list(csv.columns)
+        np.testing.assert_allclose(data, csv[columns].values, rtol=1e-6)
+        assert issparse(spikes)
+        np.testing.assert_array_equal(spikes.toarray(), csv[spike_columns].values)
+
+    frame = load_covariates(outputs.covariates_npz, as_frame=True)
+    assert list(frame.columns) == list(csv.columns)
+    pd.testing.assert_frame_equal(frame, csv, check_dtype=False, rtol=1e-6)
@@ -0,0 +1,36 @@
+import numpy as np
+import nibabel as nib
+import pytest
+from cosanlab_preproc.interfaces import Down_Sample_Precision
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100])
+def test_scaled_int16_matches_in_memory(tmpdir, run_file, chunk_size):
+    tmpdir.chdir()
+    data = np.asarray(nib.load(run_file).dataobj, dtype=np.float64)
+
+    out = nib.load(Down_Sample_Precision(in_file=run_file, chunk_size=chunk_size).run().outputs.out_file)
+    assert out.get_data_dtype() == np.int16
+    assert out.shape == data.shape
+    # The data's range is mapped onto the full int16 range, so values are only off by rounding
+    slope, inter = out.dataobj.slope, out.dataobj.inter
+    assert np.isclose(slope, (data.max() - data.min()) / 65535.)
+    np.testing.assert_allclose(out.get_fdata(), data, rtol=0, atol=slope / 2 + 1e-6 * abs(inter))
+
+
+def test_unscaled_matches_astype(tmpdir, run_file):
+    tmpdir.chdir()
+    data = np.asarray(nib.load(run_file).dataobj)
+
+    # Without scale factors values are truncated, like the old get_data().astype(data_type)
+    out = nib.load(Down_Sample_Precision(in_file=run_file, scale=False, chunk_size=7).run().outputs.out_file)
+    np.testing.assert_array_equal(np.asarray(out.dataobj), data.astype(np.int16))
+
+
+def test_unscaled_float_is_not_truncated(tmpdir, run_file):
+    tmpdir.chdir()
+    data = np.asarray(nib.load(run_file).dataobj)
+
+    out = nib.load(Down_Sample_Precision(in_file=run_file, data_type='float32', scale=False, chunk_size=7).run().outputs.out_file)
+    assert out.get_data_dtype() == np.float32
+    np.testing.assert_array_equal(np.asarray(out.dataobj), data.astype(np.float32))
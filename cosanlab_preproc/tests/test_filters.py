@@ -0,0 +1,176 @@
+import os
+import numpy as np
+import nibabel as nib
+from cosanlab_preproc import filters
+from cosanlab_preproc.filters import fwhm_to_sigma, smooth_volume
+from cosanlab_preproc.interfaces import Filter_In_Mask, Down_Sample_Precision, Filter_Smooth_Down_Sample, Smooth_In_Mask
+from conftest import tr
+
+
+def test_final_stage_matches_separate_nodes(tmpdir, run_file, mask_file):
+    tmpdir.chdir()
+
+    # Filter_In_Mask -> smoothing like fslmaths -kernel gauss -fmean -> Down_Sample_Precision
+    filtered = Filter_In_Mask(in_file=run_file, mask=mask_file, low_pass_cutoff=.1, high_pass_cutoff=.01,
+                              sampling_rate=tr).run().outputs.out_file
+    img = nib.load(filtered)
+    sigma = fwhm_to_sigma(6., img.header.get_zooms())
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    smoothed = np.stack([smooth_volume(data[..., t], sigma) for t in range(data.shape[-1])], axis=-1)
+    nib.save(nib.Nifti1Image(smoothed, img.affine, img.header), 'run_filtered_smooth.nii.gz')
+    chain = nib.load(Down_Sample_Precision(in_file='run_filtered_smooth.nii.gz').run().outputs.out_file)
+
+    fused = nib.load(Filter_Smooth_Down_Sample(in_file=run_file, mask=mask_file, low_pass_cutoff=.1, high_pass_cutoff=.01,
+                                               sampling_rate=tr, fwhm=6.).run().outputs.out_file)
+    assert fused.get_data_dtype() == np.int16
+    slope = fused.dataobj.slope
+    np.testing.assert_allclose([fused.dataobj.slope, fused.dataobj.inter], [chain.dataobj.slope, chain.dataobj.inter], rtol=1e-4)
+    np.testing.assert_allclose(fused.get_fdata(), chain.get_fdata(), rtol=0, atol=2 * slope)
+
+
+def test_final_stage_smooths_each_volume_once(tmpdir, run_file, monkeypatch):
+    tmpdir.chdir()
+    calls = []
+    smooth = filters.smooth_volume
+    monkeypatch.setattr(filters, 'smooth_volume', lambda *args, **kwargs: calls.append(1) or smooth(*args, **kwargs))
+
+    out_files = {(None, 4.): 'smooth_4.nii.gz', (None, 8.): 'smooth_8.nii.gz'}
+    filters.write_final_stage(run_file, out_files, data_type='int16', scale=True)
+    n_volumes = nib.load(run_file).shape[3]
+    assert len(calls) == 2 * n_volumes
+    assert not tmpdir.join('spool.dat').exists()
+
+
+def _count_reads(monkeypatch):
+    from cosanlab_preproc import nifti
+    reads = []
+    iter_volumes = nifti.iter_volumes
+
+    def counted(in_file, *args, **kwargs):
+        reads.append(in_file)
+        return iter_volumes(in_file, *args, **kwargs)
+    monkeypatch.setattr(nifti, 'iter_volumes', counted)
+    return reads
+
+
+def test_grid_reads_run_once(tmpdir, run_file, mask_file, monkeypatch):
+    from cosanlab_preproc.interfaces import Filter_Smooth_Down_Sample_Grid
+    tmpdir.chdir()
+    reads = _count_reads(monkeypatch)
+
+    # Smoothing only, so volumes are streamed straight from the compressed run
+    out_files = Filter_Smooth_Down_Sample_Grid(in_file=run_file, fwhm=[4, 6, 8]).run().outputs.out_files
+    assert reads == [run_file]
+    assert len(out_files) == 3
+
+    del reads[:]
+    out_files = Filter_Smooth_Down_Sample_Grid(in_file=run_file, mask=mask_file, sampling_rate=tr,
+                                               low_pass_cutoff=[0, .1, .2], fwhm=[0, 6, 8]).run().outputs.out_files
+    assert reads == [run_file]
+    assert len(out_files) == 3
+    assert len(tmpdir.listdir(lambda p: p.ext == '.dat')) == 0
+
+
+def test_final_stage_spools_only_the_masks(tmpdir, run_file, mask_file, monkeypatch):
+    tmpdir.chdir()
+    shapes = []
+    memmap = np.memmap
+
+    def recorded(*args, **kwargs):
+        shapes.append(kwargs['shape'])
+        return memmap(*args, **kwargs)
+    monkeypatch.setattr(filters.np, 'memmap', recorded)
+
+    # Smoothed outputs are 0 outside smooth_mask and unsmoothed ones outside mask
+    img = nib.load(run_file)
+    mask = np.asarray(nib.load(mask_file).dataobj).astype(bool)
+    smooth_mask = np.zeros(mask.shape, dtype=np.uint8)
+    smooth_mask[2:-2, 2:-2, 2:-2] = 1
+    nib.save(nib.Nifti1Image(smooth_mask, img.affine), 'smooth_mask.nii.gz')
+    out_files = {(.1, 0): 'filtered.nii.gz', (.1, 4.): 'smooth_4.nii.gz', (.1, 8.): 'smooth_8.nii.gz'}
+    filters.write_final_stage(run_file, out_files, mask=mask_file, sampling_rate=tr, smooth_mask='smooth_mask.nii.gz')
+    assert shapes == [(img.shape[3], mask.sum() + 2 * smooth_mask.sum())]
+    assert not tmpdir.join('spool.dat').exists()
+
+    # The spool holds the outputs exactly, up to the int16 scaling
+    unspooled = {key: 'float_' + name for key, name in out_files.items()}
+    filters.write_final_stage(run_file, unspooled, mask=mask_file, sampling_rate=tr, smooth_mask='smooth_mask.nii.gz',
+                              data_type='float32')
+    for key in out_files:
+        out, expected = nib.load(out_files[key]), np.asarray(nib.load(unspooled[key]).dataobj)
+        np.testing.assert_allclose(out.get_fdata(), expected, rtol=0, atol=out.dataobj.slope / 2 + 1e-3)
+        assert not out.get_fdata()[(mask if not key[1] else smooth_mask.astype(bool)) == 0].any()
+
+
+def test_final_stage_unscaled_float_is_not_truncated(tmpdir, run_file):
+    tmpdir.chdir()
+    data = np.asarray(nib.load(run_file).dataobj)
+
+    filters.write_final_stage(run_file, {(None, None): 'float.nii.gz'}, data_type='float32', scale=False)
+    np.testing.assert_array_equal(np.asarray(nib.load('float.nii.gz').dataobj), data)
+    filters.write_final_stage(run_file, {(None, None): 'int.nii.gz'}, data_type='int16', scale=False)
+    np.testing.assert_array_equal(np.asarray(nib.load('int.nii.gz').dataobj), data.astype(np.int16))
+
+
+def test_smooth_in_mask_keeps_constant_image_constant():
+    mask = np.zeros((15, 16, 14), dtype=bool)
+    mask[3:12, 2:13, 4:10] = True
+    mask[6:9, 6:9, 6:9] = False
+    vol = np.where(mask, 100., 5000.)
+    sigma = fwhm_to_sigma(8., (2., 2., 2.))
+
+    out = filters.smooth_in_mask(vol, sigma, mask)
+    assert out.dtype == np.float32
+    # Nothing bleeds in from outside the mask and edges aren't pulled towards 0
+    np.testing.assert_allclose(out[mask], 100, rtol=1e-5)
+    assert not out[~mask].any()
+    # Unlike smoothing the whole field of view
+    assert not np.allclose(smooth_volume(np.where(mask, vol, 0), sigma)[mask], 100, rtol=1e-2)
+
+
+def test_smooth_in_mask_node_matches_volume_by_volume(tmpdir, run_file, mask_file):
+    tmpdir.chdir()
+    img = nib.load(run_file)
+    data = np.asarray(img.dataobj)
+    mask = np.asarray(nib.load(mask_file).dataobj).astype(bool)
+    sigma = fwhm_to_sigma(6., img.header.get_zooms())
+
+    smoothed_files = Smooth_In_Mask(in_file=run_file, mask=mask_file, fwhm=[6], chunk_size=7,
+                                    num_threads=3).run().outputs.smoothed_files
+    assert [os.path.relpath(f) for f in smoothed_files] == ['run_smooth.nii.gz']
+    out = np.asarray(nib.load(smoothed_files[0]).dataobj)
+    expected = np.stack([filters.smooth_in_mask(data[..., t], sigma, mask) for t in range(data.shape[-1])], axis=-1)
+    np.testing.assert_allclose(out, expected, rtol=1e-6, atol=1e-4)
+
+
+def test_grid_matches_smooth_in_mask(tmpdir, run_file, mask_file):
+    from cosanlab_preproc.interfaces import Filter_Smooth_Down_Sample_Grid
+    tmpdir.chdir()
+
+    smoothed_files = Smooth_In_Mask(in_file=run_file, mask=mask_file, fwhm=[4, 8]).run().outputs.smoothed_files
+    assert [os.path.relpath(f) for f in smoothed_files] == [os.path.join('_fwhm_4', 'run_smooth.nii.gz'),
+                                                            os.path.join('_fwhm_8', 'run_smooth.nii.gz')]
+
+    os.mkdir('grid')
+    os.chdir('grid')
+    out_files = Filter_Smooth_Down_Sample_Grid(in_file=run_file, smooth_mask=mask_file, fwhm=[4, 8],
+                                               data_type='float32').run().outputs.out_files
+    assert [os.path.basename(f) for f in out_files] == ['_fwhm_4', '_fwhm_8']
+    for fwhm, smoothed_file in zip([4, 8], smoothed_files):
+        grid_file = os.path.join('_fwhm_%d' % fwhm, 'run_smooth_float32.nii.gz')
+        np.testing.assert_allclose(np.asarray(nib.load(grid_file).dataobj), np.asarray(nib.load(smoothed_file).dataobj),
+                                   rtol=1e-6)
+
+
+def test_grid_layout(tmpdir, run_file, mask_file):
+    from cosanlab_preproc.interfaces import Filter_Smooth_Down_Sample_Grid
+    tmpdir.mkdir('grid').chdir()
+
+    out_files = Filter_Smooth_Down_Sample_Grid(in_file=run_file, mask=mask_file, sampling_rate=tr,
+                                               low_pass_cutoff=[0, .1], fwhm=[0, 6]).run().outputs.out_files
+    assert [os.path.basename(f) for f in out_files] == ['_low_pass_cutoff_0', '_low_pass_cutoff_0.1']
+    files = sorted(os.path.relpath(os.path.join(d, f)) for d, _, fs in os.walk('.') for f in fs if f.endswith('.nii.gz'))
+    assert files == sorted([os.path.join('_low_pass_cutoff_0', '_fwhm_0', 'run_filtered_int16.nii.gz'),
+                            os.path.join('_low_pass_cutoff_0', '_fwhm_6', 'run_filtered_smooth_int16.nii.gz'),
+                            os.path.join('_low_pass_cutoff_0.1', '_fwhm_0', 'run_filtered_int16.nii.gz'),
+                            os.path.join('_low_pass_cutoff_0.1', '_fwhm_6', 'run_filtered_smooth_int16.nii.gz')])
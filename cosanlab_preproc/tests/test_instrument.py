@@ -0,0 +1,135 @@
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from cosanlab_preproc import instrument
+from cosanlab_preproc.instrument import Recorder, phase, append_record, interface_record, read_log
+
+package_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ A clock that only moves when the test advances it. """
+
+    clock = types.SimpleNamespace(now=1000.)
+    clock.advance = lambda seconds: setattr(clock, 'now', clock.now + seconds)
+    monkeypatch.setattr(instrument, 'time', types.SimpleNamespace(perf_counter=lambda: clock.now, time=lambda: clock.now,
+                                                                  strftime=time.strftime, localtime=time.localtime))
+    return clock
+
+
+def _times(recorder):
+    return {name: stats['time'] for name, stats in recorder.phases.items()}
+
+
+def test_nested_phases(clock):
+    with Recorder() as recorder:
+        clock.advance(1)
+        with phase('load'):
+            clock.advance(2)
+            # Time in an inner phase only counts towards the inner phase
+            with phase('write'):
+                clock.advance(3)
+            clock.advance(1)
+        clock.advance(4)
+        with phase('load'):
+            clock.advance(5)
+    assert _times(recorder) == {'compute': 5, 'load': 8, 'write': 3}
+    assert list(recorder.phases) == ['compute', 'load', 'write']
+    assert recorder.duration == 16
+    # Outside a recording phases do nothing
+    with phase('load'):
+        clock.advance(1)
+    assert recorder.duration == 16
+
+
+def test_worker_thread_phases_count_towards_caller(clock):
+    def work(i):
+        with phase('write'):
+            clock.advance(1)
+        return i
+
+    with Recorder() as recorder:
+        with phase('render'):
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                assert list(pool.map(work, range(4))) == list(range(4))
+    assert _times(recorder) == {'compute': 0, 'render': 4}
+
+
+def test_nested_recorders(clock):
+    with Recorder() as outer:
+        with Recorder() as inner:
+            with phase('load'):
+                clock.advance(2)
+        # Phases go to the innermost recorder until it finishes
+        with phase('write'):
+            clock.advance(1)
+    assert _times(inner) == {'compute': 0, 'load': 2}
+    assert _times(outer) == {'compute': 2, 'write': 1}
+
+
+def test_trace_memory_is_off_by_default():
+    assert not instrument.trace_memory_default
+    assert not tracemalloc.is_tracing()
+    with Recorder() as recorder:
+        assert not tracemalloc.is_tracing()
+        data = bytearray(10 * 1024**2)
+    summary = recorder.summary()
+    assert summary['tracemalloc_peak_mb'] is None
+    # RSS is always recorded
+    assert summary['peak_rss_mb'] > 0
+
+    with Recorder(trace_memory=True) as recorder:
+        assert tracemalloc.is_tracing()
+        data = bytearray(10 * 1024**2)
+    del data
+    assert not tracemalloc.is_tracing()
+    assert recorder.summary()['tracemalloc_peak_mb'] >= 10
+
+
+@pytest.mark.parametrize('value,expected', [('', False), ('1', True)])
+def test_trace_memory_environment_switch(value, expected):
+    # The switch is read on import, e.g. by MultiProc workers, so check it in a fresh process
+    env = dict(os.environ, COSANLAB_PREPROC_TRACE_MEMORY=value)
+    code = 'from cosanlab_preproc.instrument import Recorder; print(Recorder().trace_memory, Recorder(trace_memory=False).trace_memory)'
+    out = subprocess.check_output([sys.executable, '-c', code], env=env, cwd=package_dir)
+    assert out.decode().split() == [str(expected), 'False']
+
+
+def test_interface_trace_memory_input(tmpdir, run_file):
+    from cosanlab_preproc.interfaces import Down_Sample_Precision
+    tmpdir.chdir()
+
+    runtime = Down_Sample_Precision(in_file=run_file).run().runtime
+    assert runtime.tracemalloc_peak_mb is None
+    assert runtime.peak_rss_mb > 0
+    assert runtime.phases['compute']['time'] > 0
+    runtime = Down_Sample_Precision(in_file=run_file, trace_memory=True).run().runtime
+    assert runtime.tracemalloc_peak_mb > 0
+
+
+def test_log_round_trips(tmpdir, clock):
+    log_file = str(tmpdir.join(instrument.log_file_name))
+    for status, seconds in [('ok', 2), ('error', 3)]:
+        with Recorder() as recorder:
+            with phase('load'):
+                clock.advance(seconds)
+            clock.advance(1)
+        append_record(interface_record(types.SimpleNamespace(), recorder, str(tmpdir.join('node')), status), log_file)
+
+    with open(log_file) as f:
+        assert len(f.read().splitlines()) == 2
+    records = read_log(log_file)
+    assert list(records['status']) == ['ok', 'error']
+    assert list(records['node']) == ['node', 'node']
+    assert list(records['pid']) == [os.getpid()] * 2
+    assert list(records['load_time']) == [2, 3]
+    assert list(records['compute_time']) == [1, 1]
+    assert list(records['duration']) == [3, 4]
+    assert 'phases' not in records
+    assert records['tracemalloc_peak_mb'].isnull().all()
@@ -0,0 +1,42 @@
+import gzip
+import os
+import numpy as np
+import nibabel as nib
+from cosanlab_preproc.nifti import ParallelGzipFile, NiftiVolumeWriter, save_nifti
+
+
+def test_parallel_gzip_round_trips_through_gzip(tmpdir):
+    file_name = os.path.join(str(tmpdir), 'data.gz')
+    data = np.random.default_rng(0).integers(0, 8, 300000, dtype=np.uint8).tobytes()
+
+    # Small blocks so the file has many gzip members, written out of step with the block size
+    with ParallelGzipFile(file_name, n_threads=3, block_size=4096) as f:
+        for start in range(0, len(data), 10000):
+            f.write(data[start:start + 10000])
+        assert f.tell() == len(data)
+        f.seek(len(data) + 100)
+    with gzip.open(file_name, 'rb') as f:
+        assert f.read() == data + b'\x00' * 100
+
+
+def test_save_nifti_round_trips_through_nibabel(tmpdir):
+    file_name = os.path.join(str(tmpdir), 'img.nii.gz')
+    data = np.random.default_rng(0).normal(size=(9, 10, 11, 5)).astype(np.float32)
+    img = nib.Nifti1Image(data, np.diag([2., 2., 2., 1.]))
+
+    save_nifti(img, file_name, n_threads=3)
+    loaded = nib.load(file_name)
+    np.testing.assert_array_equal(np.asarray(loaded.dataobj), data)
+    np.testing.assert_array_equal(loaded.affine, img.affine)
+
+
+def test_volume_writer_round_trips_through_nibabel(tmpdir):
+    file_name = os.path.join(str(tmpdir), 'img.nii.gz')
+    data = np.random.default_rng(0).normal(size=(9, 10, 11, 5)).astype(np.float32)
+    hdr = nib.Nifti1Image(data, np.eye(4)).header
+    hdr.set_slope_inter(1, 0)
+
+    with NiftiVolumeWriter(file_name, hdr, n_threads=3) as writer:
+        for t in range(data.shape[-1]):
+            writer.write(data[..., t:t + 1])
+    np.testing.assert_array_equal(np.asarray(nib.load(file_name).dataobj), data)
@@ -0,0 +1,159 @@
+import json
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+from cosanlab_preproc.qc import compute_qc_metrics, find_outliers, compute_mean_mask
+from cosanlab_preproc.interfaces import Compute_Run_Statistics
+
+
+def _in_memory_qc(in_file):
+    """ QC metrics computed the way Plot_Quality_Control did before streaming, with the whole run in memory. """
+
+    from nilearn.masking import compute_epi_mask, apply_mask
+
+    img = nib.load(in_file)
+    mask = compute_epi_mask(img)
+    masked_data = apply_mask(img, mask)
+    mn = np.mean(masked_data, axis=0)
+    sd = np.std(masked_data, axis=0)
+    return {'mask': np.asarray(mask.dataobj).astype(bool),
+            'mean': mn,
+            'std': sd,
+            'tsnr': np.true_divide(mn, sd),
+            'global_mean': np.mean(masked_data, axis=1),
+            'global_std': np.std(masked_data, axis=1),
+            'frame_diff': np.mean(np.abs(np.diff(masked_data, axis=0)), axis=1)}
+
+
+@pytest.mark.parametrize('ext,chunk_size', [('.nii.gz', 1), ('.nii.gz', 7), ('.nii', 1)])
+def test_streaming_qc_matches_in_memory(tmpdir, run_file, ext, chunk_size):
+    # A spike in one volume, so there are outliers to find
+    img = nib.load(run_file)
+    data = np.asarray(img.dataobj)
+    data[..., 20] *= 1.5
+    in_file = os.path.join(str(tmpdir), 'spiked' + ext)
+    nib.save(nib.Nifti1Image(data, img.affine), in_file)
+
+    expected = _in_memory_qc(in_file)
+    metrics = compute_qc_metrics(in_file, chunk_size=chunk_size)
+
+    mask = np.asarray(metrics['mask'].dataobj).astype(bool)
+    np.testing.assert_array_equal(mask, expected['mask'])
+    for key in ['mean', 'std', 'tsnr']:
+        np.testing.assert_allclose(np.asarray(metrics[key].dataobj)[mask], expected[key], rtol=1e-4)
+        assert not np.asarray(metrics[key].dataobj)[~mask].any()
+    for key in ['global_mean', 'global_std', 'frame_diff']:
+        np.testing.assert_allclose(metrics[key], expected[key], rtol=1e-4)
+
+    for key, cutoff in [('global_mean', 3), ('frame_diff', 3)]:
+        np.testing.assert_array_equal(find_outliers(metrics[key], cutoff), find_outliers(expected[key], cutoff))
+    assert 20 in find_outliers(metrics['global_mean'], 3)
+
+
+def _nipy_compute_mask(mean_volume, m=0.2, M=0.9, cc=True, opening=2):
+    """ nipy.labs.mask.compute_mask, as called by nipype's ComputeMask, for when nipy isn't installed. """
+
+    from scipy import ndimage
+
+    sorted_input = np.sort(np.ravel(mean_volume))
+    limiteinf = int(np.floor(m * len(sorted_input)))
+    limitesup = int(np.floor(M * len(sorted_input)))
+    delta = sorted_input[limiteinf + 1:limitesup + 1] - sorted_input[limiteinf:limitesup]
+    ia = delta.argmax()
+    threshold = 0.5 * (sorted_input[ia + limiteinf] + sorted_input[ia + limiteinf + 1])
+    mask = mean_volume >= threshold
+    if cc:
+        labels, label_nb = ndimage.label(mask)
+        if label_nb > 1:
+            label_count = np.bincount(labels.ravel().astype(int))
+            label_count[0] = 0
+            mask = labels == label_count.argmax()
+    if opening > 0:
+        mask = ndimage.binary_opening(mask.astype(int), iterations=opening)
+    return mask.astype(bool)
+
+
+def _mean_volume():
+    """ A mean EPI with a bright brain, a dimmer disconnected blob, and noise. """
+
+    rng = np.random.default_rng(0)
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in (20, 22, 18)], indexing='ij')
+    mean = 800. * (sum(g ** 2 for g in grid) < .6) + rng.normal(50, 10, grid[0].shape)
+    mean[1:4, 1:4, 1:4] += 400
+    return mean
+
+
+@pytest.mark.parametrize('m,cc,opening', [(.2, True, 2), (.05, True, 2), (.05, False, 0), (.5, True, 1)])
+def test_mean_mask_matches_nipy(m, cc, opening):
+    mean = _mean_volume()
+    mask = compute_mean_mask(mean, m=m, cc=cc, opening=opening)
+    np.testing.assert_array_equal(mask, _nipy_compute_mask(mean, m=m, cc=cc, opening=opening))
+    assert mask.any() and not mask.all()
+
+
+def test_mean_mask_matches_nipy_package():
+    nipy_mask = pytest.importorskip('nipy.labs.mask')
+    mean = _mean_volume()
+    for m in [.05, .2]:
+        np.testing.assert_array_equal(compute_mean_mask(mean, m=m), nipy_mask.compute_mask(mean, m=m))
+
+
+def _keys(obj):
+    if isinstance(obj, dict):
+        return [(key, _keys(value)) for key, value in sorted(obj.items())]
+    if isinstance(obj, list):
+        return [_keys(value) for value in obj]
+    return None
+
+
+def _values(obj):
+    """ All the numbers in a json object, in order. """
+
+    if isinstance(obj, dict):
+        return [v for key in sorted(obj) for v in _values(obj[key])]
+    if isinstance(obj, list):
+        return [v for value in obj for v in _values(value)]
+    return [float(obj)] if isinstance(obj, (bool, int, float)) else []
+
+
+@pytest.mark.parametrize('ext,chunk_size', [('.nii.gz', 1), ('.nii.gz', 7), ('.nii', 1)])
+def test_run_statistics_match_artifact_detect(tmpdir, run_file, ext, chunk_size):
+    from nipype.algorithms.rapidart import ArtifactDetect
+
+    # An intensity spike and a head movement, so both kinds of outlier are found
+    img = nib.load(run_file)
+    data = np.asarray(img.dataobj)
+    data[..., 20] *= 1.1
+    in_file = os.path.join(str(tmpdir), 'run_realigned' + ext)
+    nib.save(nib.Nifti1Image(data, img.affine), in_file)
+    par = np.cumsum(np.random.default_rng(0).normal(0, [.02] * 3 + [.0005] * 3, (data.shape[-1], 6)), axis=0)
+    par[35:, 0] += 2
+    par_file = os.path.join(str(tmpdir), 'run_realigned.par')
+    np.savetxt(par_file, par)
+
+    tmpdir.mkdir('fused').chdir()
+    fused = Compute_Run_Statistics(in_file=in_file, realignment_parameters=par_file, chunk_size=chunk_size).run().outputs
+    assert not os.path.exists('spool.dat')
+
+    # The mean and brain mask that FSL MeanImage and nipy ComputeMask (m=.05) would give
+    mean = np.asarray(nib.load(fused.mean_file).dataobj)
+    np.testing.assert_allclose(mean, data.mean(axis=-1), rtol=1e-5)
+    mask = np.asarray(nib.load(fused.brain_mask).dataobj).astype(bool)
+    np.testing.assert_array_equal(mask, _nipy_compute_mask(mean, m=.05))
+
+    tmpdir.mkdir('art').chdir()
+    art = ArtifactDetect(realigned_files=in_file, realignment_parameters=par_file, parameter_source='FSL',
+                         mask_type='file', mask_file=fused.brain_mask, use_norm=True, norm_threshold=1,
+                         zintensity_threshold=3, use_differences=[True, False]).run().outputs
+    for key in ['outlier_files', 'intensity_files', 'norm_files']:
+        assert os.path.basename(getattr(fused, key)) == os.path.basename(getattr(art, key))
+        with open(getattr(fused, key)) as f, open(getattr(art, key)) as g:
+            assert f.read() == g.read()
+    with open(fused.statistic_files) as f, open(art.statistic_files) as g:
+        stats, expected = json.load(f), json.load(g)
+    assert stats[:2] == expected[:2]
+    assert _keys(stats) == _keys(expected)
+    np.testing.assert_allclose(_values(stats), _values(expected), rtol=1e-6, atol=1e-10)
+    outliers = np.loadtxt(fused.outlier_files)
+    assert 20 in outliers and 35 in outliers
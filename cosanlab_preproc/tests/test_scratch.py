@@ -0,0 +1,114 @@
+import os
+import pytest
+from nipype import Node, Function
+from nipype.interfaces.io import DataSink
+from cosanlab_preproc import scratch
+from cosanlab_preproc.scratch import ScratchWorkflow, SyncThread
+
+
+def _write_output(text):
+    import os
+    out_file = os.path.abspath('output.txt')
+    with open(out_file, 'w') as f:
+        f.write(text)
+    return out_file
+
+
+@pytest.fixture
+def dirs(tmpdir):
+    dirs = {'scratch': str(tmpdir.join('scratch')), 'scratch_final': str(tmpdir.join('scratch', 'final')),
+            'scratch_interm': str(tmpdir.join('scratch', 'intermediate')),
+            'final': str(tmpdir.join('project', 'final')), 'interm': str(tmpdir.join('project', 'intermediate'))}
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+    return dirs
+
+
+def _workflow(dirs, keep_intermediates=None):
+    workflow = ScratchWorkflow(name='intermediate', scratch_final_dir=dirs['scratch_final'], final_dir=dirs['final'],
+                               scratch_interm_dir=dirs['scratch_interm'], interm_dir=dirs['interm'],
+                               keep_intermediates=keep_intermediates)
+    workflow.base_dir = dirs['scratch']
+    make = Node(Function(input_names=['text'], output_names=['out_file'], function=_write_output), name='make')
+    make.inputs.text = 'data'
+    sink = Node(DataSink(base_directory=dirs['scratch_final'], parameterization=False), name='sink')
+    workflow.connect(make, 'out_file', sink, 'sub-01.@output')
+    return workflow
+
+
+@pytest.mark.parametrize('plugin', ['SLURMGraph', 'SGE', 'IPython'])
+def test_remote_plugins_are_rejected(dirs, plugin):
+    with pytest.raises(ValueError):
+        _workflow(dirs).run(plugin)
+    assert not os.listdir(dirs['final'])
+
+
+def test_outputs_are_copied_from_scratch(dirs):
+    statuses = []
+    _workflow(dirs, keep_intermediates=['make']).run('Linear', plugin_args={
+        'status_callback': lambda node, status: statuses.append((node.name, status))})
+
+    # The user's callback still sees every node
+    assert ('make', 'end') in statuses and ('sink', 'end') in statuses
+    with open(os.path.join(dirs['final'], 'sub-01', 'output.txt')) as f:
+        assert f.read() == 'data'
+    assert os.path.isfile(os.path.join(dirs['interm'], 'make', 'output.txt'))
+    # Only nodes in keep_intermediates are kept
+    assert os.listdir(dirs['interm']) == ['make']
+
+
+def test_final_sweep_copies_missed_outputs(dirs, monkeypatch):
+    # Outputs the DataSink callbacks never queued, e.g. from a DataSink whose result can't be loaded
+    monkeypatch.setattr(SyncThread, 'put', lambda self, path: None if path != self.src_dir else self._queue.put(path))
+    stray = os.path.join(dirs['scratch_final'], 'sub-02', 'stray.txt')
+    os.makedirs(os.path.dirname(stray))
+    with open(stray, 'w') as f:
+        f.write('stray')
+
+    _workflow(dirs).run('Linear')
+    assert os.path.isfile(os.path.join(dirs['final'], 'sub-01', 'output.txt'))
+    assert os.path.isfile(os.path.join(dirs['final'], 'sub-02', 'stray.txt'))
+
+
+def test_copies_go_through_a_temporary_file(dirs, monkeypatch):
+    replaced = []
+    replace = os.replace
+    monkeypatch.setattr(os, 'replace', lambda src, dst: replaced.append((src, dst)) or replace(src, dst))
+    src = os.path.join(dirs['scratch_final'], 'sub-01', 'out.txt')
+    os.makedirs(os.path.dirname(src))
+    with open(src, 'w') as f:
+        f.write('data')
+
+    SyncThread(dirs['scratch_final'], dirs['final']).sync(src)
+    dst = os.path.join(dirs['final'], 'sub-01', 'out.txt')
+    assert replaced == [('%s.%d.tmp' % (dst, os.getpid()), dst)]
+    assert os.listdir(os.path.dirname(dst)) == ['out.txt']
+    # With the source's modification time, so it's recognized as up to date
+    assert int(os.stat(src).st_mtime) == int(os.stat(dst).st_mtime)
+
+
+def test_up_to_date_files_are_skipped(dirs, monkeypatch):
+    copies = []
+    copy_file = scratch._copy_file
+    monkeypatch.setattr(scratch, '_copy_file', lambda src, dst: copies.append(src) or copy_file(src, dst))
+    for name in ['a.txt', 'b.txt']:
+        with open(os.path.join(dirs['scratch_final'], name), 'w') as f:
+            f.write(name)
+
+    sync = SyncThread(dirs['scratch_final'], dirs['final'])
+    sync.sync(dirs['scratch_final'])
+    assert len(copies) == 2
+    sync.sync(dirs['scratch_final'])
+    assert len(copies) == 2
+
+    with open(os.path.join(dirs['scratch_final'], 'a.txt'), 'w') as f:
+        f.write('changed')
+    sync.start()
+    sync.put(dirs['scratch_final'])
+    # Paths outside the scratch directory are ignored
+    sync.put(dirs['interm'])
+    sync.close()
+    assert copies[2:] == [os.path.join(dirs['scratch_final'], 'a.txt')]
+    with open(os.path.join(dirs['final'], 'a.txt')) as f:
+        assert f.read() == 'changed'
+    assert not sync.errors
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+from cosanlab_preproc import timing
+from cosanlab_preproc.timing import critical_path, longest_path, core_usage, stage_summary
+
+
+@pytest.fixture
+def nodes():
+    """
+    Node records of a small run on 8 cores:
+
+        n4 (0-10) -> normalization (10-50, 4 cores) -> coregistration (55-60, 2 cores)
+        realign (0-20) -> coregistration
+        realign -> qc (20-25)
+
+    coregistration waited 5 s to be scheduled after its last dependency finished.
+    """
+
+    records = [('anat/n4', 'n4', 0, 10, 1, []),
+               ('anat/normalization', 'normalization', 10, 50, 4, ['anat/n4']),
+               ('func/realign', 'realign', 0, 20, 1, []),
+               ('func/coregistration', 'coregistration', 55, 60, 2, ['anat/normalization', 'func/realign']),
+               ('func/qc', 'qc', 20, 25, 1, ['func/realign'])]
+    nodes = pd.DataFrame(records, columns=['node', 'stage', 'start', 'end', 'n_procs', 'depends']).set_index('node')
+    nodes['start'] = nodes['start'].astype(float)
+    nodes['end'] = nodes['end'].astype(float)
+    nodes['duration'] = nodes['end'] - nodes['start']
+    return nodes.sort_values('start')
+
+
+def test_critical_path(nodes):
+    path = critical_path(nodes)
+    assert list(path.index) == ['anat/n4', 'anat/normalization', 'func/coregistration']
+    np.testing.assert_array_equal(path['duration'], [10, 40, 5])
+    np.testing.assert_array_equal(path['wait'], [0, 0, 5])
+    assert list(path['stage']) == ['n4', 'normalization', 'coregistration']
+
+
+def test_longest_path(nodes):
+    length, path = longest_path(nodes)
+    assert length == 55
+    assert path == ['anat/n4', 'anat/normalization', 'func/coregistration']
+
+    # When realign takes longer than n4 and normalization together the chain goes through it instead
+    nodes.loc['func/realign', ['end', 'duration']] = [45, 45]
+    nodes.loc['anat/normalization', ['end', 'duration']] = [30, 20]
+    nodes.loc['func/qc', ['start', 'end', 'duration']] = [45, 47, 2]
+    length, path = longest_path(nodes)
+    assert length == 50
+    assert path == ['func/realign', 'func/coregistration']
+
+
+def test_core_usage(nodes):
+    # Core seconds over the 60 s run: n4 10 + normalization 160 + realign 20 + coregistration 10 + qc 5
+    assert core_usage(nodes) == pytest.approx(205 / 60.)
+    assert core_usage(nodes, 10, 50) == pytest.approx((160 + 10 + 5) / 40.)
+    # Nothing runs while coregistration waits
+    assert core_usage(nodes, 50, 55) == 0
+    assert core_usage(nodes, 55, 60) == 2
+    # Busy cores at an instant
+    assert core_usage(nodes, 30, 30) == 4
+
+
+def test_analysis_idle_cores(nodes, monkeypatch):
+    monkeypatch.setattr(timing, 'load_node_results', lambda work_dir: nodes)
+
+    analysis = timing.analyze_workflow('work_dir', n_procs=8)
+    assert analysis['wall_time'] == 60
+    assert analysis['longest_path_time'] == 55
+    assert analysis['busy_cores'] == pytest.approx(205 / 60.)
+    assert analysis['utilization'] == pytest.approx(205 / 60. / 8)
+    assert analysis['idle_core_hours'] == pytest.approx((8 * 60 - 205) / 3600.)
+    # Busy cores from when each critical path node was ready until it finished
+    np.testing.assert_allclose(analysis['critical_path']['busy_cores'], [(10 + 10) / 10., 175 / 40., 10 / 10.])
+
+    # Without n_procs, the most cores declared busy at once: normalization, realign and n4 at 10 s
+    assert timing.analyze_workflow('work_dir')['n_procs'] == 6
+
+
+def test_stage_summary(nodes):
+    stages = stage_summary(nodes, critical_path(nodes))
+    assert list(stages.index[:3]) == ['normalization', 'n4', 'coregistration']
+    assert stages.at['normalization', 'critical'] == 40
+    assert stages.at['realign', 'critical'] == 0
+    assert stages.at['normalization', 'share'] == pytest.approx(160 / 205.)
+    assert stages['core_hours'].sum() == pytest.approx(205 / 3600.)
@@ -0,0 +1,103 @@
+import concurrent.futures
+import errno
+import os
+import pytest
+from cosanlab_preproc import utils
+from cosanlab_preproc.utils import get_n_threads, limit_threads, link_file
+from cosanlab_preproc.interfaces import Filter_Smooth_Down_Sample
+from conftest import tr
+
+
+def test_get_n_threads_follows_limit_threads():
+    assert get_n_threads(5) == 5
+    with limit_threads(3):
+        assert get_n_threads() == 3
+        assert get_n_threads(2) == 2
+        with limit_threads(1):
+            assert get_n_threads(default=4) == 1
+        assert get_n_threads() == 3
+    assert get_n_threads(default=4) == 4
+
+
+def test_interface_thread_pools_use_num_threads(tmpdir, run_file, mask_file, monkeypatch):
+    tmpdir.chdir()
+    sizes = []
+    executor = concurrent.futures.ThreadPoolExecutor
+
+    def recorded(max_workers=None, **kwargs):
+        sizes.append(max_workers)
+        return executor(max_workers=max_workers, **kwargs)
+    monkeypatch.setattr(concurrent.futures, 'ThreadPoolExecutor', recorded)
+
+    # Filtering, smoothing and gzip compression each run on a thread pool
+    Filter_Smooth_Down_Sample(in_file=run_file, mask=mask_file, low_pass_cutoff=.1, sampling_rate=tr, fwhm=6.,
+                              num_threads=3).run()
+    assert len(sizes) >= 3
+    assert set(sizes) == {3}
+
+
+@pytest.fixture
+def src(tmpdir):
+    src = os.path.join(str(tmpdir), 'src.nii.gz')
+    with open(src, 'wb') as f:
+        f.write(b'data')
+    return src
+
+
+def _fail(code):
+    def fail(*args):
+        raise OSError(code, os.strerror(code))
+    return fail
+
+
+def _reflink_copy(src, dst):
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        d.write(s.read())
+
+
+def test_link_file_hardlinks(tmpdir, src):
+    dst = os.path.join(str(tmpdir), 'dst.nii.gz')
+    assert link_file(src, dst) == 'hardlink'
+    assert os.path.samefile(src, dst)
+    assert link_file(src, dst) == 'existing'
+    # Copying over a link leaves src alone
+    assert link_file(src, dst, mode='copy') == 'copy'
+    assert not os.path.samefile(src, dst)
+    with open(dst, 'rb') as f:
+        assert f.read() == b'data'
+
+
+@pytest.mark.parametrize('code', [errno.EXDEV, errno.EPERM])
+def test_link_file_falls_back_to_reflink(tmpdir, src, monkeypatch, code):
+    dst = os.path.join(str(tmpdir), 'dst.nii.gz')
+    monkeypatch.setattr(os, 'link', _fail(code))
+    monkeypatch.setattr(utils, '_reflink', _reflink_copy)
+    monkeypatch.setattr(utils.sys, 'platform', 'linux')
+    assert link_file(src, dst) == 'reflink'
+    assert not os.path.samefile(src, dst)
+    with open(dst, 'rb') as f:
+        assert f.read() == b'data'
+
+
+@pytest.mark.parametrize('mode', ['hardlink', 'reflink'])
+def test_link_file_falls_back_to_copy(tmpdir, src, monkeypatch, mode):
+    dst = os.path.join(str(tmpdir), 'dst.nii.gz')
+    with open(dst, 'wb') as f:
+        f.write(b'old')
+    monkeypatch.setattr(os, 'link', _fail(errno.EXDEV))
+    monkeypatch.setattr(utils, '_reflink', _fail(errno.EOPNOTSUPP))
+    assert link_file(src, dst, mode=mode) == 'copy'
+    with open(dst, 'rb') as f:
+        assert f.read() == b'data'
+    # No temporary files are left behind
+    assert sorted(os.listdir(str(tmpdir))) == ['dst.nii.gz', 'src.nii.gz']
+
+
+def test_link_file_raises_other_errors(tmpdir, src, monkeypatch):
+    dst = os.path.join(str(tmpdir), 'dst.nii.gz')
+    monkeypatch.setattr(os, 'link', _fail(errno.EACCES))
+    with pytest.raises(OSError):
+        link_file(src, dst)
+    assert not os.path.exists(dst)
+    with pytest.raises(ValueError):
+        link_file(src, dst, mode='symlink')
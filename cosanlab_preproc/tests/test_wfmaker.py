@@ -0,0 +1,139 @@
+import json
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+benchmark_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'benchmarks')
+
+
+def _make_dataset(raw_dir, missing_anat=()):
+    """ Two subjects with two sessions each of a T1w and one run, except for the (subject, session)s in missing_anat, which have no T1w. """
+
+    os.makedirs(raw_dir)
+    with open(os.path.join(raw_dir, 'dataset_description.json'), 'w') as f:
+        json.dump({'Name': 'test', 'BIDSVersion': '1.0.2'}, f)
+    affine = np.diag([3., 3., 3., 1.])
+    for sub in ['01', '02']:
+        for ses in ['01', '02']:
+            prefix = os.path.join(raw_dir, 'sub-' + sub, 'ses-' + ses)
+            name = 'sub-%s_ses-%s' % (sub, ses)
+            os.makedirs(os.path.join(prefix, 'anat'))
+            os.makedirs(os.path.join(prefix, 'func'))
+            if (sub, ses) not in missing_anat:
+                nib.save(nib.Nifti1Image(np.ones((8, 8, 8), np.float32), affine),
+                         os.path.join(prefix, 'anat', name + '_T1w.nii.gz'))
+            bold = os.path.join(prefix, 'func', name + '_task-rest_run-01_bold')
+            nib.save(nib.Nifti1Image(np.ones((6, 6, 6, 10), np.float32), affine), bold + '.nii.gz')
+            with open(bold + '.json', 'w') as f:
+                json.dump({'RepetitionTime': 2., 'TaskName': 'rest'}, f)
+
+
+@pytest.fixture
+def project_dir(tmpdir, monkeypatch):
+    """ An empty project with stand-ins for the FSL and ANTs commands and resources (see benchmarks/stub_tools.py). """
+
+    monkeypatch.syspath_prepend(benchmark_dir)
+    from stub_tools import install_stubs
+    from bench_workflow import make_resources
+
+    stub_dir = str(tmpdir.join('stubs'))
+    install_stubs(os.path.join(stub_dir, 'bin'), fsl_dir=os.path.join(stub_dir, 'fsl'))
+    make_resources(os.path.join(stub_dir, 'resources'))
+    monkeypatch.setenv('PATH', os.path.join(stub_dir, 'bin') + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('FSLDIR', os.path.join(stub_dir, 'fsl'))
+    monkeypatch.setenv('FSLOUTPUTTYPE', 'NIFTI_GZ')
+    monkeypatch.setenv('COSANLAB_PREPROC_RESOURCES', os.path.join(stub_dir, 'resources'))
+    return str(tmpdir.join('project'))
+
+
+def _flat_inputs(workflow, fullname):
+    """ Names of the nodes feeding a node of the flattened workflow, e.g. 'intermediate.01.ses-01.anat_inputs'. """
+
+    graph = workflow._create_flat_graph()
+    node = [n for n in graph.nodes() if n.fullname == fullname][0]
+    return sorted(set(u.fullname for u in graph.predecessors(node)))
+
+
+def test_batch_nests_sessions_in_subjects(project_dir):
+    from cosanlab_preproc.wfmaker import wfmaker_batch
+    _make_dataset(os.path.join(project_dir, 'raw'))
+
+    batch = wfmaker_batch(project_dir, 'raw', ants_threads=1, mni_template='3mm')
+    assert batch.name == 'intermediate'
+    assert batch.base_dir == os.path.join(project_dir, 'preprocessed')
+    assert sorted(n.name for n in batch._graph.nodes()) == ['01', '02']
+    for sub in ['01', '02']:
+        subject = batch.get_node(sub)
+        assert sorted(n.name for n in subject._graph.nodes()) == ['ses-01', 'ses-02']
+        assert subject._graph.number_of_edges() == 0
+        for ses in ['ses-01', 'ses-02']:
+            session = subject.get_node(ses)
+            # Each session processes its own T1w
+            assert session.get_node('anat_inputs') is None
+            for name in ['realign', 'run_stats', 'brain_extraction', 'normalization', 'coregistration',
+                         'apply_transforms', 'filter_smooth_down_samp', 'make_cov', 'datasink']:
+                assert session.get_node(name) is not None, name
+            t1w = os.path.join(project_dir, 'raw', 'sub-' + sub, ses, 'anat', 'sub-%s_%s_T1w.nii.gz' % (sub, ses))
+            assert session.get_node('n4_correction').inputs.input_image == t1w
+
+    # Only the requested subjects, by ID or index
+    batch = wfmaker_batch(project_dir, 'raw', subjects=['sub-02'], ants_threads=1, mni_template='3mm')
+    assert [n.name for n in batch._graph.nodes()] == ['02']
+    batch = wfmaker_batch(project_dir, 'raw', subjects=[0], ants_threads=1, mni_template='3mm')
+    assert [n.name for n in batch._graph.nodes()] == ['01']
+
+
+def test_shared_anat_feeds_every_session(project_dir):
+    from cosanlab_preproc.wfmaker import wfmaker_batch
+    _make_dataset(os.path.join(project_dir, 'raw'), missing_anat=[('02', '02')])
+
+    # Each session needs its own T1w unless the anatomical workflow is shared
+    with pytest.raises(IOError):
+        wfmaker_batch(project_dir, 'raw', ants_threads=1, mni_template='3mm')
+
+    batch = wfmaker_batch(project_dir, 'raw', shared_anat=True, ants_threads=1, mni_template='3mm')
+    for sub in ['01', '02']:
+        subject = batch.get_node(sub)
+        assert sorted(n.name for n in subject._graph.nodes()) == ['anat', 'ses-01', 'ses-02']
+        t1w = os.path.join(project_dir, 'raw', 'sub-' + sub, 'ses-01', 'anat', 'sub-%s_ses-01_T1w.nii.gz' % sub)
+        assert subject.get_node('anat').get_node('n4_correction').inputs.input_image == t1w
+        for ses in ['ses-01', 'ses-02']:
+            session = subject.get_node(ses)
+            # Sessions don't process a T1w of their own
+            for name in ['n4_correction', 'brain_extraction', 'normalization']:
+                assert session.get_node(name) is None, name
+            assert _flat_inputs(batch, 'intermediate.%s.%s.anat_inputs' % (sub, ses)) == ['intermediate.%s.anat.outputnode' % sub]
+            assert 'intermediate.%s.%s.anat_inputs' % (sub, ses) in _flat_inputs(batch, 'intermediate.%s.%s.coregistration' % (sub, ses))
+
+    # A session without a T1w can't provide the shared one
+    with pytest.raises(IOError):
+        wfmaker_batch(project_dir, 'raw', subjects=['sub-02'], shared_anat='02', ants_threads=1, mni_template='3mm')
+    batch = wfmaker_batch(project_dir, 'raw', subjects=['sub-01'], shared_anat='02', ants_threads=1, mni_template='3mm')
+    t1w = os.path.join(project_dir, 'raw', 'sub-01', 'ses-02', 'anat', 'sub-01_ses-02_T1w.nii.gz')
+    assert batch.get_node('01').get_node('anat').get_node('n4_correction').inputs.input_image == t1w
+
+
+def test_shared_anats():
+    from cosanlab_preproc.wfmaker import _shared_anats
+
+    class File(object):
+        def __init__(self, filename):
+            self.filename = filename
+
+    class Layout(object):
+        anats = {'01': [], '02': ['ses-02_T1w.nii.gz'], '03': ['ses-03_T1w.nii.gz']}
+
+        def get(self, subject, type, extensions, session=None):
+            sessions = [session] if session else sorted(self.anats)
+            return [File(f) for s in sessions for f in self.anats[s]]
+
+        def get_sessions(self, subject):
+            return sorted(self.anats)
+
+    layout = Layout()
+    assert _shared_anats(layout, '01', True) == ['ses-02_T1w.nii.gz']
+    assert _shared_anats(layout, '01', 'ses-03') == ['ses-03_T1w.nii.gz']
+    assert _shared_anats(layout, '01', 'template') == ['ses-02_T1w.nii.gz', 'ses-03_T1w.nii.gz']
+    with pytest.raises(IOError):
+        _shared_anats(layout, '01', '01')
@@ -0,0 +1,313 @@
+from __future__ import division
+
+'''
+Preproc Timing
+==============
+
+Post-run analysis of where a workflow's wall time went. Node runtimes are read from the result files nipype leaves in each node's working directory (e.g. preprocessed/intermediate/<subId>), the dependency graph is rebuilt from node inputs that point into other nodes' working directories, and the run is summarized as:
+
+- the critical path: the chain of nodes (and the scheduling waits between them) that determined the wall time
+- the longest dependency chain: the wall time the workflow would take with unlimited cores
+- cores left idle (parallel slack), overall and while each node of the critical path was running
+- the stages (node names, e.g. normalization or apply_transforms) that dominate wall time and core time
+
+Nodes reused from nipype's cache report the times of the run that produced them, so this is most meaningful for a workflow run from scratch.
+
+Can also be run from the command line:
+
+    python -m cosanlab_preproc.timing /data/project/preprocessed/intermediate/01 --n_procs 16
+
+'''
+
+__all__ = ['load_node_results', 'critical_path', 'longest_path', 'core_usage', 'stage_summary', 'analyze_workflow', 'print_report']
+__author__ = ["Luke Chang"]
+__license__ = "MIT"
+
+import os
+from glob import glob
+import numpy as np
+import pandas as pd
+
+
+def _strings(value):
+    """ All strings within a (nested) input value. """
+
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for v in value.values():
+            for s in _strings(v):
+                yield s
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            for s in _strings(v):
+                yield s
+
+
+def _owner(path, node_dirs):
+    """ Working directory in node_dirs that path is in, or None. """
+
+    path = os.path.dirname(os.path.abspath(path))
+    while path and path != os.path.dirname(path):
+        if path in node_dirs:
+            return path
+        path = os.path.dirname(path)
+    return None
+
+
+def load_node_results(work_dir):
+    """
+    Read the runtime of every node that ran under a workflow working directory and rebuild their dependencies.
+
+    Args:
+        work_dir: working directory of a workflow, e.g. preprocessed/intermediate/<subId>
+
+    Returns:
+        nodes: DataFrame indexed by node (path of its working directory relative to work_dir) with columns stage (node name), interface (module and class name), start and end (seconds from the first node's start, which is in nodes.attrs['start_time']), duration, n_procs, mem_gb, the resource monitor's cpu_percent and mem_peak_gb when it was enabled, and depends (list of nodes whose outputs it used)
+
+    """
+
+    import warnings
+    from nipype.utils.filemanip import loadpkl
+
+    work_dir = os.path.abspath(work_dir)
+    rows = {}
+    inputs = {}
+    for result_file in glob(os.path.join(work_dir, '**', 'result_*.pklz'), recursive=True):
+        node_dir = os.path.dirname(result_file)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                result = loadpkl(result_file)
+        except Exception:
+            continue
+        runtime = getattr(result, 'runtime', None)
+        if runtime is None or not getattr(runtime, 'startTime', None) or not getattr(runtime, 'endTime', None):
+            continue
+        interface = getattr(result, 'interface', None)
+        row = {'stage': os.path.basename(node_dir),
+               'interface': '%s.%s' % (interface.__module__, interface.__name__) if isinstance(interface, type) else None,
+               'start': pd.Timestamp(runtime.startTime),
+               'end': pd.Timestamp(runtime.endTime),
+               'n_procs': 1,
+               'mem_gb': np.nan,
+               'cpu_percent': getattr(runtime, 'cpu_percent', np.nan),
+               'mem_peak_gb': getattr(runtime, 'mem_peak_gb', np.nan)}
+        # Declared resources are only saved with the node itself
+        node_file = os.path.join(node_dir, '_node.pklz')
+        if os.path.exists(node_file):
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    node = loadpkl(node_file)
+                row['n_procs'] = node.n_procs
+                row['mem_gb'] = node.mem_gb
+            except Exception:
+                pass
+        inputs_file = os.path.join(node_dir, '_inputs.pklz')
+        try:
+            inputs[node_dir] = loadpkl(inputs_file) if os.path.exists(inputs_file) else {}
+        except Exception:
+            inputs[node_dir] = {}
+        rows[node_dir] = row
+
+    if not rows:
+        raise IOError("No node results found under %s" % work_dir)
+
+    node_dirs = set(rows)
+    for node_dir, row in rows.items():
+        depends = set()
+        for s in _strings(inputs[node_dir]):
+            if s.startswith(os.sep):
+                owner = _owner(s, node_dirs)
+                if owner is not None and owner != node_dir:
+                    depends.add(os.path.relpath(owner, work_dir))
+        row['depends'] = sorted(depends)
+
+    nodes = pd.DataFrame.from_dict(rows, orient='index')
+    nodes.index = [os.path.relpath(d, work_dir) for d in nodes.index]
+    nodes.index.name = 'node'
+    origin = nodes['start'].min()
+    nodes['start'] = (nodes['start'] - origin).dt.total_seconds()
+    nodes['end'] = (nodes['end'] - origin).dt.total_seconds()
+    nodes['duration'] = nodes['end'] - nodes['start']
+    nodes = nodes.sort_values('start')
+    nodes.attrs['start_time'] = origin
+    return nodes
+
+
+def critical_path(nodes):
+    """
+    Get the chain of nodes that determined the wall time: starting from the node that finished last, repeatedly step to the dependency that finished last. Each node's wait is the time between its last dependency finishing (or the workflow starting) and the node starting, i.e. time spent queued by the scheduler.
+
+    Args:
+        nodes: DataFrame from load_node_results
+
+    Returns:
+        path: DataFrame of the critical path nodes in order with columns stage, start, duration and wait
+
+    """
+
+    path = []
+    node = nodes['end'].idxmax()
+    while node is not None:
+        depends = [d for d in nodes.at[node, 'depends'] if d in nodes.index]
+        previous = nodes.loc[depends, 'end'].idxmax() if depends else None
+        ready = nodes.at[previous, 'end'] if previous is not None else 0.
+        path.append((node, nodes.at[node, 'stage'], nodes.at[node, 'start'], nodes.at[node, 'duration'],
+                     max(nodes.at[node, 'start'] - ready, 0.)))
+        node = previous
+    return pd.DataFrame(path[::-1], columns=['node', 'stage', 'start', 'duration', 'wait']).set_index('node')
+
+
+def longest_path(nodes):
+    """
+    Get the longest chain of dependent nodes by run time, i.e. the wall time the workflow would take with unlimited cores and no scheduling delay.
+
+    Args:
+        nodes: DataFrame from load_node_results
+
+    Returns:
+        length: total run time of the chain in seconds
+        path: list of nodes in the chain
+
+    """
+
+    finish = {}
+    previous = {}
+    # Dependencies always start before their dependents, so start order is a topological order
+    for node in nodes.sort_values('start').index:
+        depends = [d for d in nodes.at[node, 'depends'] if d in finish]
+        best = max(depends, key=lambda d: finish[d]) if depends else None
+        finish[node] = nodes.at[node, 'duration'] + (finish[best] if best is not None else 0.)
+        previous[node] = best
+    node = max(finish, key=finish.get)
+    length = finish[node]
+    path = []
+    while node is not None:
+        path.append(node)
+        node = previous[node]
+    return length, path[::-1]
+
+
+def core_usage(nodes, start=None, end=None):
+    """
+    Average number of cores declared busy (the sum of running nodes' n_procs) between start and end.
+
+    Args:
+        nodes: DataFrame from load_node_results
+        start: start of the interval in seconds; default the first node's start
+        end: end of the interval in seconds; default the last node's end
+
+    Returns:
+        cores: mean number of busy cores
+
+    """
+
+    start = nodes['start'].min() if start is None else start
+    end = nodes['end'].max() if end is None else end
+    if end <= start:
+        return float(nodes.loc[(nodes['start'] <= start) & (nodes['end'] >= end), 'n_procs'].sum())
+    overlap = (np.minimum(nodes['end'], end) - np.maximum(nodes['start'], start)).clip(lower=0)
+    return float((overlap * nodes['n_procs']).sum() / (end - start))
+
+
+def stage_summary(nodes, path=None):
+    """
+    Summarize run time by stage (node name) across runs, sessions and subjects.
+
+    Args:
+        nodes: DataFrame from load_node_results
+        path: DataFrame from critical_path, to add each stage's time on the critical path
+
+    Returns:
+        stages: DataFrame indexed by stage with columns count, total and max run time, core_hours (run time x n_procs), share of all core time and critical (time on the critical path), sorted by critical then total time
+
+    """
+
+    nodes = nodes.assign(core_seconds=nodes['duration'] * nodes['n_procs'])
+    stages = nodes.groupby('stage').agg(count=('duration', 'size'), total=('duration', 'sum'),
+                                        max=('duration', 'max'), core_seconds=('core_seconds', 'sum'),
+                                        n_procs=('n_procs', 'max'))
+    stages['share'] = stages['core_seconds'] / stages['core_seconds'].sum()
+    stages['core_hours'] = stages.pop('core_seconds') / 3600.
+    stages['critical'] = 0.
+    if path is not None:
+        stages['critical'] = path.groupby('stage')['duration'].sum().reindex(stages.index).fillna(0.)
+    return stages.sort_values(['critical', 'total'], ascending=False)
+
+
+def analyze_workflow(work_dir, n_procs=None):
+    """
+    Analyze the run time of a finished workflow.
+
+    Args:
+        work_dir: working directory of a workflow, e.g. preprocessed/intermediate/<subId>
+        n_procs: number of cores the workflow was run with, e.g. MultiProc's n_procs; default the most cores declared busy at once
+
+    Returns:
+        analysis: dict with nodes (load_node_results), critical_path (with the mean busy cores while each node ran), longest_path, longest_path_time, stages (stage_summary), wall_time, n_procs, busy_cores (mean over the run), utilization (busy_cores / n_procs) and idle_core_hours (parallel slack)
+
+    """
+
+    nodes = load_node_results(work_dir)
+    if n_procs is None:
+        n_procs = max(core_usage(nodes, t, t) for t in nodes['start'])
+    path = critical_path(nodes)
+    path['busy_cores'] = [core_usage(nodes, row.start - row.wait, row.start + row.duration) for row in path.itertuples()]
+    length, chain = longest_path(nodes)
+    wall_time = nodes['end'].max() - nodes['start'].min()
+    busy_cores = core_usage(nodes)
+    return {'nodes': nodes,
+            'critical_path': path,
+            'longest_path': chain,
+            'longest_path_time': length,
+            'stages': stage_summary(nodes, path),
+            'wall_time': wall_time,
+            'n_procs': n_procs,
+            'busy_cores': busy_cores,
+            'utilization': busy_cores / n_procs,
+            'idle_core_hours': (n_procs - busy_cores) * wall_time / 3600.}
+
+
+def _format_time(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+def print_report(analysis, n_stages=15):
+    """ Print an analysis from analyze_workflow. """
+
+    nodes = analysis['nodes']
+    path = analysis['critical_path'].copy()
+    n_procs = analysis['n_procs']
+    print("Wall time: %s for %d nodes" % (_format_time(analysis['wall_time']), len(nodes)))
+    print("Cores: %g, mean busy %.1f (%.0f%% utilization), %.1f core-hours idle" % (
+        n_procs, analysis['busy_cores'], 100 * analysis['utilization'], analysis['idle_core_hours']))
+    print("Longest dependency chain (wall time with unlimited cores): %s" % _format_time(analysis['longest_path_time']))
+    print("Critical path: %s running, %s waiting to be scheduled\n" % (_format_time(path['duration'].sum()), _format_time(path['wait'].sum())))
+
+    path['idle_cores'] = n_procs - path['busy_cores']
+    for column in ['start', 'duration', 'wait']:
+        path[column] = path[column].map(_format_time)
+    print("Critical path")
+    print(path[['stage', 'start', 'wait', 'duration', 'busy_cores', 'idle_cores']].to_string(float_format='%.1f'))
+    print("")
+
+    stages = analysis['stages'].head(n_stages).copy()
+    for column in ['total', 'max', 'critical']:
+        stages[column] = stages[column].map(_format_time)
+    stages['share'] = (100 * stages['share']).map('%.0f%%'.__mod__)
+    print("Stages by time on the critical path")
+    print(stages[['count', 'n_procs', 'critical', 'total', 'max', 'core_hours', 'share']].to_string(float_format='%.2f'))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Analyze the critical path and core usage of a finished workflow")
+    parser.add_argument('work_dir', help="workflow working directory, e.g. preprocessed/intermediate/<subId>")
+    parser.add_argument('--n_procs', type=float, default=None, help="number of cores the workflow was run with")
+    parser.add_argument('--n_stages', type=int, default=15)
+    args = parser.parse_args()
+    print_report(analyze_workflow(args.work_dir, n_procs=args.n_procs), n_stages=args.n_stages)
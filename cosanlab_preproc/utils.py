@@ -1,15 +1,21 @@
 """Handy utilities"""
 
-__all__ = ['get_resource_path', 'get_anatomical', 'get_n_slices', 'get_ta', 'get_slice_order', 'get_n_volumes', 'get_vox_dims']
+__all__ = ['get_resource_path', 'get_anatomical', 'get_n_slices', 'get_ta', 'get_slice_order', 'get_n_volumes', 'get_vox_dims', 'get_image_gb', 'limit_threads', 'get_n_threads', 'link_file']
 __author__ = ["Luke Chang"]
 __license__ = "MIT"
 
 from os.path import dirname, join, sep as pathsep
 import nibabel as nib
+import errno
 import os
+import shutil
+import sys
+from contextlib import contextmanager
 
 def get_resource_path():
-    """ Get path to nltools resource directory. """
+    """ Get path to nltools resource directory, or the directory in the COSANLAB_PREPROC_RESOURCES environment variable if it's set, e.g. to supply the OASIS_template.nii.gz that brain extraction needs. """
+    if os.environ.get('COSANLAB_PREPROC_RESOURCES'):
+        return join(os.environ['COSANLAB_PREPROC_RESOURCES'], '')
     return join(dirname(__file__), 'resources') + pathsep
 
 
@@ -19,11 +25,10 @@ def get_anatomical():
 
 
 def get_n_slices(volume):
-    """ Get number of volumes of image. """
+    """ Get number of slices of image. """
 
-    import nibabel as nib
-    nii = nib.load(volume)
-    return nii.get_shape()[2]
+    from cosanlab_preproc.nifti import load_header
+    return load_header(volume).get_data_shape()[2]
 
 
 def get_ta(tr, n_slices):
@@ -35,40 +40,37 @@ def get_ta(tr, n_slices):
 def get_slice_order(volume):
     """ Get order of slices """
 
-    import nibabel as nib
-    nii = nib.load(volume)
-    n_slices = nii.get_shape()[2]
+    from cosanlab_preproc.nifti import load_header
+    n_slices = load_header(volume).get_data_shape()[2]
     return range(1, n_slices+1)
 
 
 def get_n_volumes(volume):
     """ Get number of volumes of image. """
 
-    import nibabel as nib
-    nii = nib.load(volume)
-    if len(nib.shape) < 4:
+    from cosanlab_preproc.nifti import load_header
+    shape = load_header(volume).get_data_shape()
+    if len(shape) < 4:
         return 1
     else:
-        return nii.shape[-1]
+        return shape[-1]
 
 
 def get_vox_dims(volume):
     """ Get voxel dimensions of image. """
 
-    import nibabel as nib
+    from cosanlab_preproc.nifti import load_header
     if isinstance(volume, list):
         volume = volume[0]
-    nii = nib.load(volume)
-    hdr = nii.get_header()
-    voxdims = hdr.get_zooms()
+    voxdims = load_header(volume).get_zooms()
     return [float(voxdims[0]), float(voxdims[1]), float(voxdims[2])]
 
 
 def file_getter(layout, subject_id, dist_corr=False, task_name='', session=None):
-    """Helper function to search BIDS layout for session or non-session data. Returns full paths of anatomical, functional, and field map data"""
+    """Helper function to search a BIDS layout (or BIDSIndex) for session or non-session data. Returns full paths of anatomical (None if there isn't one), functional, and field map data"""
 
     if session:
-        anat = layout.get(subject=subject_id, type='T1w', extensions='.nii.gz', session=session)[0].filename
+        anats = layout.get(subject=subject_id, type='T1w', extensions='.nii.gz', session=session)
         if task_name:
             funcs = [f.filename for f in layout.get(subject=subject_id, type='bold', task=task_name, session=session, extensions='.nii.gz')]
         else:
@@ -78,7 +80,7 @@ def file_getter(layout, subject_id, dist_corr=False, task_name='', session=None)
         else:
             fmaps = []
     else:
-        anat = layout.get(subject=subject_id, type='T1w', extensions='.nii.gz')[0].filename
+        anats = layout.get(subject=subject_id, type='T1w', extensions='.nii.gz')
         if task_name:
             funcs = [f.filename for f in layout.get(subject=subject_id, type='bold', task=task_name, extensions='.nii.gz')]
         else:
@@ -88,4 +90,124 @@ def file_getter(layout, subject_id, dist_corr=False, task_name='', session=None)
         else:
             fmaps = []
 
+    # Sessions can lack a T1w when anatomical processing is shared across sessions
+    anat = anats[0].filename if anats else None
+
     return anat, funcs, fmaps
+
+
+def get_image_gb(volume, n_volumes=None, itemsize=4):
+    """ Get size of image in memory in GB, by default as float32; n_volumes overrides the number of volumes, e.g. to size a run resampled to a template. """
+
+    from cosanlab_preproc.nifti import load_header
+    shape = load_header(volume).get_data_shape()
+    if n_volumes is None:
+        n_volumes = shape[3] if len(shape) > 3 else 1
+    return float(shape[0]) * shape[1] * shape[2] * n_volumes * itemsize / 1024.**3
+
+
+# Threads allowed by the innermost limit_threads context, e.g. the n_procs of the node that's running
+_thread_limit = None
+
+
+@contextmanager
+def limit_threads(n_threads):
+    """
+    Limit the threads used by BLAS and OpenMP libraries (e.g. numpy, scipy) within the context, so a node's numerical code doesn't start more threads than the node declares to the nipype scheduler (its n_procs). Libraries already loaded are limited with threadpoolctl if it's installed; environment variables are set for libraries loaded later and for subprocesses. The package's own thread pools (gzip compression, filtering and smoothing) get their default size from get_n_threads, which returns the limit.
+
+    Args:
+        n_threads: maximum number of threads; None doesn't limit threads
+
+    """
+
+    if not n_threads:
+        yield
+        return
+
+    global _thread_limit
+    variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+    previous = dict((v, os.environ.get(v)) for v in variables)
+    for v in variables:
+        os.environ[v] = str(n_threads)
+    previous_limit, _thread_limit = _thread_limit, n_threads
+    try:
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            yield
+        else:
+            with threadpool_limits(limits=n_threads):
+                yield
+    finally:
+        _thread_limit = previous_limit
+        for v, value in previous.items():
+            if value is None:
+                os.environ.pop(v, None)
+            else:
+                os.environ[v] = value
+
+
+def get_n_threads(n_threads=None, default=None):
+    """
+    Get the number of threads a thread pool should use: n_threads if it's given, otherwise the limit of the enclosing limit_threads context (within a node, the n_procs it declares to the scheduler), otherwise default, otherwise the number of cpus.
+
+    Args:
+        n_threads: requested number of threads; default None
+        default: number of threads outside of limit_threads; default None (the number of cpus)
+
+    Returns:
+        n_threads: number of threads
+
+    """
+
+    return n_threads or _thread_limit or default or os.cpu_count() or 1
+
+
+# ioctl that clones a file's extents (a reflink) on Linux filesystems that support it, e.g. btrfs and XFS
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def link_file(src, dst, mode='hardlink'):
+    """
+    Put a file at dst with the contents of src without copying its data where possible. 'hardlink' makes dst another name for src, which takes no space or time but means writing to either changes both; 'reflink' makes a copy-on-write clone that shares src's data until either is modified, where the filesystem supports it (e.g. btrfs, XFS). Either falls back to the next cheapest method when src and dst are on different filesystems or the filesystem doesn't support it, down to copying. An existing dst is replaced, through a temporary file so it's never seen half written, unless it already is src.
+
+    Args:
+        src: file to link
+        dst: destination path; its directory must exist
+        mode: 'hardlink' (then reflink, then copy), 'reflink' (then copy) or 'copy'; default 'hardlink'
+
+    Returns:
+        method: the method that was used, 'existing', 'hardlink', 'reflink' or 'copy'
+
+    """
+
+    fallbacks = {'hardlink': ['hardlink', 'reflink', 'copy'], 'reflink': ['reflink', 'copy'], 'copy': ['copy']}
+    if mode not in fallbacks:
+        raise ValueError("mode must be: hardlink, reflink or copy")
+    if mode == 'hardlink' and os.path.exists(dst) and os.path.samefile(src, dst):
+        return 'existing'
+
+    methods = [m for m in fallbacks[mode] if m != 'reflink' or sys.platform.startswith('linux')]
+    tmp = '%s.%d.tmp' % (dst, os.getpid())
+    for method in methods:
+        try:
+            if method == 'hardlink':
+                os.link(os.path.realpath(src), tmp)
+            elif method == 'reflink':
+                _reflink(src, tmp)
+            else:
+                shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+            return method
+        except OSError as e:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            # e.g. different filesystems, or links/clones aren't supported
+            if method == 'copy' or e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS):
+                raise
@@ -1,8 +1,9 @@
 from __future__ import division
-from ._builder import builder
+from ._builder import builder, anat_builder
 import os
 from bids.grabbids import BIDSLayout
 from .utils import file_getter
+from .bids_index import load_bids_index
 import six
 
 """
@@ -14,7 +15,7 @@ Handy function to build dynamic workflows using BIDS formatted data files.
 """
 
 
-def wfmaker(project_dir, raw_dir, subject_id, task_name='', apply_trim=False, apply_dist_corr=False, apply_smooth=False, apply_filter=False, mni_template='2mm', apply_n4=True, ants_threads=8, readable_crash_files=False):
+def wfmaker(project_dir, raw_dir, subject_id, task_name='', apply_trim=False, apply_dist_corr=False, apply_smooth=False, apply_filter=False, mni_template='2mm', apply_n4=True, ants_threads=8, readable_crash_files=False, reports='inline', intermediate_format='nii.gz', apply_compcor=False, bids_index=True, shared_anat=False, scratch_dir=None, keep_intermediates=None, sink_mode='hardlink'):
     """
     This function returns a "standard" workflow based on requested settings. Assumes data is in the following directory structure in BIDS format:
 
@@ -27,11 +28,9 @@ def wfmaker(project_dir, raw_dir, subject_id, task_name='', apply_trim=False, ap
     5) Brain Extraction + N4 Bias Correction (ANTs)
     6) Coregistration (rigid) (ANTs)
     7) Normalization to MNI (non-linear) (ANTs)
-    8) Low-pass filtering (nilearn; optional)
-    8) Smoothing (FSL; optional)
-    9) Downsampling to INT16 precision to save space (nibabel)
+    8) Final stage in a single node (native; reads the normalized run once): optional low-pass filtering within the MNI brain mask, optional smoothing within the MNI brain mask, and downsampling to INT16 precision to save space, for every combination of filter cut-off and smoothing kernel
 
-    If data contains multiple sessions, this returns a *list* of workflows each of which should be run independently.
+    If data contains multiple sessions, this returns a *list* of workflows each of which should be run independently, unless shared_anat is used, in which case it returns a single workflow for the subject that processes the anatomical scan once and reuses it for every session, or scratch_dir is used, in which case the session workflows are nested in a single workflow.
 
     Args:
         project_dir (str): full path to the root of project folder, e.g. /my/data/myproject. All preprocessed data will be placed under this foler and the raw_dir folder will be searched for under this folder
@@ -40,12 +39,20 @@ def wfmaker(project_dir, raw_dir, subject_id, task_name='', apply_trim=False, ap
         apply_trim (int/bool; optional): number of volumes to trim from the beginning of each functional run; default is None
         task_name (str; optional): which functional task runs to process; default is all runs
         apply_dist_corr (bool; optional): look for fmap files and perform distortion correction; default False
-        smooth (int/list; optional): smoothing to perform in FWHM mm; if a list is provided will create outputs for each smoothing kernel separately; default False
-        apply_filter (float/list; optional): low-pass/high-freq filtering cut-offs in Hz; if a list is provided will create outputs for each filter cut-off separately. With high temporal resolution scans .25Hz is a decent value to capture respitory artifacts; default None/False
+        apply_smooth (int/list; optional): smoothing to perform in FWHM mm, within the MNI brain mask so signal doesn't bleed across its edge; if a list is provided will create outputs for each smoothing kernel separately, all from one read of the data in the final stage node; default False
+        apply_filter (float/list; optional): low-pass/high-freq filtering cut-offs in Hz, applied within the MNI brain mask in the final stage node; if a list is provided will create outputs for each filter cut-off separately, each filtered once and shared by every smoothing kernel. With high temporal resolution scans .25Hz is a decent value to capture respitory artifacts; default None/False
         mni_template (str; optional): which mm resolution template to use, e.g. '3mm'; default '2mm'
         apply_n4 (bool; optional): perform N4 Bias Field correction on the anatomical image; default true
         ants_threads (int; optional): number of threads ANTs should use for its processes; default 8
         readable_crash_files (bool; optional): should nipype crash files be saved as txt? This makes them easily readable, but sometimes interferes with nipype's ability to use cached results of successfully run nodes (i.e. picking up where it left off after bugs are fixed); default False
+        reports (str; optional): 'inline' renders QA plots as part of the workflow; 'deferred' only saves the data the plots need so they can be rendered for a whole project afterwards with cosanlab_preproc.reports.render_reports; default 'inline'
+        intermediate_format (str; optional): 'nii' writes intermediate 4D files (distortion correction, realignment, normalization) uncompressed so they can be memory-mapped and skip gzip between nodes; final outputs are always compressed; default 'nii.gz'
+        apply_compcor (bool/list; optional): add CompCor regressors, computed from the normalized data and the normalized tissue segmentation, to the covariates file; True for aCompCor (CSF and white matter) or a list of 'acompcor' and/or 'tcompcor'; default False
+        bids_index (bool/str; optional): read the BIDS dataset from a persistent index that is only rebuilt when the dataset's directories change, rather than re-walking it on every call; True stores it in preprocessed/bids_index.sqlite, a string gives a different file and False uses pybids directly; default True
+        shared_anat (bool/str; optional): for multi-session data, process one anatomical scan per subject (N4, brain extraction and normalization) and use it for every session's coregistration and normalization instead of each session's own T1w; True uses the first session with a T1w, a session label (e.g. '01') uses that session's T1w and 'template' builds an unbiased within-subject template from all the subject's T1w scans (requires FreeSurfer); default False
+        scratch_dir (str; optional): directory on node-local storage (e.g. /scratch/$SLURM_JOB_ID) to run the workflow's working directories in instead of preprocessed/intermediate; final outputs are copied to preprocessed/final in the background as each subject/session finishes. The workflow must be run with the Linear or MultiProc plugin; default None
+        keep_intermediates (list; optional): with scratch_dir, names of nodes (e.g. ['realign', 'normalization']) whose working directories are copied to preprocessed/intermediate as they finish; default None
+        sink_mode (str; optional): how final outputs are put in preprocessed/final from preprocessed/intermediate: 'hardlink' links them so 4D outputs aren't stored twice, but writing to a final file then also changes the intermediate one; 'reflink' makes copy-on-write clones on filesystems that support them (e.g. btrfs, XFS); 'copy' always copies. Links fall back to copying when the two are on different filesystems; default 'hardlink'
 
     Examples:
 
@@ -74,12 +81,119 @@ def wfmaker(project_dir, raw_dir, subject_id, task_name='', apply_trim=False, ap
 
     """
 
-    ##################
-    ### PATH SETUP ###
-    ##################
+    apply_compcor = _check_options(mni_template, reports, intermediate_format, apply_compcor, shared_anat, sink_mode)
+    dirs = _setup_dirs(project_dir, raw_dir)
+    layout = _get_layout(dirs, bids_index)
+    options = dict(task_name=task_name, apply_trim=apply_trim, apply_dist_corr=apply_dist_corr, apply_smooth=apply_smooth, apply_filter=apply_filter, mni_template=mni_template, apply_n4=apply_n4, ants_threads=ants_threads, readable_crash_files=readable_crash_files, reports=reports, intermediate_format=intermediate_format, apply_compcor=apply_compcor, shared_anat=shared_anat, sink_mode=sink_mode)
+    if scratch_dir is None:
+        return _subject_workflow(project_dir, dirs, layout, subject_id, options)
+    scratch_dirs = _scratch_dirs(dirs, scratch_dir)
+    workflow = _top_workflow(dirs, scratch_dirs, keep_intermediates)
+    workflow.add_nodes([_nest_sessions(_subject_workflow(project_dir, scratch_dirs, layout, subject_id, options))])
+    return workflow
+
+
+def wfmaker_batch(project_dir, raw_dir, subjects='all', task_name='', apply_trim=False, apply_dist_corr=False, apply_smooth=False, apply_filter=False, mni_template='2mm', apply_n4=True, ants_threads=8, readable_crash_files=False, reports='inline', intermediate_format='nii.gz', apply_compcor=False, bids_index=True, shared_anat=False, scratch_dir=None, keep_intermediates=None, sink_mode='hardlink'):
+    """
+    Build a single workflow that preprocesses many subjects, so that one nipype scheduler (e.g. MultiProc or SLURMGraph) can pack the runs of all subjects onto the available resources, rather than running a separate process, BIDS layout and scheduler per subject. The BIDS layout is read once and shared by all subjects.
+
+    Each subject's workflow is the same one wfmaker would build and is nested in the batch workflow as a sub-workflow (sessions are nested within their subject), so intermediate and final outputs end up in the same place as they would with wfmaker.
+
+    Args:
+        project_dir (str): full path to the root of project folder; see wfmaker
+        raw_dir (str): folder name for raw data; see wfmaker
+        subjects (list/str; optional): list of subject IDs (e.g. 'sub-0001') or integer indices into the subjects in raw_dir, or 'all'; default 'all'
+        All other arguments are the same as wfmaker's
+
+    Examples:
+
+        >>> from cosanlab_preproc.wfmaker import wfmaker_batch
+        >>> workflow = wfmaker_batch(
+                        project_dir = '/data/project',
+                        raw_dir = 'raw',
+                        subjects = 'all',
+                        apply_smooth = 6)
+        >>>
+        >>> workflow.run('MultiProc',plugin_args = {'n_procs': 64})
+
+    """
+
+    apply_compcor = _check_options(mni_template, reports, intermediate_format, apply_compcor, shared_anat, sink_mode)
+    dirs = _setup_dirs(project_dir, raw_dir)
+    layout = _get_layout(dirs, bids_index)
+    options = dict(task_name=task_name, apply_trim=apply_trim, apply_dist_corr=apply_dist_corr, apply_smooth=apply_smooth, apply_filter=apply_filter, mni_template=mni_template, apply_n4=apply_n4, ants_threads=ants_threads, readable_crash_files=readable_crash_files, reports=reports, intermediate_format=intermediate_format, apply_compcor=apply_compcor, shared_anat=shared_anat, sink_mode=sink_mode)
+
+    if isinstance(subjects, six.string_types):
+        if subjects != 'all':
+            raise ValueError("subjects must be a list or 'all'")
+        subjects = ['sub-' + s for s in layout.get_subjects()]
+    if not subjects:
+        raise ValueError("No subjects to process")
+
+    scratch_dirs = _scratch_dirs(dirs, scratch_dir) if scratch_dir is not None else None
+    batch = _top_workflow(dirs, scratch_dirs, keep_intermediates)
+    for subject_id in subjects:
+        batch.add_nodes([_nest_sessions(_subject_workflow(project_dir, scratch_dirs or dirs, layout, subject_id, options))])
+    return batch
+
+
+def _top_workflow(dirs, scratch_dirs=None, keep_intermediates=None):
+    """ Workflow to nest subject workflows in. Subject workflows keep their names, so nesting them in a workflow named after the intermediate dir keeps their working directories the same as with wfmaker. With scratch_dirs it's a ScratchWorkflow in the scratch intermediate dir that copies outputs back to dirs. """
+
+    from nipype.pipeline.engine import Workflow
+
+    if scratch_dirs is None:
+        workflow = Workflow(name=os.path.basename(dirs['output_interm_dir']))
+        workflow.base_dir = dirs['output_dir']
+        return workflow
+
+    from .scratch import ScratchWorkflow
+    workflow = ScratchWorkflow(name=os.path.basename(scratch_dirs['output_interm_dir']),
+                               scratch_final_dir=scratch_dirs['output_final_dir'], final_dir=dirs['output_final_dir'],
+                               scratch_interm_dir=scratch_dirs['output_interm_dir'], interm_dir=dirs['output_interm_dir'],
+                               keep_intermediates=keep_intermediates)
+    workflow.base_dir = scratch_dirs['output_dir']
+    return workflow
+
+
+def _nest_sessions(workflow):
+    """ Nest a list of session workflows from _subject_workflow in a workflow for the subject. """
+
+    from nipype.pipeline.engine import Workflow
+
+    if not isinstance(workflow, list):
+        return workflow
+    sub_workflow = Workflow(name=os.path.basename(workflow[0].base_dir))
+    sub_workflow.add_nodes(workflow)
+    return sub_workflow
+
+
+def _check_options(mni_template, reports, intermediate_format, apply_compcor, shared_anat, sink_mode):
+    """ Validate workflow options shared by wfmaker and wfmaker_batch. Returns apply_compcor as a list or False. """
+
     if mni_template not in ['1mm', '2mm', '3mm']:
         raise ValueError("MNI template must be: 1mm, 2mm, or 3mm")
+    if reports not in ['inline', 'deferred']:
+        raise ValueError("reports must be: inline or deferred")
+    if intermediate_format not in ['nii', 'nii.gz']:
+        raise ValueError("intermediate_format must be: nii or nii.gz")
+    if apply_compcor is True:
+        apply_compcor = ['acompcor']
+    if apply_compcor and not all(c in ['acompcor', 'tcompcor'] for c in apply_compcor):
+        raise ValueError("apply_compcor must be: True or a list of acompcor and/or tcompcor")
+    if not isinstance(shared_anat, (bool,) + six.string_types):
+        raise ValueError("shared_anat must be: True, False, a session label or template")
+    if sink_mode not in ['hardlink', 'reflink', 'copy']:
+        raise ValueError("sink_mode must be: hardlink, reflink or copy")
+    return apply_compcor
+
 
+def _setup_dirs(project_dir, raw_dir):
+    """ Get the data, output and log directories of a project, creating them if needed. """
+
+    ##################
+    ### PATH SETUP ###
+    ##################
     data_dir = os.path.join(project_dir, raw_dir)
     output_dir = os.path.join(project_dir, 'preprocessed')
     output_final_dir = os.path.join(output_dir, 'final')
@@ -93,7 +207,37 @@ def wfmaker(project_dir, raw_dir, subject_id, task_name='', apply_trim=False, ap
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
-    layout = BIDSLayout(data_dir)
+    return dict(data_dir=data_dir, output_dir=output_dir, output_final_dir=output_final_dir, output_interm_dir=output_interm_dir, log_dir=log_dir)
+
+
+def _scratch_dirs(dirs, scratch_dir):
+    """ Project directories with the output directories moved to scratch_dir, creating them if needed. The data and log directories stay in the project. """
+
+    scratch_dirs = dict(dirs, output_dir=os.path.abspath(scratch_dir),
+                        output_final_dir=os.path.join(os.path.abspath(scratch_dir), os.path.basename(dirs['output_final_dir'])),
+                        output_interm_dir=os.path.join(os.path.abspath(scratch_dir), os.path.basename(dirs['output_interm_dir'])))
+    for d in ['output_final_dir', 'output_interm_dir']:
+        if not os.path.exists(scratch_dirs[d]):
+            os.makedirs(scratch_dirs[d])
+    return scratch_dirs
+
+
+def _get_layout(dirs, bids_index):
+    """ Get the BIDS layout of a project, from its persistent index if bids_index. """
+
+    if bids_index:
+        index_file = bids_index if isinstance(bids_index, six.string_types) else os.path.join(dirs['output_dir'], 'bids_index.sqlite')
+        return load_bids_index(dirs['data_dir'], index_file)
+    return BIDSLayout(dirs['data_dir'])
+
+
+def _subject_workflow(project_dir, dirs, layout, subject_id, options):
+    """ Build the workflow (or list of per session workflows) of one subject. """
+
+    from nipype.pipeline.engine import Workflow
+
+    options = dict(options)
+
     # Dartmouth subjects are named with the sub- prefix, handle whether we receive an integer identifier for indexing or the full subject id with prefixg
     if isinstance(subject_id, six.string_types):
         subId = subject_id[4:]
@@ -106,15 +250,47 @@ def wfmaker(project_dir, raw_dir, subject_id, task_name='', apply_trim=False, ap
     # For multi-session datasets return a list of workflows consisting of pipelines specific to all data within that session
     # Otherwise return a single workflow
     sessions = layout.get_sessions()
-    if len(sessions) > 0:
+    shared_anat = options.pop('shared_anat')
+    if len(sessions) > 0 and shared_anat:
+        # One anatomical workflow whose outputs feed every session workflow, all within a workflow for the subject
+        anat_wf = anat_builder(subject_id, subId, dirs['output_interm_dir'], _shared_anats(layout, subId, shared_anat), mni_template=options['mni_template'], apply_n4=options['apply_n4'], ants_threads=options['ants_threads'])
+        workflow = Workflow(name=subId)
+        workflow.base_dir = dirs['output_interm_dir']
+        for s in sessions:
+            anat, funcs, fmaps = file_getter(layout, subId, options['apply_dist_corr'], options['task_name'], session=s)
+            if not funcs:
+                continue
+            w = builder(subject_id=subject_id, subId=subId, project_dir=project_dir, layout=layout, anat=None, funcs=funcs, fmaps=fmaps, session=s, shared_anat=True, **dict(dirs, **options))
+            workflow.connect([
+                (anat_wf, w, [('outputnode.brain', 'anat_inputs.brain'),
+                              ('outputnode.transform', 'anat_inputs.transform'),
+                              ('outputnode.warped_image', 'anat_inputs.warped_image'),
+                              ('outputnode.segmentation', 'anat_inputs.segmentation')])
+            ])
+
+    elif len(sessions) > 0:
         workflow = []
         for s in sessions:
-            anat, funcs, fmaps = file_getter(layout, subId, apply_dist_corr, task_name, session=s)
-            w = builder(subject_id=subject_id, subId=subId, project_dir=project_dir, data_dir=data_dir, output_dir=output_dir, output_final_dir=output_final_dir, output_interm_dir=output_interm_dir, log_dir=log_dir, layout=layout, anat=anat, funcs=funcs, fmaps=fmaps, task_name=task_name, session=s, apply_trim=apply_trim, apply_dist_corr=apply_dist_corr, apply_smooth=apply_smooth, apply_filter=apply_filter, mni_template=mni_template, apply_n4=apply_n4, ants_threads=ants_threads, readable_crash_files=readable_crash_files)
+            anat, funcs, fmaps = file_getter(layout, subId, options['apply_dist_corr'], options['task_name'], session=s)
+            w = builder(subject_id=subject_id, subId=subId, project_dir=project_dir, layout=layout, anat=anat, funcs=funcs, fmaps=fmaps, session=s, **dict(dirs, **options))
             workflow.append(w)
 
     else:
-        anat, funcs, fmaps = file_getter(layout, subId, apply_dist_corr, task_name)
-        workflow = builder(subject_id=subject_id, subId=subId, project_dir=project_dir, data_dir=data_dir, output_dir=output_dir, output_final_dir=output_final_dir, output_interm_dir=output_interm_dir, log_dir=log_dir, layout=layout, anat=anat, funcs=funcs, fmaps=fmaps, task_name=task_name, session=None, apply_trim=apply_trim, apply_dist_corr=apply_dist_corr, apply_smooth=apply_smooth, apply_filter=apply_filter, mni_template=mni_template, apply_n4=apply_n4, ants_threads=ants_threads, readable_crash_files=readable_crash_files)
+        anat, funcs, fmaps = file_getter(layout, subId, options['apply_dist_corr'], options['task_name'])
+        workflow = builder(subject_id=subject_id, subId=subId, project_dir=project_dir, layout=layout, anat=anat, funcs=funcs, fmaps=fmaps, session=None, **dict(dirs, **options))
 
     return workflow
+
+
+def _shared_anats(layout, subId, shared_anat):
+    """ Get the T1w scan(s) a subject's shared anatomical workflow is built from. """
+
+    anats = [f.filename for f in layout.get(subject=subId, type='T1w', extensions='.nii.gz')]
+    if shared_anat == 'template':
+        return anats
+    for s in layout.get_sessions(subject=subId):
+        if shared_anat is True or shared_anat in [s, 'ses-' + s]:
+            session_anats = [f.filename for f in layout.get(subject=subId, type='T1w', session=s, extensions='.nii.gz')]
+            if session_anats:
+                return session_anats[:1]
+    raise IOError("No T1w anatomical scan found for subject %s and shared_anat=%s" % (subId, shared_anat))